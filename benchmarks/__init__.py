@@ -0,0 +1,30 @@
+"""
+Benchmarks for dkredis.
+
+The benchmarks need a redis server (``REDIS_HOST``, default localhost).
+Run an individual benchmark as a module, e.g.::
+
+    python -m benchmarks.bench_connect
+
+or run (some of) them, and compare the results with a saved baseline::
+
+    python -m benchmarks --quick cache lock
+    inv bench --names=cache,lock --quick
+
+"""
+import time
+
+
+def measure(fn, n=1000):
+    """Call ``fn()`` ``n`` times and return the number of calls per second.
+    """
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return n / (time.perf_counter() - start)
+
+
+def report(name, value, unit='ops/sec'):
+    """Print one benchmark result.
+    """
+    print(f'{name:<48} {value:>14,.1f} {unit}')
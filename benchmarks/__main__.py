@@ -0,0 +1,239 @@
+"""
+Run the benchmarks, save the results as JSON, and compare them with a
+saved baseline::
+
+    python -m benchmarks                    # all benchmarks
+    python -m benchmarks cache lock         # some of them
+    python -m benchmarks --quick            # fewer iterations
+    python -m benchmarks --save-baseline    # the results become the baseline
+    python -m benchmarks --server spawn     # start a redis-server
+
+``--server`` is ``env`` (use ``REDIS_HOST``/``REDIS_PORT``, default
+localhost:6379), ``spawn`` (start a private ``redis-server`` on a free
+port) or ``fake`` (an in-process fakeredis server, if ``fakeredis`` is
+installed, which is only useful to check that the benchmarks run).
+
+Results are written to ``.benchmarks/latest.json``, a result is flagged
+as a regression when it is more than ``--threshold`` (default 10%) worse
+than the baseline (``.benchmarks/baseline.json``).
+"""
+import argparse
+import datetime
+import importlib
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import redis
+
+from dkredis import dkredis, scripts
+
+RESULTS_DIR = '.benchmarks'
+
+
+def _update_unit(name):
+    return 'retries' if name.endswith('retries') else 'ops/sec'
+
+
+#: name -> (module, kwargs, kwargs with --quick, unit of the results,
+#: names of the fields of tuple results).
+SUITE = {
+    'connect': ('bench_connect', {}, {'n': 200}, 'ops/sec', None),
+    'cache': ('bench_cache', {}, {'n': 200}, 'ops/sec', None),
+    'serializers': ('bench_serializers', {}, {'n': 20}, None,
+                    [('bytes', 'bytes'), ('dumps', 'us'), ('loads', 'us')]),
+    'compression': ('bench_compression', {}, {'n': 2}, None,
+                    [('bytes', 'bytes'), ('compressed', 'bytes'),
+                     ('compress', 'ms'), ('decompress', 'ms')]),
+    'hashes': ('bench_hashes', {}, {'sizes': (10, 1000)}, 's', None),
+    'update': ('bench_update', {}, {'threads': 8, 'n': 20}, _update_unit,
+               None),
+    'pop': ('bench_pop', {}, {'n': 200}, 'ops/sec', None),
+    'lock': ('bench_lock', {}, {'threads': 4, 'n': 5}, None, None),
+    'multilock': ('bench_multilock', {}, {'n': 5, 'batch': 50},
+                  'batches/sec', None),
+    'ratelimit': ('bench_ratelimit', {}, {'n': 200, 'batch': 20},
+                  'ops/sec', None),
+    'stampede': ('bench_stampede', {}, {'callers': 8}, 'calls', None),
+}
+
+
+def higher_is_better(unit):
+    return unit.endswith('/sec')
+
+
+def metrics(results, unit, fields):
+    """Flatten the results of a benchmark's ``run()`` to
+       ``{name: {'value': ..., 'unit': ...}}``.
+    """
+    res = {}
+    for key, value in results.items():
+        name = ' / '.join(key) if isinstance(key, tuple) else key
+        if fields is not None:
+            for (field, funit), v in zip(fields, value):
+                res[f'{name}: {field}'] = {'value': v, 'unit': funit}
+        elif isinstance(value, tuple):
+            res[name] = {'value': value[0], 'unit': value[1]}
+        else:
+            u = unit(name) if callable(unit) else unit
+            res[name] = {'value': value, 'unit': u}
+    return res
+
+
+def compare(results, baseline, threshold):
+    """Print the results next to the baseline, return the number of
+       regressions.
+    """
+    regressions = 0
+    for bench, res in results.items():
+        base = baseline.get(bench, {})
+        for name, m in res.items():
+            line = f'{bench + ": " + name:<64} {m["value"]:>14,.2f} {m["unit"]}'
+            old = base.get(name)
+            if old and old['value'] and old['unit'] == m['unit']:
+                change = (m['value'] - old['value']) / old['value']
+                worse = -change if higher_is_better(m['unit']) else change
+                line += f'  ({change:+.1%})'
+                if worse > threshold:
+                    line += '  REGRESSION'
+                    regressions += 1
+            print(line)
+    return regressions
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    r = redis.StrictRedis(port=port)
+    while 1:
+        try:
+            return r.ping()
+        except redis.ConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def start_server(kind):
+    """Start a redis server for the benchmarks (see ``--server``), and
+       point ``dkredis.connect()`` at it. Returns a function that stops
+       it.
+    """
+    if kind == 'env':
+        return lambda: None
+    port = _free_port()
+    if kind == 'spawn':
+        exe = shutil.which('redis-server')
+        if exe is None:
+            sys.exit('redis-server not found')
+        proc = subprocess.Popen(
+            [exe, '--port', str(port), '--save', '', '--appendonly', 'no'],
+            stdout=subprocess.DEVNULL)
+
+        def stop():
+            proc.terminate()
+            proc.wait()
+    else:
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            sys.exit('--server fake needs fakeredis')
+        server = TcpFakeServer(('127.0.0.1', port))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+    os.environ['REDIS_HOST'] = '127.0.0.1'
+    os.environ['REDIS_PORT'] = str(port)
+    _wait_for(port)
+    dkredis.reset_pools()
+    scripts.load(dkredis.connect())
+    return stop
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        prog='python -m benchmarks', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('names', nargs='*', help=f'any of: {", ".join(SUITE)}')
+    p.add_argument('--quick', action='store_true')
+    p.add_argument('--server', choices=['env', 'spawn', 'fake'],
+                   default='env')
+    p.add_argument('--output', default=os.path.join(RESULTS_DIR,
+                                                    'latest.json'))
+    p.add_argument('--baseline', default=os.path.join(RESULTS_DIR,
+                                                      'baseline.json'))
+    p.add_argument('--save-baseline', action='store_true')
+    p.add_argument('--threshold', type=float, default=0.1)
+    p.add_argument('--fail-on-regression', action='store_true')
+    args = p.parse_args(argv)
+
+    names = args.names or list(SUITE)
+    unknown = set(names) - set(SUITE)
+    if unknown:
+        p.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+
+    stop = start_server(args.server)
+    try:
+        try:
+            info = dkredis.connect().info('server')
+        except redis.ResponseError:     # fakeredis
+            info = {}
+        results = {}
+        for name in names:
+            module, kwargs, quick, unit, fields = SUITE[name]
+            mod = importlib.import_module(f'benchmarks.{module}')
+            print(f'running {name}...', file=sys.stderr)
+            results[name] = metrics(
+                mod.run(**(quick if args.quick else kwargs)), unit, fields)
+    finally:
+        stop()
+
+    doc = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'redis_version': info.get('redis_version'),
+            'server': args.server,
+            'quick': args.quick,
+        },
+        'results': results,
+    }
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)['results']
+    regressions = compare(results, baseline, args.threshold)
+
+    outputs = [(args.output, doc)]
+    if args.save_baseline:
+        # keep the baseline of the benchmarks that weren't run
+        outputs.append((args.baseline, dict(
+            doc, results=dict(baseline, **results))))
+    for fname, data in outputs:
+        os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+        with open(fname, 'w') as fp:
+            json.dump(data, fp, indent=2)
+        print(f'results written to {fname}', file=sys.stderr)
+    if regressions:
+        print(f'{regressions} regression(s)', file=sys.stderr)
+        if args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
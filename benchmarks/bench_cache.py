@@ -0,0 +1,40 @@
+"""
+Throughput of ``cache.put`` and ``cache.get`` for small to large values,
+and of the hit path of a ``@cached`` function.
+"""
+import argparse
+
+from dkredis.rediscache import cache, cached
+
+from . import measure, report
+
+SIZES = (100, 10 * 1024, 1024 * 1024)
+
+
+def run(n=2000, sizes=SIZES):
+    results = {}
+    for size in sizes:
+        val = 'x' * size
+        # fewer iterations for large values
+        count = max(10, n * 100 // max(size, 100))
+        results[f'cache.put, {size:,} bytes'] = measure(
+            lambda: cache.put('bench:cache', val, 60), count)
+        results[f'cache.get, {size:,} bytes'] = measure(
+            lambda: cache.get('bench:cache'), count)
+
+    @cached('bench:cached', 60)
+    def fn(x):
+        return {'x': x, 'items': list(range(10))}
+
+    fn(1)
+    results['@cached hit'] = measure(lambda: fn(1), n)
+    cache.remove_many(['bench:cache', 'bench:cached'])
+    return results
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('-n', type=int, default=2000)
+    args = p.parse_args()
+    for name, value in run(args.n).items():
+        report(name, value)
@@ -0,0 +1,59 @@
+"""
+Compression ratio and CPU cost of the compressors in
+:mod:`dkredis.serializers` on typical large cache values (rendered HTML
+and a report dataset). Doesn't need a redis server.
+"""
+import argparse
+import timeit
+
+from dkredis import serializers
+
+
+def sample_html(rows=2000):
+    return '<table>' + ''.join(
+        f'<tr class="row{i % 2}"><td>{i}</td><td>Customer {i * 7 % 1000}</td>'
+        f'<td class="amount">{i * 13.5:.2f}</td></tr>'
+        for i in range(rows)
+    ) + '</table>'
+
+
+def sample_report(rows=5000):
+    return [
+        {'id': i, 'customer': f'Customer {i * 7 % 1000}',
+         'amount': i * 13.5, 'paid': i % 3 == 0}
+        for i in range(rows)
+    ]
+
+
+SAMPLES = {
+    'rendered html': sample_html(),
+    'report dataset': sample_report(),
+}
+
+
+def run(n=20):
+    results = {}
+    for sample, val in SAMPLES.items():
+        raw = serializers.dumps(val, compression=False)
+        for name in serializers.available_compressors():
+            data = serializers.compress(raw, name)
+            compress_ms = timeit.timeit(
+                lambda: serializers.compress(raw, name), number=n) / n * 1e3
+            loads_ms = timeit.timeit(
+                lambda: serializers.loads(data), number=n) / n * 1e3
+            plain_ms = timeit.timeit(
+                lambda: serializers.loads(raw), number=n) / n * 1e3
+            results[(sample, name)] = (
+                len(raw), len(data), compress_ms, loads_ms - plain_ms)
+    return results
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('-n', type=int, default=20)
+    args = p.parse_args()
+    print(f'{"sample":<16} {"compressor":<10} {"bytes":>9} {"compressed":>10} '
+          f'{"ratio":>6} {"compress ms":>12} {"decompress ms":>14}')
+    for (sample, name), (size, csize, c_ms, d_ms) in run(args.n).items():
+        print(f'{sample:<16} {name:<10} {size:>9,} {csize:>10,} '
+              f'{size / csize:>6.1f} {c_ms:>12.2f} {d_ms:>14.2f}')
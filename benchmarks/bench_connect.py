@@ -0,0 +1,37 @@
+"""
+Throughput of ``cache.get`` with a new connection per call (the old
+behavior of ``dkredis.connect()``) and with the shared connection pool.
+"""
+import argparse
+from unittest import mock
+
+from dkredis import dkredis
+from dkredis.rediscache import cache
+
+from . import measure, report
+
+
+def run(n=2000):
+    cache.put('bench:connect', {'hello': 'world'}, 60)
+    results = {}
+
+    connect = dkredis.connect
+    with mock.patch.object(dkredis, 'connect',
+                           lambda *a, **kw: connect(*a, pooled=False, **kw)):
+        results['cache.get (new connection per call)'] = measure(
+            lambda: cache.get('bench:connect'), n)
+
+    dkredis.reset_pools()
+    results['cache.get (shared pool)'] = measure(
+        lambda: cache.get('bench:connect'), n)
+
+    cache.remove('bench:connect')
+    return results
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('-n', type=int, default=2000)
+    args = p.parse_args()
+    for name, value in run(args.n).items():
+        report(name, value)
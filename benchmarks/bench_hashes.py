@@ -0,0 +1,66 @@
+"""
+``mhkeyget`` (SCAN + pipelined HGET) compared with the old KEYS + one
+HGET per hash, and ``get_dict`` (HGETALL) compared with the old HKEYS +
+one HGET per field, for 10, 1k and 100k hashes.
+"""
+import argparse
+import time
+
+from dkredis import dkredis
+
+from . import report
+
+
+def old_mhkeyget(keypattern, field, r):
+    return {h: r.hget(h, field) for h in r.keys(keypattern)}
+
+
+def old_get_dict(key, r):
+    return {f: r.hget(key, f) for f in r.hkeys(key)}
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def setup(r, n):
+    r.delete(*r.keys('bench:h:*') or ['bench:h:none'])
+    for start in range(0, n, 10000):
+        with r.pipeline(transaction=False) as p:
+            for i in range(start, min(n, start + 10000)):
+                p.hset(f'bench:h:{i}', 'x', i)
+            p.execute()
+    r.delete('bench:bighash')
+    r.hset('bench:bighash', mapping={f'f{i}': i for i in range(min(n, 10000))})
+
+
+def run(sizes=(10, 1000, 100000), skip_old_above=10000):
+    r = dkredis.connect()
+    results = {}
+    for n in sizes:
+        setup(r, n)
+        if n <= skip_old_above:
+            results[f'old mhkeyget, {n} hashes'] = timed(
+                lambda: old_mhkeyget('bench:h:*', 'x', r))
+            results[f'old get_dict, {min(n, 10000)} fields'] = timed(
+                lambda: old_get_dict('bench:bighash', r))
+        results[f'mhkeyget, {n} hashes'] = timed(
+            lambda: dkredis.mhkeyget('bench:h:*', 'x', cn=r))
+        results[f'get_dict, {min(n, 10000)} fields'] = timed(
+            lambda: dkredis.get_dict('bench:bighash', cn=r))
+    r.delete(*r.keys('bench:h:*') or ['bench:h:none'])
+    r.delete('bench:bighash')
+    return results
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('--sizes', default='10,1000,100000')
+    p.add_argument('--skip-old-above', type=int, default=10000,
+                   help="don't run the (slow) old versions above this size")
+    args = p.parse_args()
+    sizes = [int(n) for n in args.sizes.split(',')]
+    for name, value in run(sizes, args.skip_old_above).items():
+        report(name, value * 1000, 'ms')
@@ -0,0 +1,83 @@
+"""
+Lock handoff latency (time from one thread releasing a lock until a
+waiting thread has it) and throughput, with many contending threads.
+
+Compares polling for the lock (``SET NX`` and sleep, like the old
+``mutex``) with :class:`dkredis.dkredislocks.Lock`, which wakes waiters
+when it is released.
+"""
+import argparse
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from dkredis import dkredis
+from dkredis.dkredislocks import Lock
+from dkredis.utils import unique_id
+
+
+class PollingLock:
+    def __init__(self, name, waitsecs):
+        self.key = 'bench:polllock:' + name
+        self.waitsecs = waitsecs
+
+    def acquire(self):
+        r = dkredis.connect()
+        self.token = unique_id()
+        while not r.set(self.key, self.token, px=30000, nx=True):
+            time.sleep(self.waitsecs)
+        return True
+
+    def release(self):
+        dkredis.remove_if(self.key, self.token)
+
+
+def run(threads=16, n=20, waitsecs=0.05):
+    results = {}
+    variants = [
+        (f'polling (sleep {waitsecs}s)',
+         lambda: PollingLock('bench', waitsecs)),
+        ('Lock', lambda: Lock('bench:lock')),
+        ('Lock(fair=True)', lambda: Lock('bench:lock', fair=True)),
+    ]
+    for name, mklock in variants:
+        latencies = []
+        released = [None]
+        mu = threading.Lock()
+
+        def work(_):
+            for _ in range(n):
+                lock = mklock()
+                lock.acquire()
+                with mu:
+                    if released[0] is not None:
+                        latencies.append(time.perf_counter() - released[0])
+                        released[0] = None
+                with mu:
+                    released[0] = time.perf_counter()
+                lock.release()
+
+        start = time.perf_counter()
+        with ThreadPool(threads) as pool:
+            pool.map(work, range(threads))
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        results[f'{name}: acquire/release'] = (threads * n / elapsed,
+                                               'ops/sec')
+        results[f'{name}: median handoff'] = (
+            latencies[len(latencies) // 2] * 1000, 'ms')
+        results[f'{name}: p99 handoff'] = (
+            latencies[int(len(latencies) * 0.99)] * 1000, 'ms')
+    return results
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('-t', '--threads', type=int, default=16)
+    p.add_argument('-n', type=int, default=20, help='locks per thread')
+    p.add_argument('-w', '--waitsecs', type=float, default=0.05,
+                   help='sleep between attempts of the polling lock')
+    args = p.parse_args()
+    for name, (value, unit) in run(args.threads, args.n,
+                                   args.waitsecs).items():
+        print(f'{name:<48} {value:>14,.1f} {unit}')
@@ -0,0 +1,37 @@
+"""
+Locking (and releasing) a batch of records: one :class:`Lock` per record
+compared with ``multi_lock``/``multi_unlock``.
+"""
+import argparse
+
+from dkredis.dkredislocks import Lock, multi_lock, multi_unlock
+
+from . import measure, report
+
+
+def run(n=20, batch=200):
+    resources = [f'bench:multilock:{i}' for i in range(batch)]
+
+    def one_by_one():
+        locks = [Lock(resource) for resource in resources]
+        for lock in locks:
+            lock.acquire(blocking=False)
+        for lock in locks:
+            lock.release()
+
+    def all_at_once():
+        multi_unlock(multi_lock(resources))
+
+    return {
+        f'Lock x {batch}': measure(one_by_one, n),
+        f'multi_lock({batch} resources)': measure(all_at_once, n),
+    }
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('-n', type=int, default=20)
+    p.add_argument('-b', '--batch', type=int, default=200)
+    args = p.parse_args()
+    for name, value in run(args.n, args.batch).items():
+        report(name, value, 'batches/sec')
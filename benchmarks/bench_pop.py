@@ -0,0 +1,52 @@
+"""
+Latency of popping values: GET followed by DEL (the old ``pop_pyval``),
+``pop_pyval`` (GETDEL), and ``pop_pyvals`` for a batch of keys.
+"""
+import argparse
+
+from dkredis import dkredis, serializers
+
+from . import measure, report
+
+
+def run(n=2000, batch=100):
+    r = dkredis.connect()
+    results = {}
+
+    def get_del():
+        dkredis.set_pyval('bench:pop', 42, cn=r)
+        val = r.get('bench:pop')
+        r.delete('bench:pop')
+        return serializers.loads(val)
+
+    def getdel():
+        dkredis.set_pyval('bench:pop', 42, cn=r)
+        return dkredis.pop_pyval('bench:pop', cn=r)
+
+    results['set + GET + DEL'] = measure(get_del, n)
+    results['set + pop_pyval'] = measure(getdel, n)
+
+    keys = [f'bench:pop:{i}' for i in range(batch)]
+
+    def pop_each():
+        for key in keys:
+            dkredis.pop_pyval(key, cn=r)
+
+    def pop_many():
+        dkredis.pop_pyvals(keys, cn=r)
+
+    for name, fn in [(f'pop_pyval x {batch}', pop_each),
+                     (f'pop_pyvals({batch} keys)', pop_many)]:
+        def bench():
+            r.mset({key: serializers.dumps(42) for key in keys})
+            fn()
+        results[name] = measure(bench, max(1, n // batch))
+    return results
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('-n', type=int, default=2000)
+    args = p.parse_args()
+    for name, value in run(args.n).items():
+        report(name, value)
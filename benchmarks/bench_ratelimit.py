@@ -0,0 +1,40 @@
+"""
+Rate limit checks per second: the old ``rate_limiting_lock`` (for
+comparison), each of the limiters in :mod:`dkredis.ratelimit`, and
+``check_many`` for a batch of resources.
+"""
+import argparse
+
+from dkredis import dkredis, ratelimit
+from dkredis.dkredislocks import rate_limiting_lock
+
+from . import measure, report
+
+
+def run(n=2000, batch=100):
+    r = dkredis.connect()
+    results = {}
+    results['rate_limiting_lock'] = measure(
+        lambda: rate_limiting_lock(['bench:rl'], 60, cn=r), n)
+    resources = [f'r{i}' for i in range(batch)]
+    for cls in [ratelimit.FixedWindow, ratelimit.SlidingWindow,
+                ratelimit.GCRA]:
+        limiter = cls('bench', limit=10**6, period=60, cn=r)
+        limiter.reset('r')
+        results[cls.__name__ + '.check'] = measure(
+            lambda: limiter.check('r'), n)
+        # per resource checked
+        results[f'{cls.__name__}.check_many({batch})'] = batch * measure(
+            lambda: limiter.check_many(resources), max(1, n // batch))
+        for resource in ['r'] + resources:
+            limiter.reset(resource)
+    r.delete(b'rl-lock.bench:rl')
+    return results
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('-n', type=int, default=2000)
+    args = p.parse_args()
+    for name, value in run(args.n).items():
+        report(name, value)
@@ -0,0 +1,54 @@
+"""
+Payload size and (de)serialization time of the serializers in
+:mod:`dkredis.serializers`, compared with the old pickle protocol 1
+format. Doesn't need a redis server.
+"""
+import argparse
+import pickle
+import timeit
+
+from dkredis import serializers
+
+
+SAMPLES = {
+    'small dict': {'id': 42, 'name': 'hello world', 'active': True},
+    'list of 1000 ints': list(range(1000)),
+    'nested dict': {
+        f'key{i}': {'title': f'title {i}', 'tags': ['a', 'b', 'c'], 'n': i}
+        for i in range(100)
+    },
+    'report rows (5000)': [
+        {'id': i, 'amount': i * 1.5, 'text': 'x' * 20, 'ok': i % 2 == 0}
+        for i in range(5000)
+    ],
+}
+
+
+def legacy_dumps(val):
+    return pickle.dumps(val, protocol=1)
+
+
+def run(n=200):
+    results = {}
+    for sample, val in SAMPLES.items():
+        formats = [('pickle-1 (legacy)', legacy_dumps)]
+        for name in serializers.available():
+            formats.append((name, lambda v, name=name: serializers.dumps(v, name)))
+        for name, dumps in formats:
+            try:
+                data = dumps(val)
+            except (TypeError, ValueError):
+                continue
+            dump_us = timeit.timeit(lambda: dumps(val), number=n) / n * 1e6
+            load_us = timeit.timeit(lambda: serializers.loads(data), number=n) / n * 1e6
+            results[(sample, name)] = (len(data), dump_us, load_us)
+    return results
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('-n', type=int, default=200)
+    args = p.parse_args()
+    print(f'{"sample":<22} {"format":<18} {"bytes":>9} {"dumps us":>10} {"loads us":>10}')
+    for (sample, name), (size, dump_us, load_us) in run(args.n).items():
+        print(f'{sample:<22} {name:<18} {size:>9,} {dump_us:>10.1f} {load_us:>10.1f}')
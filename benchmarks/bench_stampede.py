@@ -0,0 +1,51 @@
+"""
+Load test: number of calls to an expensive function when N concurrent
+callers find its cached value missing, with the plain get/put pattern
+and with ``cache.get_or_compute``.
+"""
+import argparse
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from dkredis.rediscache import cache
+
+
+def run(callers=32, compute_secs=0.2):
+    results = {}
+    lock = threading.Lock()
+    calls = [0]
+
+    def compute():
+        with lock:
+            calls[0] += 1
+        time.sleep(compute_secs)
+        return 'value'
+
+    def naive(_):
+        try:
+            return cache.get('bench:stampede')
+        except cache.DoesNotExist:
+            val = compute()
+            cache.put('bench:stampede', val, 60)
+            return val
+
+    def protected(_):
+        return cache.get_or_compute('bench:stampede', compute, 60)
+
+    for name, fn in [('get/put', naive), ('get_or_compute', protected)]:
+        cache.remove('bench:stampede')
+        calls[0] = 0
+        with ThreadPool(callers) as pool:
+            pool.map(fn, range(callers))
+        results[f'{name}: fn calls with {callers} callers'] = calls[0]
+    cache.remove('bench:stampede')
+    return results
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('-n', '--callers', type=int, default=32)
+    args = p.parse_args()
+    for name, value in run(args.callers).items():
+        print(f'{name:<48} {value:>6}')
@@ -0,0 +1,48 @@
+"""
+Throughput of ``setmax`` on one hot key with many contending threads,
+using the optimistic WATCH/MULTI transaction of ``update`` and the
+server-side script.
+"""
+import argparse
+import time
+from multiprocessing.pool import ThreadPool
+
+from dkredis import dkredis
+
+KEY = 'bench:update'
+
+
+def run(threads=32, n=200):
+    results = {}
+
+    def watch_setmax(i):
+        dkredis.update(KEY, lambda v: max(int(v or 0), i))
+
+    def script_setmax(i):
+        dkredis.setmax(KEY, i)
+
+    for name, fn in [('update (WATCH)', watch_setmax),
+                     ('setmax (script)', script_setmax)]:
+        dkredis.connect().delete(KEY)
+        retries = dkredis.UPDATE_STATS['retries']
+        start = time.perf_counter()
+        with ThreadPool(threads) as pool:
+            pool.map(fn, range(threads * n))
+        elapsed = time.perf_counter() - start
+        results[f'{name}, {threads} threads'] = threads * n / elapsed
+        results[f'{name}, retries'] = (
+            dkredis.UPDATE_STATS['retries'] - retries)
+    dkredis.connect().delete(KEY)
+    return results
+
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('-t', '--threads', type=int, default=32)
+    p.add_argument('-n', type=int, default=200, help='calls per thread')
+    args = p.parse_args()
+    for name, value in run(args.threads, args.n).items():
+        if name.endswith('retries'):
+            print(f'{name:<48} {value:>14}')
+        else:
+            print(f'{name:<48} {value:>14,.1f} ops/sec')
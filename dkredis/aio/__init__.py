@@ -0,0 +1,19 @@
+"""
+Asyncio versions of the dkredis functions, built on ``redis.asyncio``.
+
+Usage::
+
+    from dkredis import aio
+
+    r = aio.connect()
+    await aio.set_pyval('foo', {'hello': 'world'}, secs=60)
+    await aio.get_pyval('foo')
+
+    async with aio.fetch_lock('weatherapi') as should_fetch:
+        ...
+
+Values and keys are stored exactly as by the synchronous functions, so
+sync and async code can share data.
+"""
+from .dkredis import *  # noqa
+from .dkredislocks import *  # noqa
@@ -0,0 +1,240 @@
+"""
+Asyncio interface to our redis instance (see :mod:`dkredis.dkredis`).
+"""
+import asyncio
+import threading
+import weakref
+
+import redis as _redis
+import redis.asyncio as _aioredis
+
+from .. import instrumentation, serializers
+from ..dkredis import (  # noqa
+    POOL_SETTINGS,
+    UPDATE_STATS,
+    Timeout,
+    _FENCED_SET,
+    _INCR,
+    _POP,
+    _REMOVE_IF,
+    _SETMAXMIN,
+    _as_type_of,
+    _backoff,
+    _connection_params,
+    _create_pool,
+    _decode_hash,
+    _fenced_args,
+    _has_getdel,
+    _incr_args,
+    _minmax_args,
+)
+from ..instrumentation import instrumented
+
+# event loop -> {(host, port, db, password): Redis}
+_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def connect(host=None, port=None, db=0, password=None, pooled=True):
+    """Return an asyncio connection to the redis server.
+
+       Connections are pooled per event loop (asyncio connections can't
+       be shared between loops), using the settings from
+       :func:`dkredis.dkredis.configure_pools`.
+    """
+    key = _connection_params(host, port, db, password)
+    if not pooled:
+        host, port, db, password = key
+        return _aioredis.StrictRedis(host=host, port=port, db=db,
+                                     password=password)
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            pool = _create_pool(*key, redis_module=_aioredis)
+            client = _aioredis.StrictRedis(connection_pool=pool)
+            clients[key] = client
+    return client
+
+
+async def reset_pools():
+    """Forget the connection pools of the running loop, and disconnect
+       their idle connections (see :func:`dkredis.dkredis.reset_pools`).
+    """
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _clients.pop(loop, {})
+    for client in clients.values():
+        await client.connection_pool.disconnect(inuse_connections=False)
+
+
+@instrumented('update')
+async def update(key, fn, cn=None, max_retries=100):
+    """Usage
+       ::
+
+            await update(KEY, lambda val: val + 42)
+
+       (``fn`` is a normal function, not a coroutine). See
+       :func:`dkredis.dkredis.update`.
+    """
+    r = cn or connect()
+    async with r.pipeline() as p:
+        for attempt in range(max_retries + 1):
+            try:
+                await p.watch(key)  # --> immediate mode
+                val = await p.get(key)
+                p.multi()  # --> back to buffered mode
+                newval = fn(val)
+                p.set(key, newval)
+                await p.execute()  # raises WatchError if `key` has changed
+                break  # success, break out of the loop
+            except _redis.WatchError:
+                # someone else got there before us, retry.
+                UPDATE_STATS['retries'] += 1
+                if instrumentation.hooks:
+                    instrumentation.record('update.retry')
+                await asyncio.sleep(_backoff(attempt))
+        else:
+            UPDATE_STATS['timeouts'] += 1
+            raise Timeout(retry=max_retries)
+    if isinstance(newval, bytes):
+        newval = newval.decode('u8')
+    return newval
+
+
+async def setmax(key, val, cn=None, cutoff=None):
+    """Atomically update key with the max of the current value and `val`::
+
+          r[key] := max(r[key], val)
+
+       returns the maximum value (see :func:`dkredis.dkredis.setmax`).
+    """
+    r = cn or connect()
+    res = await _SETMAXMIN.call_async(r, [key],
+                                      _minmax_args('max', val, cutoff))
+    return _as_type_of(res, val)
+
+
+async def setmin(key, val, cn=None, cutoff=None):
+    """Atomically update key with the min of the current value and `val`::
+
+          r[key] := min(r[key], val)
+
+       returns the minimum value (see :func:`dkredis.dkredis.setmin`).
+    """
+    r = cn or connect()
+    res = await _SETMAXMIN.call_async(r, [key],
+                                      _minmax_args('min', val, cutoff))
+    return _as_type_of(res, val)
+
+
+async def incr(key, amount=1, minval=None, maxval=None, cn=None):
+    """Atomically add ``amount`` to the number stored at ``key``, clamped
+       to ``[minval, maxval]`` (see :func:`dkredis.dkredis.incr`).
+    """
+    r = cn or connect()
+    res = await _INCR.call_async(r, [key], _incr_args(amount, minval, maxval))
+    return _as_type_of(res, amount)
+
+
+@instrumented('set_pyval')
+async def set_pyval(key, val, secs=None, cn=None, serializer=None,
+                    compression=None):
+    """Store any (picleable) value in Redis.
+    """
+    r = cn or connect()
+    pval = serializers.dumps(val, serializer, compression)
+    if secs is None:
+        await r.set(key, pval)
+    else:
+        await r.setex(key, secs, pval)
+
+
+async def set_pyval_fenced(key, val, fence, secs=None, cn=None,
+                           serializer=None, compression=None):
+    """Store ``val`` unless a value has been stored with a newer fencing
+       token (see :func:`dkredis.dkredis.set_pyval_fenced`).
+    """
+    r = cn or connect()
+    pval = serializers.dumps(val, serializer, compression)
+    return bool(await _FENCED_SET.call_async(
+        r, *_fenced_args(key, pval, fence, secs)))
+
+
+@instrumented('get_pyval')
+async def get_pyval(key, cn=None, missing_value=None):
+    """Get a Python value from Redis.
+    """
+    r = cn or connect()
+    val = await r.get(key)
+    if val is None:
+        return missing_value  # value if key is missing
+    return serializers.loads(val)
+
+
+async def _pop(r, keys):
+    if len(keys) == 1 and _has_getdel.get(r.connection_pool, True):
+        try:
+            return [await r.getdel(keys[0])]
+        except _redis.ResponseError as e:
+            if 'unknown command' not in str(e).lower():
+                raise
+            _has_getdel[r.connection_pool] = False   # redis < 6.2
+    return await _POP.call_async(r, keys)
+
+
+async def pop_pyval(key, cn=None):
+    """Get value and remove key (atomically, in one round trip).
+    """
+    r = cn or connect()
+    val, = await _pop(r, [key])
+    if val is None:
+        return None
+    return serializers.loads(val)
+
+
+async def pop_pyvals(keys, cn=None):
+    """Get the values of ``keys`` and remove them (atomically, in one
+       round trip). Returns a dict ``{key: value}`` of the keys that
+       existed.
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+    r = cn or connect()
+    return {key: serializers.loads(val)
+            for key, val in zip(keys, await _pop(r, keys))
+            if val is not None}
+
+
+async def remove(key, cn=None):
+    """Remove a key from redis.
+    """
+    r = cn or connect()
+    await r.delete(key)
+
+
+async def remove_if(key, val, cn=None):
+    """Atomically remove key if it has the value `val`.
+    """
+    r = cn or connect()
+    return await _REMOVE_IF.call_async(r, [key], [val])
+
+
+async def set_dict(key, dictval, secs=None, cn=None):
+    """All values in `dictval` should be strings. They'll be read back
+       as strings.
+    """
+    r = cn or connect()
+    await r.hset(key, mapping=dictval)
+    if secs is not None:
+        await r.expire(key, secs)
+
+
+async def get_dict(key, cn=None):
+    """Return a redis hash as a python dict.
+    """
+    r = cn or connect()
+    return _decode_hash(await r.hgetall(key))
@@ -0,0 +1,454 @@
+"""
+Asyncio versions of the locks in :mod:`dkredis.dkredislocks`.
+"""
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import redis as _redis
+
+from .. import dkredislocks as _sync
+from ..dkredislocks import (  # noqa
+    Held,
+    WAKE_TTL_MS,
+    _ACQUIRE,
+    _ACQUIRE_FAIR,
+    _DEQUEUE,
+    _EXTEND,
+    _MULTI_ACQUIRE,
+    _MULTI_RELEASE,
+    _RACQUIRE,
+    _READ_ACQUIRE,
+    _READ_RELEASE,
+    _RELEASE,
+    _REXTEND,
+    _RRELEASE,
+    _WRITE_ACQUIRE,
+    _WRITE_RELEASE,
+    _expiry,
+    _fetch_lock_key,
+    _lock_info,
+    _multi_lock_keys,
+)
+from ..instrumentation import instrumented
+from ..utils import unique_id
+from .dkredis import connect, Timeout, remove_if
+
+log = logging.getLogger(__name__)
+
+
+async def extend(key, token, ttl, cn=None):
+    """Set the time to live of the lock ``key`` to ``ttl`` seconds, if it
+       is still held with ``token``. Returns False if the lock was lost.
+    """
+    r = cn or connect()
+    return bool(await _EXTEND.call_async(r, [key], [token, int(ttl * 1000)]))
+
+
+class Watchdog:
+    """Task that renews the lease of a lock (see
+       :class:`dkredis.dkredislocks.Watchdog`).
+    """
+
+    def __init__(self, r, key, token, ttl, interval=None, script=None):
+        self.r = r
+        self.key = key
+        self.token = token
+        self.ttl = ttl
+        self.script = _EXTEND if script is None else script
+        self.interval = ttl / 3.0 if interval is None else interval
+        self.lost = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while 1:
+            await asyncio.sleep(self.interval)
+            try:
+                if not await self.script.call_async(
+                        self.r, [self.key],
+                        [self.token, int(self.ttl * 1000)]):
+                    self.lost = True
+                    return
+            except _redis.RedisError as e:  # pragma: nocover
+                log.warning("could not extend lock %s: %r", self.key, e)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+@asynccontextmanager
+async def fetch_lock(apiname: str, timeout=5, cn=None, renew=False):
+    """Use this lock to ensure that only one process is fetching
+       expired cached data from an external api (see
+       :func:`dkredis.dkredislocks.fetch_lock`).
+
+       Usage::
+
+            async with fetch_lock('weatherapi') as should_fetch:
+                if should_fetch:
+                    ...
+
+       With ``renew=True`` the lock is renewed by a task while the context
+       is active.
+    """
+    async with fetch_lease(apiname, timeout, cn, renew) as held:
+        yield held.acquired
+
+
+@asynccontextmanager
+async def fetch_lease(apiname: str, timeout=5, cn=None, renew=False,
+                      fencing=False):
+    """:func:`fetch_lock`, that yields a :class:`Held` (see
+       :func:`dkredis.dkredislocks.fetch_lease`).
+    """
+    key = _fetch_lock_key(apiname)
+    uniq = unique_id()
+    r = cn or connect()
+    fence = None
+    if fencing:
+        fence = -await _ACQUIRE.call_async(r, [key, key + ':fence'],
+                                           [uniq, int(timeout * 1000)])
+        acquired = fence > 0
+    else:
+        acquired = await r.set(key, value=uniq, nx=True, **_expiry(timeout))
+    if acquired:
+        watchdog = None
+        if renew:
+            watchdog = Watchdog(r, key, uniq, timeout)
+            watchdog.start()
+        try:
+            yield Held(True, watchdog, fence)  # the client should fetch
+        finally:
+            if watchdog is not None:
+                await watchdog.stop()
+            # only release the lock if it is still ours.
+            await remove_if(key, uniq, cn=r)
+    else:
+        yield Held(False)    # the client should not do the fetch
+
+
+class Lock(_sync.Lock):
+    """Asyncio version of :class:`dkredis.dkredislocks.Lock`.
+
+       Usage::
+
+           async with Lock('invoices', ttl=10, timeout=5):
+               ...
+
+    """
+
+    @property
+    def cn(self):
+        # (looked up every time, the pooled connections belong to the
+        # running event loop)
+        return connect() if self._cn is None else self._cn
+
+    async def _try_acquire(self, token, queue_ms):
+        lock, _, queue, timeouts = self._keys()
+        ttl_ms = int(self.ttl * 1000)
+        if self.fair:
+            return self._fenced(await _ACQUIRE_FAIR.call_async(
+                self.cn, [lock, queue, timeouts] + self._fence_keys(),
+                [token, ttl_ms, queue_ms]))
+        return self._fenced(await _ACQUIRE.call_async(
+            self.cn, [lock] + self._fence_keys(), [token, ttl_ms]))
+
+    async def _release(self, token):
+        lock, wake, queue, _ = self._keys()
+        return bool(await _RELEASE.call_async(
+            self.cn, [lock, wake, queue], [token, int(self.poll * 2000)]))
+
+    async def _wait(self, token, secs):
+        wake = self.key + ':wake'
+        if self.fair:
+            wake += ':' + token
+        await self.cn.blpop([wake], timeout=max(secs, 0.001))
+
+    @instrumented('lock.acquire', info=_lock_info)
+    async def acquire(self, blocking=True, timeout=None):
+        """Acquire the lock, waiting at most ``timeout`` seconds (None:
+           forever). Returns True if the lock was acquired.
+        """
+        token = None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        queue_ms = int(self.poll * 2000) if blocking else 0
+        while 1:
+            if token is None or not self.fair:
+                token = self._new_token()
+            wait_ms = await self._try_acquire(token, queue_ms)
+            if wait_ms == 0:
+                self._acquired(token)
+                if self.renew and self.watchdog is None:
+                    self.watchdog = Watchdog(self.cn, self.key, token,
+                                             self.ttl,
+                                             script=self._extend_script)
+                    self.watchdog.start()
+                return True
+            wait = min(wait_ms / 1000.0, self.poll)
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+            if not blocking or wait <= 0:
+                if self.fair and blocking:
+                    await _DEQUEUE.call_async(self.cn, self._keys()[2:],
+                                              [token])
+                return False
+            await self._wait(token, wait)
+
+    async def extend(self, ttl=None):
+        """Extend the lock by ``ttl`` seconds (default: ``self.ttl``).
+        """
+        if self.token is None:
+            return False
+        ttl = self.ttl if ttl is None else ttl
+        return bool(await self._extend_script.call_async(
+            self.cn, [self.key], [self.token, int(ttl * 1000)]))
+
+    async def release(self):
+        """Release the lock (if it is still ours), and wake up a waiter.
+        """
+        if self.watchdog is not None:
+            await self.watchdog.stop()
+        token, self.token = self.token, None
+        self.fence = None
+        if token is None:
+            return False
+        return self._released(await self._release(token))
+
+    async def locked(self):
+        """Is the lock held (by anyone)?
+        """
+        return bool(await self.cn.exists(self.key))
+
+    def __enter__(self):
+        raise TypeError(f"use 'async with' with {type(self).__name__}")
+
+    def __exit__(self, *args):  # pragma: nocover
+        pass
+
+    async def __aenter__(self):
+        if not await self.acquire(timeout=self.timeout):
+            raise Timeout()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.release()
+
+
+class RLock(Lock):
+    """Asyncio version of :class:`dkredis.dkredislocks.RLock`, the owner
+       is the current task.
+    """
+    prefix = _sync.RLock.prefix
+    _extend_script = _REXTEND
+
+    def __init__(self, name, ttl=30, timeout=None, poll=1.0, renew=False,
+                 fencing=False, cn=None):
+        super().__init__(name, ttl=ttl, timeout=timeout, poll=poll,
+                         renew=renew, fencing=fencing, cn=cn)
+        self.holds = 0
+
+    def _acquired(self, token):
+        self.holds += 1
+        if self.holds == 1:
+            super()._acquired(token)
+
+    async def release(self):
+        """Release one acquisition of the lock.
+        """
+        if self.holds > 1:
+            self.holds -= 1
+            return await self._release(self.token)
+        self.holds = 0
+        return await super().release()
+
+    def _new_token(self):
+        return f'{_sync._process_id}:{id(asyncio.current_task())}'
+
+    async def _try_acquire(self, token, queue_ms):
+        return self._fenced(await _RACQUIRE.call_async(
+            self.cn, [self.key] + self._fence_keys(),
+            [token, int(self.ttl * 1000)]))
+
+    async def _release(self, token):
+        return await _RRELEASE.call_async(
+            self.cn, [self.key, self.key + ':wake'],
+            [token, int(self.poll * 2000)]) >= 0
+
+
+class RWLock(_sync.RWLock):
+    """Asyncio version of :class:`dkredis.dkredislocks.RWLock`.
+
+       Usage::
+
+           lock = RWLock('pricelist')
+           async with lock.read():
+               ...
+
+    """
+
+    @property
+    def cn(self):
+        # (looked up every time, the pooled connections belong to the
+        # running event loop)
+        return connect() if self._cn is None else self._cn
+
+    async def _acquire(self, token, try_acquire, wake, blocking, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+        while 1:
+            wait_ms = await try_acquire(token, waited)
+            if wait_ms == 0:
+                return token
+            wait = min(wait_ms / 1000.0, self.poll)
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+            if not blocking or wait <= 0:
+                return None
+            await self.cn.blpop([wake], timeout=max(wait, 0.001))
+            waited = True
+
+    @instrumented('rwlock.read', info=_lock_info)
+    async def acquire_read(self, blocking=True, timeout=None):
+        """Acquire a read lock, returns a token or None.
+        """
+        k = self._keys()
+
+        def try_acquire(token, waited):
+            return _READ_ACQUIRE.call_async(
+                self.cn, [k['readers'], k['writer'], k['intent'], k['rwake']],
+                [token, int(self.ttl * 1000), '1' if waited else '0'])
+
+        return await self._acquire(unique_id(), try_acquire, k['rwake'],
+                                   blocking, timeout)
+
+    async def release_read(self, token):
+        k = self._keys()
+        return bool(await _READ_RELEASE.call_async(
+            self.cn, [k['readers'], k['wwake']],
+            [token, int(self.poll * 2000)]))
+
+    @instrumented('rwlock.write', info=_lock_info)
+    async def acquire_write(self, blocking=True, timeout=None):
+        """Acquire the write lock, returns a token or None.
+        """
+        k = self._keys()
+        intent_ms = int(self.poll * 2000) if blocking else 1
+
+        def try_acquire(token, waited):
+            return _WRITE_ACQUIRE.call_async(
+                self.cn, [k['readers'], k['writer'], k['intent']],
+                [token, int(self.ttl * 1000), intent_ms])
+
+        token = unique_id()
+        if await self._acquire(token, try_acquire, k['wwake'], blocking,
+                               timeout):
+            return token
+        if blocking:
+            await self.release_write(token)
+        return None
+
+    async def release_write(self, token):
+        k = self._keys()
+        return bool(await _WRITE_RELEASE.call_async(
+            self.cn, [k['writer'], k['intent'], k['rwake'], k['wwake']],
+            [token, int(self.poll * 2000)]))
+
+    @asynccontextmanager
+    async def read(self):
+        token = await self.acquire_read(timeout=self.timeout)
+        if token is None:
+            raise Timeout()
+        try:
+            yield
+        finally:
+            await self.release_read(token)
+
+    @asynccontextmanager
+    async def write(self):
+        token = await self.acquire_write(timeout=self.timeout)
+        if token is None:
+            raise Timeout()
+        try:
+            yield
+        finally:
+            await self.release_write(token)
+
+
+async def multi_lock(resources, ttl=30, cn=None):
+    """Lock all ``resources`` for ``ttl`` seconds, all or nothing (see
+       :func:`dkredis.dkredislocks.multi_lock`). Returns a dict
+       ``{resource: token}``, or None.
+    """
+    resources = list(dict.fromkeys(resources))     # unique, in order
+    if not resources:
+        return {}
+    uniq = unique_id()
+    tokens = {resource: f'{uniq}:{i}' for i, resource in enumerate(resources)}
+    r = cn or connect()
+    if await _MULTI_ACQUIRE.call_async(r, _multi_lock_keys(resources),
+                                       [int(ttl * 1000)] +
+                                       list(tokens.values())):
+        return None
+    return tokens
+
+
+async def multi_unlock(tokens, cn=None):
+    """Release the locks acquired by :func:`multi_lock`.
+    """
+    if not tokens:
+        return 0
+    r = cn or connect()
+    return await _MULTI_RELEASE.call_async(
+        r, _multi_lock_keys(tokens), list(tokens.values()) + [WAKE_TTL_MS])
+
+
+class _Mutex(Lock):
+    "The :class:`Lock` used by :func:`mutex` (see ``dkredislocks._Mutex``)."
+    prefix = _sync._Mutex.prefix
+    _new_token = _sync._Mutex._new_token
+
+
+@asynccontextmanager
+async def mutex(name, seconds: int = 30, timeout: int = 60,
+                unlock: bool = True, waitsecs: int = 3, renew: bool = False,
+                reentrant: bool = False, fencing: bool = False):
+    """Lock the ``name`` for ``seconds`` (see
+       :func:`dkredis.dkredislocks.mutex`).
+
+       It will raise a Timeout exception if the lock couldn't be acquired
+       in ``timeout`` seconds. With ``fencing=True`` the context value is
+       a fencing token.
+
+       Usage::
+
+           async with mutex('mymutex'):
+               # mutual exclusion zone ;-)
+
+    """
+    if timeout == 0:
+        timeout = 60 * 60  # 1 hour
+    if reentrant:
+        lock = RLock(name, ttl=seconds, poll=waitsecs, renew=renew,
+                     fencing=fencing)
+    else:
+        lock = _Mutex(name, ttl=seconds, poll=waitsecs, renew=renew,
+                      fencing=fencing)
+    if not await lock.acquire(timeout=timeout):
+        raise Timeout()
+    try:
+        yield lock.fence
+    finally:
+        if unlock:
+            await lock.release()
+        elif lock.watchdog is not None:
+            await lock.watchdog.stop()
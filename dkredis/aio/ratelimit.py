@@ -0,0 +1,58 @@
+"""
+Asyncio versions of the rate limiters in :mod:`dkredis.ratelimit`.
+
+Usage::
+
+    from dkredis.aio import ratelimit
+
+    limiter = ratelimit.GCRA('email', limit=100, period=60, burst=10)
+    res = await limiter.check('example.com')
+
+"""
+from .. import ratelimit as _sync
+from .. import scripts
+from ..instrumentation import instrumented
+from ..ratelimit import RateLimit, _allowed, _result  # noqa
+from .dkredis import connect
+
+
+class _Async:
+    """The methods of :class:`dkredis.ratelimit.RateLimiter` that talk to
+       redis, as coroutines.
+    """
+
+    @property
+    def cn(self):
+        # connections are pooled per event loop, so don't keep one
+        return connect() if self._cn is None else self._cn
+
+    @instrumented('ratelimit.check', info=_allowed)
+    async def check(self, resource, cost=1):
+        return _result(await self.script.call_async(
+            self.cn, [self.key(resource)], self._args(cost)))
+
+    @instrumented('ratelimit.check_many')
+    async def check_many(self, resources, cost=1):
+        resources = list(resources)
+        args = self._args(cost)
+        async with self.cn.pipeline(transaction=False) as p:
+            for resource in resources:
+                await self.script.call_async(p, [self.key(resource)], args)
+            results = await scripts.execute_async(p)
+        return {resource: _result(res)
+                for resource, res in zip(resources, results)}
+
+    async def reset(self, resource):
+        await self.cn.delete(self.key(resource))
+
+
+class FixedWindow(_Async, _sync.FixedWindow):
+    pass
+
+
+class SlidingWindow(_Async, _sync.SlidingWindow):
+    pass
+
+
+class GCRA(_Async, _sync.GCRA):
+    pass
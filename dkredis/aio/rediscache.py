@@ -0,0 +1,408 @@
+"""
+Asyncio version of :mod:`dkredis.rediscache`.
+
+Keys and values are stored exactly as by the synchronous cache, and the
+configuration (serializer, compression, L1 cache) of
+:class:`dkredis.rediscache.cache` is inherited.
+
+Usage::
+
+    from dkredis.aio.rediscache import cache, cached
+
+    try:
+        v = await cache.get(key)
+    except cache.DoesNotExist:
+        v = await mk_object_value(...)
+        await cache.put(key, v, duration=secs)
+
+"""
+import asyncio
+import functools
+import inspect
+import logging
+import time
+
+from .. import l1cache
+from .. import serializers
+from .. import rediscache as _sync
+from .. import scripts
+from ..rediscache import (  # noqa
+    CacheEntry,
+    _cache_unserialize,
+    _cached_key,
+    _cached_tags,
+    _computed_meta,
+    _duration_seconds,
+    _is_fresh,
+    _hits_misses,
+    _missing,
+    _poll_delays,
+    _should_recompute,
+    _tagged_entry,
+)
+from ..instrumentation import instrumented
+from ..utils import unique_id
+from . import dkredis
+
+log = logging.getLogger(__name__)
+
+# keep references to running background refresh tasks
+_background_tasks = set()
+
+
+class cache(_sync.cache):
+    """Python value cache (all methods that talk to redis are coroutines).
+    """
+
+    @classmethod
+    async def _write(cls, p, rkeys):
+        l1 = cls.l1
+        if cls.publish_invalidations:
+            sender = '-' if l1 is None else l1.sender
+            l1cache.publish(p, rkeys, sender=sender)
+        res = await scripts.execute_async(p)
+        if l1 is not None:
+            l1.invalidate(rkeys)
+        return res
+
+    @classmethod
+    async def ping(cls):
+        await dkredis.connect().ping()
+
+    @classmethod
+    async def remove(cls, key):
+        """Remove key from cache.
+        """
+        await cls.remove_many([key])
+
+    @classmethod
+    async def remove_many(cls, keys):
+        """Remove all ``keys`` from the cache (in one round trip).
+        """
+        await cls.invalidate(keys)
+
+    @classmethod
+    @instrumented('cache.invalidate')
+    async def invalidate(cls, keys=(), tags=()):
+        """Remove all ``keys`` from the cache and invalidate all ``tags``
+           (in one round trip).
+        """
+        keys = list(keys)
+        tags = list(tags)
+        if not (keys or tags):
+            return
+        rkeys = [cls.rediskey(key) for key in keys]
+        async with dkredis.connect().pipeline(transaction=False) as p:
+            if cls.legacy_keys and keys:
+                p.unlink(*rkeys, *[cls.legacy_rediskey(k) for k in keys])
+            elif keys:
+                p.unlink(*rkeys)
+            for tag in tags:
+                p.incr(cls.tagkey(tag))
+            await cls._write(p, rkeys)
+
+    @classmethod
+    async def invalidate_tags(cls, tags):
+        """Invalidate all values tagged with any of ``tags``.
+        """
+        await cls.invalidate(tags=tags)
+
+    @classmethod
+    async def _tag_generations(cls, tags):
+        gens = await dkredis.connect().mget([cls.tagkey(tag) for tag in tags])
+        return {tag: int(gen or 0) for tag, gen in zip(tags, gens)}
+
+    @classmethod
+    @instrumented('cache.put')
+    async def put(cls, key, value, duration=None, serializer=None,
+                  compression=None, stale=None, tags=None):
+        """Put ``value`` in cache, under ``key``, for ``duration`` seconds
+           (and ``stale`` seconds more as a stale value), tagged with
+           ``tags``.
+        """
+        meta = None
+        if stale:
+            duration = _duration_seconds(duration)
+            meta = {'x': time.time() + duration}
+            duration += _duration_seconds(stale)
+        if tags:
+            meta = dict(meta or {}, t=await cls._tag_generations(tags))
+        await cls.put_many({key: value}, duration, serializer, compression,
+                           meta)
+
+    @classmethod
+    async def put_fenced(cls, key, value, fence, duration=None,
+                         serializer=None, compression=None):
+        """Put ``value`` in cache, unless the cached value was written
+           with a newer fencing token (see
+           :meth:`dkredis.rediscache.cache.put_fenced`).
+        """
+        k = cls.rediskey(key)
+        v = cls._serialize(value, serializer, compression)
+        async with dkredis.connect().pipeline(transaction=False) as p:
+            await dkredis._FENCED_SET.call_async(
+                p, *dkredis._fenced_args(k, v, fence,
+                                         _duration_seconds(duration),
+                                         cls.fencekey(key)))
+            if cls.legacy_keys:
+                p.unlink(cls.legacy_rediskey(key))
+            return bool((await cls._write(p, [k]))[0])
+
+    @classmethod
+    @instrumented('cache.put_many')
+    async def put_many(cls, mapping, duration=None, serializer=None,
+                       compression=None, meta=None):
+        """Put all ``key: value`` pairs from ``mapping`` in the cache, for
+           ``duration`` seconds (in one round trip).
+        """
+        _duration = _duration_seconds(duration)
+        async with dkredis.connect().pipeline(transaction=False) as p:
+            rkeys = []
+            for key, value in mapping.items():
+                rkey = cls.rediskey(key)
+                rkeys.append(rkey)
+                p.set(rkey, cls._serialize(value, serializer, compression,
+                                           meta),
+                      ex=_duration)
+            if cls.legacy_keys and mapping:
+                p.unlink(*[cls.legacy_rediskey(key) for key in mapping])
+            await cls._write(p, rkeys)
+
+    @classmethod
+    async def _raw_get(cls, key):
+        r = dkredis.connect()
+        if not cls.legacy_keys:
+            return await r.get(cls.rediskey(key))
+        val, legacy_val = await r.mget(cls._rediskeys(key))
+        return legacy_val if val is None else val
+
+    @classmethod
+    async def _raw_get_with_pttl(cls, key):
+        async with dkredis.connect().pipeline(transaction=False) as p:
+            for rkey in cls._rediskeys(key):
+                p.get(rkey)
+                p.pttl(rkey)
+            res = await p.execute()
+        for i in range(0, len(res), 2):
+            if res[i] is not None:
+                return res[i:i + 2]
+        return None, -2
+
+    @classmethod
+    async def _raw_get_tagged(cls, key, tags):
+        rkeys = cls._rediskeys(key)
+        res = await dkredis.connect().mget(
+            rkeys + [cls.tagkey(t) for t in tags])
+        n = len(rkeys)
+        val = next((v for v in res[:n] if v is not None), None)
+        return val, {tag: int(gen or 0) for tag, gen in zip(tags, res[n:])}
+
+    @classmethod
+    async def _tagged_lookup(cls, key, tags):
+        res = _tagged_entry(*await cls._raw_get_tagged(key, tags))
+        if res is None:
+            raise cls.DoesNotExist(
+                "Value not in cache (possibly due to expiration).")
+        return res
+
+    @classmethod
+    @instrumented('cache.get', miss=_sync.cache.DoesNotExist)
+    async def get(cls, key, tags=None):
+        "Fetch value for ``key`` from the L1 cache (if enabled) or redis."
+        if tags:
+            return (await cls._tagged_lookup(key, tags))[0]
+        if cls.l1 is not None:
+            return (await cls._l1_get(cls.l1, key))[0]
+        val = await cls._raw_get(key)
+        if val is None:
+            raise cls.DoesNotExist(
+                "Value not in cache (possibly due to expiration).")
+        return _cache_unserialize(val)
+
+    @classmethod
+    async def _l1_get(cls, l1, key):
+        rkey = cls.rediskey(key)
+        entry = l1.get(rkey, _missing)
+        if entry is not _missing:
+            return entry
+        epoch = l1.epoch
+        val, pttl = await cls._raw_get_with_pttl(key)
+        if val is None:
+            raise cls.DoesNotExist(
+                "Value not in cache (possibly due to expiration).")
+        return cls._l1_put(l1, rkey, val, pttl, epoch)
+
+    @classmethod
+    async def get_with_ttl(cls, key):
+        """Fetch value for ``key`` and its remaining time to live (in
+           seconds) in a single round trip.
+        """
+        val, pttl = await cls._raw_get_with_pttl(key)
+        if val is None:
+            raise cls.DoesNotExist(
+                "Value not in cache (possibly due to expiration).")
+        return _cache_unserialize(val), pttl / 1000.0
+
+    @classmethod
+    async def get_value(cls, key, default=None, tags=None):
+        try:
+            return await cls.get(key, tags)
+        except cls.DoesNotExist:
+            return default
+
+    @classmethod
+    @instrumented('cache.get_many', info=_hits_misses)
+    async def get_many(cls, keys):
+        """Fetch the values for all ``keys`` with a single MGET.
+
+           Returns a tuple ``(hits, misses)``.
+        """
+        keys = list(keys)
+        hits = {}
+        misses = set()
+        l1 = cls.l1
+        if l1 is not None:
+            for key in keys:
+                entry = l1.get(cls.rediskey(key), _missing)
+                if entry is not _missing:
+                    hits[key] = entry[0]
+            keys = [key for key in keys if key not in hits]
+        if not keys:
+            return hits, misses
+        rkeys = [cls.rediskey(key) for key in keys]
+        if cls.legacy_keys:
+            rkeys += [cls.legacy_rediskey(key) for key in keys]
+        vals = await dkredis.connect().mget(rkeys)
+        if cls.legacy_keys:
+            n = len(keys)
+            vals = [legacy if val is None else val
+                    for val, legacy in zip(vals[:n], vals[n:])]
+        for key, val in zip(keys, vals):
+            if val is None:
+                misses.add(key)
+            else:
+                hits[key] = _cache_unserialize(val)
+        return hits, misses
+
+    @classmethod
+    async def _lookup(cls, key, tags=None):
+        if tags:
+            return await cls._tagged_lookup(key, tags)
+        if cls.l1 is not None:
+            return await cls._l1_get(cls.l1, key)
+        val = await cls._raw_get(key)
+        if val is None:
+            raise cls.DoesNotExist(
+                "Value not in cache (possibly due to expiration).")
+        return serializers.loads_meta(val)
+
+    @classmethod
+    async def get_entry(cls, key, tags=None):
+        """Fetch a :class:`CacheEntry` with the value for ``key`` and
+           whether it is fresh.
+        """
+        value, meta = await cls._lookup(key, tags)
+        return CacheEntry(value, _is_fresh(meta))
+
+    @classmethod
+    @instrumented('cache.compute')
+    async def _compute(cls, key, fn, duration, stale=None, tags=None):
+        gens = await cls._tag_generations(tags) if tags else None
+        start = time.perf_counter()
+        value = fn()
+        if inspect.isawaitable(value):
+            value = await value
+        _duration, meta = _computed_meta(
+            duration, stale, time.perf_counter() - start, gens)
+        await cls.put_many({key: value}, _duration, meta=meta)
+        return value
+
+    @classmethod
+    async def _poll(cls, key, tags=None):
+        if tags:
+            return _tagged_entry(*await cls._raw_get_tagged(key, tags))
+        val = await dkredis.connect().get(cls.rediskey(key))
+        return None if val is None else serializers.loads_meta(val)
+
+    @classmethod
+    async def _refresh(cls, key, fn, duration, stale, lockkey, token,
+                       tags=None):
+        try:
+            await cls._compute(key, fn, duration, stale, tags)
+        except Exception:
+            log.exception("CACHE:REFRESH(%r) failed", key)
+        finally:
+            await dkredis.remove_if(lockkey, token)
+
+    @classmethod
+    @instrumented('cache.get_or_compute')
+    async def get_or_compute(cls, key, fn, duration=None, lock_timeout=30,
+                             wait=None, beta=1.0, stale=None,
+                             background=False, tags=None):
+        """Return the cached value for ``key``, or compute it with ``fn()``
+           (a function or coroutine function) and cache it, with stampede
+           protection and stale-while-revalidate (see
+           :meth:`dkredis.rediscache.cache.get_or_compute`). With
+           ``background=True`` stale values are refreshed in a separate
+           task.
+        """
+        try:
+            value, meta = await cls._lookup(key, tags)
+        except cls.DoesNotExist:
+            value = _missing
+        else:
+            if not _should_recompute(meta, beta):
+                return value
+
+        lockkey = 'dkredis:fetchlock:' + cls.rediskey(key)
+        r = dkredis.connect()
+        for delay in _poll_delays(lock_timeout if wait is None else wait):
+            if delay:
+                await asyncio.sleep(delay)
+                res = await cls._poll(key, tags)
+                if res is not None:
+                    return res[0]
+            token = unique_id()
+            if await r.set(lockkey, token, px=int(lock_timeout * 1000),
+                           nx=True):
+                if background and value is not _missing:
+                    task = asyncio.ensure_future(cls._refresh(
+                        key, fn, duration, stale, lockkey, token, tags))
+                    _background_tasks.add(task)
+                    task.add_done_callback(_background_tasks.discard)
+                    return value
+                try:
+                    return await cls._compute(key, fn, duration, stale,
+                                              tags)
+                finally:
+                    await dkredis.remove_if(lockkey, token, cn=r)
+            if value is not _missing:
+                return value    # someone else is re-computing it
+
+        log.warning("CACHE:GET_OR_COMPUTE(%r): gave up waiting", key)
+        return await cls._compute(key, fn, duration, stale, tags)
+
+
+def cached(cache_key=None, timeout=3600, lock_timeout=30, beta=1.0,
+           stale=None, background=False, tags=None):
+    """Function result cache decorator for coroutine functions (see
+       :func:`dkredis.rediscache.cached`). The decorated function is
+       always a coroutine function.
+
+       Usage::
+
+           @cached(lambda u: 'user_privileges_%s' % u.username, 3600)
+           async def get_user_privileges(user):
+               #...
+    """
+    def _cached(func):
+        @functools.wraps(func)
+        async def do_cache(*args, **kws):
+            key = _cached_key(cache_key, func, timeout, args, kws)
+            return await cache.get_or_compute(
+                key, lambda: func(*args, **kws), timeout,
+                lock_timeout=lock_timeout, beta=beta,
+                stale=stale, background=background,
+                tags=_cached_tags(tags, args, kws))
+        return do_cache
+    return _cached
@@ -18,13 +18,33 @@ The windows version of the redis server that we use is
 from https://github.com/rgl/redis/downloads
 ----
 """
+import contextlib
 import os
-import pickle
+import random
+import threading
+import time
+import weakref
 
 import redis as _redis
 
+from . import instrumentation, scripts, serializers
+from .instrumentation import instrumented
+
 PICLE_PROTOCOL = 1
 
+#: Settings used when :func:`connect` creates a new connection pool
+#: (change them with :func:`configure_pools`).
+POOL_SETTINGS = {
+    'max_connections': None,        # None: unbounded (50 for blocking pools)
+    'blocking': False,              # wait for a free connection when full
+    'blocking_timeout': 20,         # seconds to wait in blocking mode
+    'health_check_interval': 0,     # seconds (0: no health checks)
+}
+
+# (host, port, db, password) -> StrictRedis sharing one ConnectionPool
+_clients = {}
+_clients_lock = threading.Lock()
+
 
 class Timeout(Exception):  # pragma: nocover
     """A timout limit was exceeded.
@@ -130,67 +150,424 @@ class Timeout(Exception):  # pragma: nocover
 #         return newval
 
 
-def connect(host=None, port=6379, db=0, password=None):
-    """Return a connection to the redis server.
+def _connection_params(host, port, db, password):
+    """Fill in connection defaults from the environment.
     """
     if host is None:
         host = os.environ.get('REDIS_HOST', 'localhost')
+    if port is None:
+        port = int(os.environ.get('REDIS_PORT', 6379))
     if password is None:
         password = os.environ.get('REDIS_PASSWORD')
-    return _redis.StrictRedis(host=host, port=port, db=db, password=password)
+    return host, port, db, password
 
 
-# def update_binop(binaryfn):
-#     """Utility function for creating binary update functions.
-#     """
-#     def curry(key, val, cn=None):
-#         return update(key, (lambda v: binaryfn(v, val)), cn=cn)
-#     return curry
-#
-#
-# #  Usage:  setmax(KEY, val)
-# #          setmin(KEY, val)
-# setmax = update_binop(max)
-# setmin = update_binop(min)
-#
-#
-# def setmin_cutoff(cutoff):
-#     """setmin_cutoff(KEY, val, cutoff)
-#        ==> min(r[KEY], val) if less than cutoff
-#     """
-#     def fn(a, b):
-#         return max(cutoff, min(a, b))
-#     return update_binop(fn)
-#
-# setmin_cut = lambda cut: lambda a, b: update_binop(
-#                                           lambda a,b: max(cut, min(a, b)))
-# setmax_cut = lambda cut: lambda a, b: update_binop(
-#                                           lambda a,b: min(cut, max(a, b)))
-#
-# setmin0 = setmin_cut(0)
-# setmax0 = setmax_cut(0)
-#
-# def setmax_cutoff(key,
-#     """setmin_cutoff(KEY, val, cutoff)
-#        ==> max(r[KEY], val) if greater than cutoff
-#     """
-#     return update_binop(lambda a,b: min(cutoff, max(a, b)))
-#
-#
-# #: set to minimum of
-# setmin0 = lambda a,b: setmin_cutoff(a, b
+def _create_pool(host, port, db, password, redis_module=_redis):
+    """Create a connection pool according to ``POOL_SETTINGS``
+       (``redis_module`` is ``redis`` or ``redis.asyncio``).
+    """
+    settings = POOL_SETTINGS
+    kw = dict(
+        host=host, port=port, db=db, password=password,
+        health_check_interval=settings['health_check_interval'],
+    )
+    if settings['blocking']:
+        return redis_module.BlockingConnectionPool(
+            max_connections=settings['max_connections'] or 50,
+            timeout=settings['blocking_timeout'],
+            **kw
+        )
+    return redis_module.ConnectionPool(
+        max_connections=settings['max_connections'],
+        **kw
+    )
+
+
+def configure_pools(max_connections=None, blocking=False,
+                    blocking_timeout=20, health_check_interval=0):
+    """Configure the connection pools used by :func:`connect`.
+
+       Existing pools are closed (:func:`reset_pools`), so this should be
+       called at startup.
+    """
+    POOL_SETTINGS.update(
+        max_connections=max_connections,
+        blocking=blocking,
+        blocking_timeout=blocking_timeout,
+        health_check_interval=health_check_interval,
+    )
+    reset_pools()
+
+
+def reset_pools():
+    """Forget all connection pools, and disconnect their idle connections
+       (connections in use by other threads are closed when their pool
+       is garbage collected).
+
+       Call this in post-fork workers (e.g. uwsgi's ``postfork`` hook) if
+       the parent process has used :func:`connect`. redis-py will also
+       detect the fork on first use, but only for pools it can see.
+    """
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        pool = client.connection_pool
+        # (a BlockingConnectionPool can only disconnect all connections)
+        if not isinstance(pool, _redis.BlockingConnectionPool):
+            pool.disconnect(inuse_connections=False)
+
+
+def _after_fork_in_child():
+    # the lock may have been held by another thread at fork time, and
+    # the child must not share sockets with the parent.
+    global _clients_lock
+    _clients_lock = threading.Lock()
+    _clients.clear()
+
+
+if hasattr(os, 'register_at_fork'):  # pragma: nocover
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def connect(host=None, port=None, db=0, password=None, pooled=True):
+    """Return a connection to the redis server (default:
+       ``REDIS_HOST``:``REDIS_PORT`` from the environment, or
+       localhost:6379).
+
+       All connections to the same ``(host, port, db, password)`` share a
+       process-wide, thread-safe connection pool (see
+       :func:`configure_pools`). Use ``pooled=False`` to get a client with
+       its own private pool.
+    """
+    key = _connection_params(host, port, db, password)
+    if not pooled:
+        host, port, db, password = key
+        return _redis.StrictRedis(host=host, port=port, db=db,
+                                  password=password)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                pool = _create_pool(*key)
+                client = _redis.StrictRedis(connection_pool=pool)
+                _clients[key] = client
+    return client
+
+
+class BatchDiscarded(Exception):
+    """The batch of a call was discarded before it was executed.
+    """
 
 
-def update(key, fn, cn=None):
+class Future:
+    """The result of a call made in a :func:`batch` block, available when
+       the batch has been executed.
+    """
+    __slots__ = ('_batch', '_done', '_value', '_error')
+
+    def __init__(self, batch=None):
+        self._batch = batch
+        self._done = False
+        self._value = None
+        self._error = None
+
+    def __repr__(self):
+        if not self._done:
+            return '<Future pending>'
+        if self._error is not None:
+            return f'<Future raised {self._error!r}>'
+        return f'<Future {self._value!r}>'
+
+    def _set(self, value=None, error=None):
+        self._batch = None
+        self._done = True
+        self._value = value
+        self._error = error
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """The value returned by the call, or raise the exception it
+           raised (executes the batch if that hasn't happened yet).
+        """
+        if not self._done:
+            self._batch.execute()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def exception(self):
+        """The exception raised by the call (or None).
+        """
+        if not self._done:
+            self._batch.execute()
+        return self._error
+
+
+class Batch:
+    """The commands queued by the calls in a :func:`batch` block, sent to
+       the server in one pipeline.
+    """
+
+    def __init__(self, cn=None, size=1000):
+        self.cn = cn or connect()
+        self.size = size
+        self.pipeline = self.cn.pipeline(transaction=False)
+        # [(future, number of commands, convert)]
+        self._calls = []
+
+    def __len__(self):
+        return len(self._calls)
+
+    def add(self, fn, convert=None):
+        """Queue a call: ``fn(pipeline)`` queues its commands, and
+           ``convert(results)`` turns the list of their results into the
+           value of the returned :class:`Future`.
+        """
+        before = len(self.pipeline.command_stack)
+        fn(self.pipeline)
+        future = Future(self)
+        n = len(self.pipeline.command_stack) - before
+        self._calls.append((future, n, convert))
+        if self.size and len(self.pipeline.command_stack) >= self.size:
+            self.execute()
+        return future
+
+    def done(self, value):
+        """A :class:`Future` for a call that didn't need the pipeline.
+        """
+        future = Future()
+        future._set(value)
+        return future
+
+    def discard(self):
+        """Drop the queued commands.
+        """
+        calls, self._calls = self._calls, []
+        self.pipeline.reset()
+        for future, _, _ in calls:
+            future._set(error=BatchDiscarded())
+
+    @instrumented('batch.execute')
+    def execute(self):
+        """Send the queued commands, and resolve their futures (a command
+           that fails only fails its own call).
+        """
+        calls, self._calls = self._calls, []
+        if not calls:
+            return
+        try:
+            results = scripts.execute(self.pipeline, raise_on_error=False)
+        except Exception as e:      # e.g. connection errors fail all calls
+            for future, _, _ in calls:
+                future._set(error=e)
+            raise
+        i = 0
+        for future, n, convert in calls:
+            res = results[i:i + n]
+            i += n
+            error = next((r for r in res if isinstance(r, Exception)), None)
+            if error is not None:
+                future._set(error=error)
+                continue
+            try:
+                future._set(convert(res) if convert is not None else None)
+            except Exception as e:
+                future._set(error=e)
+
+
+class _BatchState(threading.local):
+    batch = None
+
+
+_batch_state = _BatchState()
+
+
+def _batching(cn=None):
+    """The current :class:`Batch` of this thread, if calls that get
+       connection ``cn`` should be batched.
+    """
+    if cn is None:
+        return _batch_state.batch
+    return None
+
+
+@contextlib.contextmanager
+def batch(cn=None, size=1000):
+    """Send the commands of the calls in the block (in this thread) in a
+       single pipeline, when the block exits, or whenever ``size``
+       commands have been queued::
+
+           with dkredis.batch():
+               values = [get_pyval(key) for key in keys]
+               set_pyval('total', 42)
+           print([v.result() for v in values])
+
+       The batched calls (:func:`get_pyval`, :func:`set_pyval`,
+       :func:`remove`, :func:`set_dict`, :func:`get_dict`, :func:`incr`,
+       :func:`setmax`/:func:`setmin`, and ``put``, ``get``,
+       ``get_value``, ``remove`` and ``invalidate`` of
+       :class:`dkredis.rediscache.cache`) return a
+       :class:`Future` instead of their result, and calling
+       :meth:`Future.result` raises the exception of that call, if any.
+       Calls with an explicit ``cn`` are not batched.
+
+       All other calls (e.g. :func:`update`, :func:`pop_pyval`,
+       :func:`set_pyval_fenced`, ``cache.put_many``, ``cache.get_many``
+       and ``cache.get_or_compute``) still run right away, before the
+       queued commands. Nested blocks join the outer batch.
+
+       If the block raises an exception, the queued commands are
+       discarded (and their futures raise :class:`BatchDiscarded`).
+    """
+    if _batch_state.batch is not None:
+        yield _batch_state.batch
+        return
+    b = _batch_state.batch = Batch(cn, size)
+    try:
+        yield b
+    except BaseException:
+        _batch_state.batch = None
+        b.discard()
+        raise
+    _batch_state.batch = None
+    b.execute()
+
+
+#: Counters for the optimistic (WATCH) path of :func:`update`.
+UPDATE_STATS = {
+    'retries': 0,       # transactions retried because the key changed
+    'timeouts': 0,      # updates that gave up after ``max_retries``
+}
+
+#: Upper limit (seconds) of the random backoff between retries in
+#: :func:`update`.
+UPDATE_MAX_BACKOFF = 0.05
+
+# KEYS[1]: key, ARGV[1]: value, ARGV[2]: 'max' or 'min', ARGV[3]: optional
+# cutoff. Values are compared as numbers if both are numeric, and as
+# strings otherwise.
+_SETMAXMIN = scripts.register('setmaxmin', """
+    local function gt(a, b)
+        local x, y = tonumber(a), tonumber(b)
+        if x and y then
+            return x > y
+        end
+        return a > b
+    end
+    local cur = redis.call('GET', KEYS[1])
+    local res = ARGV[1]
+    local ismax = ARGV[2] == 'max'
+    if cur and gt(cur, res) == ismax and cur ~= res then
+        res = cur
+    end
+    local cutoff = ARGV[3]
+    if cutoff and gt(res, cutoff) == ismax and res ~= cutoff then
+        res = cutoff
+    end
+    if res ~= cur then
+        redis.call('SET', KEYS[1], res)
+    end
+    return res
+""")
+
+# KEYS[1]: key, ARGV[1]: amount, ARGV[2]/ARGV[3]: min/max value ('': none)
+_INCR = scripts.register('incr', """
+    local cur = redis.call('GET', KEYS[1])
+    local res = 0
+    if cur then
+        res = tonumber(cur)
+        if not res then
+            return redis.error_reply('ERR value is not a number')
+        end
+    end
+    res = res + tonumber(ARGV[1])
+    if ARGV[2] ~= '' then
+        res = math.max(res, tonumber(ARGV[2]))
+    end
+    if ARGV[3] ~= '' then
+        res = math.min(res, tonumber(ARGV[3]))
+    end
+    res = string.format('%.17g', res)
+    redis.call('SET', KEYS[1], res)
+    return res
+""")
+
+_REMOVE_IF = scripts.register('remove_if', """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    else
+        return 0
+    end
+""")
+
+# GET and DEL of KEYS, for servers without GETDEL
+_POP = scripts.register('pop', """
+    local res = {}
+    for i, key in ipairs(KEYS) do
+        res[i] = redis.call('GET', key)
+        redis.call('DEL', key)
+    end
+    return res
+""")
+
+# connection pool -> False if the server doesn't have GETDEL
+_has_getdel = weakref.WeakKeyDictionary()
+
+
+def _backoff(attempt):
+    """Random (full jitter) exponential backoff.
+    """
+    return random.uniform(0, min(UPDATE_MAX_BACKOFF, 0.001 * 2 ** attempt))
+
+
+def _as_type_of(res, val):
+    """Convert ``res`` (bytes, returned by a script) to the type of
+       ``val`` (numbers), or str.
+    """
+    res = res.decode('u8')
+    if isinstance(val, (int, float)) and not isinstance(val, bool):
+        for tp in (type(val), float):
+            try:
+                return tp(res)
+            except ValueError:
+                pass
+    return res
+
+
+def _minmax_args(mode, val, cutoff):
+    if cutoff is None:
+        return [val, mode]
+    return [val, mode, cutoff]
+
+
+def _incr_args(amount, minval, maxval):
+    return [amount,
+            '' if minval is None else minval,
+            '' if maxval is None else maxval]
+
+
+@instrumented('update')
+def update(key, fn, cn=None, max_retries=100):
     """Usage
        ::
 
             update(KEY, lambda val: val + 42)
 
+       ``fn`` is called with the current value (bytes or None), and the
+       new value is written in a transaction that is retried (with a
+       random backoff) if the key is changed by someone else in the
+       meantime. Raises :class:`Timeout` after ``max_retries`` retries.
+
+       Use :func:`setmax`, :func:`setmin` or :func:`incr` for the common
+       cases, they run on the server and never have to retry.
     """
     r = cn or connect()
     with r.pipeline() as p:
-        while 1:
+        for attempt in range(max_retries + 1):
             try:
                 p.watch(key)  # --> immediate mode
                 val = p.get(key)
@@ -198,77 +575,218 @@ def update(key, fn, cn=None):
                 newval = fn(val)
                 p.set(key, newval)
                 p.execute()  # raises WatchError if anyone has changed `key`
-                break  # success, break out of while loop
-            except _redis.WatchError:  # pragma: nocover
-                pass  # someone else got there before us, retry.
+                break  # success, break out of the loop
+            except _redis.WatchError:
+                # someone else got there before us, retry.
+                UPDATE_STATS['retries'] += 1
+                if instrumentation.hooks:
+                    instrumentation.record('update.retry')
+                time.sleep(_backoff(attempt))
+        else:
+            UPDATE_STATS['timeouts'] += 1
+            raise Timeout(retry=max_retries)
     if isinstance(newval, bytes):
         newval = newval.decode('u8')
     return newval
 
 
-def setmax(key, val, cn=None):
-    """Update key with the max of the current value and `val`::
+def setmax(key, val, cn=None, cutoff=None):
+    """Atomically update key with the max of the current value and `val`::
 
           r[key] := max(r[key], val)
 
-       returns the maximum value.
+       returns the maximum value (as a str, unless `val` is a number).
+       Values are compared as numbers if both are numeric, otherwise as
+       strings. A missing key is set to `val`.
+
+       With a ``cutoff`` the result is at most ``cutoff``.
     """
-    if isinstance(val, str):
-        val = val.encode('u8')
-    return update(key, lambda v: max(v, val), cn=cn)
+    args = _minmax_args('max', val, cutoff)
+    b = _batching(cn)
+    if b is not None:
+        return b.add(lambda p: _SETMAXMIN(p, [key], args),
+                     lambda res: _as_type_of(res[0], val))
+    r = cn or connect()
+    return _as_type_of(_SETMAXMIN(r, [key], args), val)
 
 
-def setmin(key, val, cn=None):
-    """Update key with the max of the current value and `val`::
+def setmin(key, val, cn=None, cutoff=None):
+    """Atomically update key with the min of the current value and `val`::
 
           r[key] := min(r[key], val)
 
-       returns the maximum value.
+       returns the minimum value (see :func:`setmax`).
+
+       With a ``cutoff`` the result is at least ``cutoff``.
     """
-    if isinstance(val, str):
-        val = val.encode('u8')
-    return update(key, lambda v: min(v, val), cn=cn)
+    args = _minmax_args('min', val, cutoff)
+    b = _batching(cn)
+    if b is not None:
+        return b.add(lambda p: _SETMAXMIN(p, [key], args),
+                     lambda res: _as_type_of(res[0], val))
+    r = cn or connect()
+    return _as_type_of(_SETMAXMIN(r, [key], args), val)
 
 
-def set_pyval(key, val, secs=None, cn=None):
-    """Store any (picleable) value in Redis.
+def setmax_cutoff(key, val, cutoff, cn=None):
+    """``r[key] := min(cutoff, max(r[key], val))``
+    """
+    return setmax(key, val, cn=cn, cutoff=cutoff)
+
+
+def setmin_cutoff(key, val, cutoff, cn=None):
+    """``r[key] := max(cutoff, min(r[key], val))``
+    """
+    return setmin(key, val, cn=cn, cutoff=cutoff)
+
+
+def incr(key, amount=1, minval=None, maxval=None, cn=None):
+    """Atomically add ``amount`` to the number stored at ``key`` (a
+       missing key counts as 0), clamping the result to
+       ``[minval, maxval]``. Returns the new value.
     """
+    args = _incr_args(amount, minval, maxval)
+    b = _batching(cn)
+    if b is not None:
+        return b.add(lambda p: _INCR(p, [key], args),
+                     lambda res: _as_type_of(res[0], amount))
     r = cn or connect()
-    pval = pickle.dumps(val, protocol=PICLE_PROTOCOL)
+    return _as_type_of(_INCR(r, [key], args), amount)
+
+
+def _set(r, key, pval, secs):
     if secs is None:
         r.set(key, pval)
     else:
         r.setex(key, secs, pval)
 
 
+@instrumented('set_pyval')
+def set_pyval(key, val, secs=None, cn=None, serializer=None,
+              compression=None):
+    """Store any (picleable) value in Redis.
+
+       ``serializer`` and ``compression`` are names of a serializer and a
+       compressor from :mod:`dkredis.serializers` (default: pickle, and
+       compression of large values only if configured there).
+    """
+    pval = serializers.dumps(val, serializer, compression)
+    b = _batching(cn)
+    if b is not None:
+        return b.add(lambda p: _set(p, key, pval, secs))
+    _set(cn or connect(), key, pval, secs)
+
+
+# KEYS[1]: value, KEYS[2]: the last fencing token written, ARGV[1]:
+# fencing token, ARGV[2]: value, ARGV[3]: ttl (ms, 0: no expiry).
+# The token is kept as long as the value (after that there is nothing
+# left to protect).
+_FENCED_SET = scripts.register('fenced_set', """
+    local last = tonumber(redis.call('GET', KEYS[2]) or '0')
+    if tonumber(ARGV[1]) < last then
+        return 0
+    end
+    if ARGV[3] == '0' then
+        redis.call('SET', KEYS[1], ARGV[2])
+        redis.call('SET', KEYS[2], ARGV[1])
+    else
+        redis.call('SET', KEYS[1], ARGV[2], 'PX', ARGV[3])
+        redis.call('SET', KEYS[2], ARGV[1], 'PX', ARGV[3])
+    end
+    return 1
+""")
+
+
+def _fenced_args(key, data, fence, secs=None, fencekey=None):
+    # (the fencing tokens have their own namespace, so they can't be
+    # mistaken for the value of another key)
+    ttl_ms = 0 if secs is None else max(int(secs * 1000), 1)
+    if fencekey is None:
+        fencekey = 'dkredis:fence:' + key
+    return [key, fencekey], [fence, data, ttl_ms]
+
+
+def _fenced_set(r, key, data, fence, secs=None, fencekey=None):
+    return _FENCED_SET(r, *_fenced_args(key, data, fence, secs, fencekey))
+
+
+def set_pyval_fenced(key, val, fence, secs=None, cn=None, serializer=None,
+                     compression=None):
+    """Store ``val`` (like :func:`set_pyval`), unless a value has been
+       stored with a newer fencing token than ``fence`` (from a lock
+       acquired with ``fencing=True``, see
+       :class:`dkredis.dkredislocks.Lock`).
+
+       Returns True if the value was written. The check and the write are
+       atomic.
+    """
+    r = cn or connect()
+    pval = serializers.dumps(val, serializer, compression)
+    return bool(_fenced_set(r, key, pval, fence, secs))
+
+
+@instrumented('get_pyval')
 def get_pyval(key, cn=None, missing_value=None):
     """Get a Python value from Redis.
     """
+    b = _batching(cn)
+    if b is not None:
+        return b.add(lambda p: p.get(key),
+                     lambda res: _loads(res[0], missing_value))
     r = cn or connect()
-    val = r.get(key)
+    return _loads(r.get(key), missing_value)
+
+
+def _loads(val, missing_value=None):
     if val is None:  # pragma: nocover
         return missing_value  # value if key is missing
     # print "dkredis:get_pyval:VAL:%s:" % val
-    return pickle.loads(val)
+    return serializers.loads(val)
+
+
+def _pop(r, keys):
+    """Atomically get and delete ``keys``, returning the raw values (with
+       GETDEL for a single key, otherwise with a script).
+    """
+    if len(keys) == 1 and _has_getdel.get(r.connection_pool, True):
+        try:
+            return [r.getdel(keys[0])]
+        except _redis.ResponseError as e:
+            if 'unknown command' not in str(e).lower():
+                raise
+            _has_getdel[r.connection_pool] = False   # redis < 6.2
+    return _POP(r, keys)
 
 
 def pop_pyval(key, cn=None):
-    """Get value and remove key.
+    """Get value and remove key (atomically, in one round trip).
     """
     r = cn or connect()
-    val = get_pyval(key, cn=r)
-    r.delete(key)
-    # with r.pipeline() as p:
-    #     # can't get a val in the middle of a pipeline
-    #     val = get_pyval(key, p)
-    #     p.delete(key)
-    #     p.execute()
-    return val
+    val, = _pop(r, [key])
+    if val is None:
+        return None
+    return serializers.loads(val)
+
+
+def pop_pyvals(keys, cn=None):
+    """Get the values of ``keys`` and remove them (atomically, in one
+       round trip). Returns a dict ``{key: value}`` of the keys that
+       existed.
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+    r = cn or connect()
+    return {key: serializers.loads(val)
+            for key, val in zip(keys, _pop(r, keys)) if val is not None}
 
 
 def remove(key, cn=None):
     """Remove a key from redis.
     """
+    b = _batching(cn)
+    if b is not None:
+        return b.add(lambda p: p.delete(key))
     r = cn or connect()
     r.delete(key)
 
@@ -277,39 +795,106 @@ def remove_if(key, val, cn=None):
     """Atomically remove key if it has the value `val`.
     """
     r = cn or connect()
-
-    lua_script = """
-        if redis.call('GET', KEYS[1]) == ARGV[1] then
-            return redis.call('DEL', KEYS[1])
-        else
-            return 0
-        end
-    """
-    return r.eval(lua_script, 1, key, val)
+    return _REMOVE_IF(r, [key], [val])
 
 
 def set_dict(key, dictval, secs=None, cn=None):
     """All values in `dictval` should be strings. They'll be read back
        as strings -- use `py_setval` to set dicts with any values.
     """
-    r = cn or connect()
+    b = _batching(cn)
+    if b is not None:
+        return b.add(lambda p: _hset(p, key, dictval, secs))
+    _hset(cn or connect(), key, dictval, secs)
+
+
+def _hset(r, key, dictval, secs):
     r.hset(key, mapping=dictval)
     if secs is not None:
         r.expire(key, secs)
 
 
+def _decode_hash(res):
+    """Decode the bytes keys and values from redis to str.
+    """
+    return {k.decode('u8'): v.decode('u8') for k, v in res.items()}
+
+
 def get_dict(key, cn=None):
     """Return a redis hash as a python dict.
     """
+    b = _batching(cn)
+    if b is not None:
+        return b.add(lambda p: p.hgetall(key),
+                     lambda res: _decode_hash(res[0]))
     r = cn or connect()
-    res = {}
-    for fieldname in r.hkeys(key):
-        res[fieldname] = r.hget(key, fieldname)
-    return {k.decode('u8'): v.decode('u8') for k, v in res.items()}
+    return _decode_hash(r.hgetall(key))
+
+
+def get_dicts(keys, cn=None):
+    """Return the redis hashes stored under ``keys`` (in one round trip)
+       as a dict ``{key: dict}``.
+    """
+    keys = list(keys)
+    r = cn or connect()
+    with r.pipeline(transaction=False) as p:
+        for key in keys:
+            p.hgetall(key)
+        return {key: _decode_hash(res) for key, res in zip(keys, p.execute())}
+
+
+def mhget(keys, fields, cn=None):
+    """Get ``fields`` from each of the hashes stored under ``keys`` (in one
+       round trip). Returns ``{key: {field: value}}``, where ``value`` is
+       None for missing fields.
+    """
+    keys = list(keys)
+    fields = list(fields)
+    r = cn or connect()
+    with r.pipeline(transaction=False) as p:
+        for key in keys:
+            p.hmget(key, fields)
+        return {
+            key: {f: (v.decode('u8') if v is not None else None)
+                  for f, v in zip(fields, vals)}
+            for key, vals in zip(keys, p.execute())
+        }
+
+
+def _hget_batch(r, keys, field):
+    with r.pipeline(transaction=False) as p:
+        for key in keys:
+            p.hget(key, field)
+        vals = p.execute()
+    for key, val in zip(keys, vals):
+        if val is not None:
+            yield key.decode('u8'), val.decode('u8')
+
+
+def imhkeyget(keypattern, field, cn=None, batchsize=1000):
+    """Iterate over ``(key, value)`` pairs of the ``field`` in all hashes
+       whose key matches ``keypattern`` (see :func:`mhkeyget`).
+
+       The keys are found with SCAN (which doesn't block the server), and
+       the values are fetched with one pipelined round trip per
+       ``batchsize`` keys. SCAN can return a key more than once if the
+       keyspace changes during the iteration.
+    """
+    r = cn or connect()
+    keys = []
+    for key in r.scan_iter(match=keypattern, count=batchsize):
+        keys.append(key)
+        if len(keys) >= batchsize:
+            yield from _hget_batch(r, keys, field)
+            keys = []
+    if keys:
+        yield from _hget_batch(r, keys, field)
 
 
 def mhkeyget(keypattern, field, cn=None):
-    """Get a field from multiple hashes.
+    """Get a field from multiple hashes (hashes without the field are
+       skipped). Use :func:`imhkeyget` to iterate over a large number of
+       hashes.
 
        Usage::
 
@@ -328,11 +913,4 @@ def mhkeyget(keypattern, field, cn=None):
          True
 
     """
-    result = {}
-    r = cn or connect()
-
-    hashes = r.keys(keypattern)
-    for h in hashes:
-        result[h] = r.hget(h, field)
-    # XXX: redis always returns bytes, and we want unicode
-    return {k.decode('u8'): v.decode('u8') for k, v in result.items()}
+    return dict(imhkeyget(keypattern, field, cn=cn))
@@ -1,18 +1,127 @@
+import logging
+import os
+import random
+import threading
 import time
 from contextlib import contextmanager
 
+import redis as _redis
+
+from . import scripts
+from .instrumentation import instrumented
 from .utils import (
     is_valid_identifier,
     unique_id,
     convert_to_bytes,
     later,
-    now,
 )
 from .dkredis import connect, Timeout, remove_if
 
 
+def _fetch_lock_key(apiname):
+    if not is_valid_identifier(apiname):
+        raise ValueError(
+            f'`apiname` must be a valid lower-case python identifier, '
+            f'got {apiname}'
+        )
+    return f'dkredis:fetchlock:{apiname}'
+
+
+def _expiry(timeout):
+    """SET arguments for a ``timeout`` in seconds (int or float).
+    """
+    if isinstance(timeout, int):
+        return {'ex': timeout}
+    return {'px': int(timeout * 1000)}
+
+
+log = logging.getLogger(__name__)
+
+
+def _lock_info(args, kw, res):
+    # args[0] is the lock, res is True/a token if it was acquired.
+    return {'acquired': bool(res), 'name': args[0].name}
+
+
+# KEYS[1]: lock, ARGV[1]: token, ARGV[2]: ttl (ms)
+_EXTEND = scripts.register('lock_extend', """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+""")
+
+
+def extend(key, token, ttl, cn=None):
+    """Set the time to live of the lock ``key`` to ``ttl`` seconds, if it
+       is still held with ``token``. Returns False if the lock was lost.
+    """
+    r = cn or connect()
+    return bool(_EXTEND(r, [key], [token, int(ttl * 1000)]))
+
+
+class Watchdog(threading.Thread):
+    """Background thread that renews the lease of a lock (held with
+       ``token``) every ``interval`` seconds (default: a third of
+       ``ttl``), until :meth:`stop` is called or the lock is lost.
+    """
+
+    def __init__(self, r, key, token, ttl, interval=None, script=None):
+        super().__init__(name=f'dkredis-watchdog:{key}', daemon=True)
+        self.r = r
+        self.key = key
+        self.token = token
+        self.ttl = ttl
+        self.script = _EXTEND if script is None else script
+        self.interval = ttl / 3.0 if interval is None else interval
+        #: True if the lock expired, or was taken by someone else.
+        self.lost = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                if not self.script(self.r, [self.key],
+                                   [self.token, int(self.ttl * 1000)]):
+                    self.lost = True
+                    return
+            except _redis.RedisError as e:  # pragma: nocover
+                # try again, the lock is still valid for a while.
+                log.warning("could not extend lock %s: %r", self.key, e)
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+
+
+class Held:
+    """Yielded by :func:`fetch_lease`: true if the lock was acquired (i.e.
+       the caller should do the fetch).
+    """
+
+    def __init__(self, acquired, watchdog=None, fence=None):
+        self.acquired = acquired
+        self.watchdog = watchdog
+        #: the fencing token (with ``fencing=True``).
+        self.fence = fence
+
+    def __bool__(self):
+        return self.acquired
+
+    def __repr__(self):
+        return f'<Held acquired={self.acquired} lost={self.lost}>'
+
+    @property
+    def lost(self):
+        """True if the lock was lost while it was held (only detected when
+           the lease is renewed).
+        """
+        return self.watchdog is not None and self.watchdog.lost
+
+
 @contextmanager
-def fetch_lock(apiname: str, timeout=5, cn=None):
+def fetch_lock(apiname: str, timeout=5, cn=None, renew=False):
     """Use this lock to ensure that only one process is fetching
        expired cached data from an external api.
 
@@ -38,24 +147,61 @@ def fetch_lock(apiname: str, timeout=5, cn=None):
                             time.sleep(1)
                             return cache.get_value('weatherdata', default=None)
 
+       With ``renew=True`` the lock is extended by ``timeout`` seconds
+       every ``timeout / 3`` seconds (in a background thread) while the
+       context is active, so a short ``timeout`` can be used (for quick
+       recovery if the process crashes) even if the fetch is slow.
+
+       Use :func:`fetch_lease` to know if the lock was lost, or to get a
+       fencing token.
     """
-    if not is_valid_identifier(apiname):
-        raise ValueError(
-            f'`apiname` must be a valid lower-case python identifier, '
-            f'got {apiname}'
-        )
-    key = f'dkredis:fetchlock:{apiname}'
+    with fetch_lease(apiname, timeout, cn, renew) as held:
+        yield held.acquired
+
+
+@contextmanager
+def fetch_lease(apiname: str, timeout=5, cn=None, renew=False,
+                fencing=False):
+    """:func:`fetch_lock`, that yields a :class:`Held` (true if the caller
+       should do the fetch).
+
+       ``held.lost`` tells if the lock was lost while it was held (with
+       ``renew=True``), and with ``fencing=True`` ``held.fence`` is a
+       fencing token (see :func:`dkredis.dkredis.set_pyval_fenced`).
+
+       Usage::
+
+            with fetch_lease('weatherapi', fencing=True) as held:
+                if held:
+                    weatherdata = fetch_weather_data()
+                    cache.put_fenced('weatherdata', weatherdata, held.fence)
+
+    """
+    key = _fetch_lock_key(apiname)
     uniq = unique_id()
     r = cn or connect()
-    if r.set(key, value=uniq, ex=timeout, nx=True):
+    fence = None
+    if fencing:
+        fence = -_ACQUIRE(r, [key, key + ':fence'],
+                          [uniq, int(timeout * 1000)])
+        acquired = fence > 0
+    else:
+        acquired = r.set(key, value=uniq, nx=True, **_expiry(timeout))
+    if acquired:
         # We have the lock:
         # if set(..nx=True) returns True, then our value was set, and we have
         # the lock, yield to the context, then exit.
+        watchdog = None
+        if renew:
+            watchdog = Watchdog(r, key, uniq, timeout)
+            watchdog.start()
 
         try:
-            yield True      # the client should do the fetch
+            yield Held(True, watchdog, fence)  # the client should fetch
 
         finally:
+            if watchdog is not None:
+                watchdog.stop()
             # Release the lock:
             # The lock can have timed out while we were in the context, so we
             # need to check that we still have the lock before deleting it.
@@ -65,7 +211,7 @@ def fetch_lock(apiname: str, timeout=5, cn=None):
             return
     else:
         # Lock is already held by another process
-        yield False    # the client should not do the fetch
+        yield Held(False)    # the client should not do the fetch
 
 
 def rate_limiting_lock(resources, seconds=30, cn=None):
@@ -73,87 +219,779 @@ def rate_limiting_lock(resources, seconds=30, cn=None):
        Useful e.g. to prevent sending email to the same domain more often
        than every 15 seconds.
 
-       XXX: Currently doesn't recover from crashed clients (can be done as
-            an else: clause to the if r.msetnx(), similarly to the mutex
-            function (below).
-
+       All keys are locked (with an expiry), or none of them, in a single
+       atomic operation. ``seconds`` can be a float.
     """
     if not resources:
         return True
 
     resources = [convert_to_bytes(r) for r in resources]
-    keys = {b'rl-lock.' + r: later(seconds) for r in resources}
+    keys = [b'rl-lock.' + r for r in resources]
+    expires = later(seconds)
 
     r = cn or connect()
+    return _MULTI_ACQUIRE(r, keys, [int(seconds * 1000)] +
+                          [expires] * len(keys)) == 0
+
+
+# KEYS: locks, ARGV[1]: ttl (ms), ARGV[2..]: token for each key.
+# Returns 0 if all keys were set, otherwise the (1-based) index of the
+# first key that exists.
+_MULTI_ACQUIRE = scripts.register('multi_acquire', """
+    for i, key in ipairs(KEYS) do
+        if redis.call('EXISTS', key) == 1 then
+            return i
+        end
+    end
+    for i, key in ipairs(KEYS) do
+        redis.call('SET', key, ARGV[i + 1], 'PX', ARGV[1])
+    end
+    return 0
+""")
+
+# KEYS: locks, ARGV[1..n]: token for each key, ARGV[n + 1]: wake ttl (ms).
+# Deletes the locks that are still ours, and wakes a waiter for each.
+_MULTI_RELEASE = scripts.register('multi_release', """
+    local n = 0
+    local ttl = ARGV[#KEYS + 1]
+    for i, key in ipairs(KEYS) do
+        if redis.call('GET', key) == ARGV[i] then
+            redis.call('DEL', key)
+            local wake = key .. ':wake'
+            redis.call('LPUSH', wake, 1)
+            redis.call('LTRIM', wake, 0, 0)
+            redis.call('PEXPIRE', wake, ttl)
+            n = n + 1
+        end
+    end
+    return n
+""")
+
+#: How long (ms) an unclaimed wake-up message is kept.
+WAKE_TTL_MS = 2000
+
+# The acquire scripts return 0 if the lock was acquired, otherwise the
+# max time (ms) to wait (at least 1, PTTL is 0 for the last ms). When they are passed the key of a fencing token
+# counter, they return minus the new fencing token instead of 0.
+
+# KEYS[1]: lock, KEYS[2]: fencing token counter (optional), ARGV[1]:
+# token, ARGV[2]: ttl (ms).
+# A lock without a ttl was left by mutex() of older versions, which stored
+# the expiry timestamp of the lock as its value (and didn't always delete
+# it), it is taken over when that timestamp has passed.
+_ACQUIRE = scripts.register('lock_acquire', """
+    if redis.call('PTTL', KEYS[1]) == -1 then
+        local t = redis.call('TIME')
+        local now = t[1] + t[2] / 1000000
+        local expires = tonumber(redis.call('GET', KEYS[1]))
+        if expires and expires > now then
+            return math.max(math.ceil((expires - now) * 1000), 1)
+        end
+        redis.call('DEL', KEYS[1])
+    end
+    if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+        if KEYS[2] then
+            return -redis.call('INCR', KEYS[2])
+        end
+        return 0
+    end
+    local pttl = redis.call('PTTL', KEYS[1])
+    if pttl < 0 then
+        return tonumber(ARGV[2])
+    end
+    return math.max(pttl, 1)
+""")
+
+# KEYS[1]: lock, KEYS[2]: queue (list of waiting tokens), KEYS[3]: waiter
+# timeouts (zset), KEYS[4]: fencing token counter (optional), ARGV[1]:
+# token, ARGV[2]: ttl (ms), ARGV[3]: how long (ms) to keep a place in the
+# queue (0: don't queue).
+# Only the first waiter in the queue can take a free lock.
+_ACQUIRE_FAIR = scripts.register('lock_acquire_fair', """
+    local t = redis.call('TIME')
+    local now = t[1] * 1000 + math.floor(t[2] / 1000)
+    for _, w in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now)) do
+        redis.call('LREM', KEYS[2], 1, w)
+    end
+    redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+    local head = redis.call('LINDEX', KEYS[2], 0)
+    if (not head or head == ARGV[1]) and
+            redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+        if head then
+            redis.call('LPOP', KEYS[2])
+        end
+        redis.call('ZREM', KEYS[3], ARGV[1])
+        if KEYS[4] then
+            return -redis.call('INCR', KEYS[4])
+        end
+        return 0
+    end
+    local wait = tonumber(ARGV[3])
+    if wait > 0 then
+        if redis.call('ZADD', KEYS[3], now + wait, ARGV[1]) == 1 then
+            redis.call('RPUSH', KEYS[2], ARGV[1])
+        end
+        redis.call('PEXPIRE', KEYS[2], wait)
+        redis.call('PEXPIRE', KEYS[3], wait)
+    end
+    local pttl = redis.call('PTTL', KEYS[1])
+    if pttl < 0 then
+        return tonumber(ARGV[2])
+    end
+    return math.max(pttl, 1)
+""")
+
+# KEYS[1]: queue, KEYS[2]: waiter timeouts, ARGV[1]: token
+_DEQUEUE = scripts.register('lock_dequeue', """
+    redis.call('LREM', KEYS[1], 1, ARGV[1])
+    return redis.call('ZREM', KEYS[2], ARGV[1])
+""")
+
+# KEYS[1]: lock, KEYS[2]: wake list, KEYS[3]: queue, ARGV[1]: token,
+# ARGV[2]: ttl (ms) of the wake-up message.
+# Wakes the first waiter in the queue (fair locks), or any one waiter.
+_RELEASE = scripts.register('lock_release', """
+    if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+        return 0
+    end
+    redis.call('DEL', KEYS[1])
+    local wake = KEYS[2]
+    local head = redis.call('LINDEX', KEYS[3], 0)
+    if head then
+        wake = wake .. ':' .. head
+    end
+    redis.call('LPUSH', wake, 1)
+    redis.call('LTRIM', wake, 0, 0)
+    redis.call('PEXPIRE', wake, ARGV[2])
+    return 1
+""")
+
+
+class Lock:
+    """A mutual exclusion lock, held for at most ``ttl`` seconds (so it is
+       released even if the process holding it crashes).
+
+       Waiting processes block on a per-lock list that is pushed to when
+       the lock is released, so the lock is handed over within
+       milliseconds. With ``fair=True`` the lock is handed over in the
+       order the waiters arrived.
 
-    if r.msetnx(keys):
-        with r.pipeline() as pipe:
-            for key in keys:
-                pipe.expire(key, seconds)
-            pipe.execute()
-        return True
+       Usage::
 
-    return False
+           lock = Lock('invoices', ttl=10)
+           if lock.acquire(timeout=5):
+               try:
+                   ...
+               finally:
+                   lock.release()
+
+           with Lock('invoices', ttl=10, timeout=5):   # raises Timeout
+               ...
+
+       A waiter re-checks the lock at least every ``poll`` seconds (in
+       case the holder crashed, or the wake-up went to a waiter that has
+       given up).
+
+       With ``renew=True`` the lock is extended (by ``ttl`` seconds) in a
+       background thread while it is held, and :attr:`lost` tells if it
+       was lost anyway.
+
+       With ``fencing=True`` every acquisition gets a new, higher,
+       fencing token (:attr:`fence`), to pass to the writes done while
+       holding the lock (see :func:`dkredis.dkredis.set_pyval_fenced`),
+       so a holder that stalled past ``ttl`` can't overwrite the results
+       of the next holder. (The token counter is kept forever, so don't
+       use fencing with an unbounded number of lock names.)
+    """
+    prefix = 'dkredis:lock:'
+    _extend_script = _EXTEND
+
+    def __init__(self, name, ttl=30, timeout=None, fair=False, poll=1.0,
+                 renew=False, fencing=False, cn=None):
+        self.name = name
+        self.key = self.prefix + name
+        self.ttl = ttl
+        self.timeout = timeout
+        self.fair = fair
+        self.poll = poll
+        self.renew = renew
+        self.fencing = fencing
+        self.token = None
+        #: the fencing token of the current acquisition (or None).
+        self.fence = None
+        self.watchdog = None
+        self._lost = False
+        self._cn = cn
+
+    @property
+    def cn(self):
+        if self._cn is None:
+            self._cn = connect()
+        return self._cn
+
+    def _keys(self):
+        k = self.key
+        return [k, k + ':wake', k + ':queue', k + ':timeouts']
+
+    def _fence_keys(self):
+        return [self.key + ':fence'] if self.fencing else []
+
+    def _fenced(self, wait_ms):
+        # a negative result from the acquire scripts is a fencing token
+        if wait_ms < 0:
+            self.fence = -wait_ms
+            return 0
+        return wait_ms
+
+    def _try_acquire(self, token, queue_ms):
+        lock, _, queue, timeouts = self._keys()
+        ttl_ms = int(self.ttl * 1000)
+        if self.fair:
+            return self._fenced(_ACQUIRE_FAIR(
+                self.cn, [lock, queue, timeouts] + self._fence_keys(),
+                [token, ttl_ms, queue_ms]))
+        return self._fenced(_ACQUIRE(self.cn, [lock] + self._fence_keys(),
+                                     [token, ttl_ms]))
+
+    def _release(self, token):
+        lock, wake, queue, _ = self._keys()
+        return bool(_RELEASE(self.cn, [lock, wake, queue],
+                             [token, int(self.poll * 2000)]))
+
+    def _new_token(self):
+        return unique_id()
+
+    def _wait(self, token, secs):
+        wake = self.key + ':wake'
+        if self.fair:
+            wake += ':' + token
+        self.cn.blpop([wake], timeout=max(secs, 0.001))
+
+    @instrumented('lock.acquire', info=_lock_info)
+    def acquire(self, blocking=True, timeout=None):
+        """Acquire the lock, waiting at most ``timeout`` seconds (None:
+           forever). Returns True if the lock was acquired.
+        """
+        token = None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        queue_ms = int(self.poll * 2000) if blocking else 0
+        while 1:
+            if token is None or not self.fair:
+                # (a fair waiter keeps its token, it is its place in the
+                # queue)
+                token = self._new_token()
+            wait_ms = self._try_acquire(token, queue_ms)
+            if wait_ms == 0:
+                self._acquired(token)
+                if self.renew and self.watchdog is None:
+                    self.watchdog = Watchdog(self.cn, self.key, token,
+                                             self.ttl,
+                                             script=self._extend_script)
+                    self.watchdog.start()
+                return True
+            wait = min(wait_ms / 1000.0, self.poll)
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+            if not blocking or wait <= 0:
+                if self.fair and blocking:
+                    _DEQUEUE(self.cn, self._keys()[2:], [token])
+                return False
+            self._wait(token, wait)
+
+    def _acquired(self, token):
+        self.token = token
+        self._lost = False
+
+    def _released(self, ok):
+        if self.watchdog is not None:
+            self._lost = self.watchdog.lost
+            self.watchdog = None
+        self._lost = self._lost or not ok
+        return ok
+
+    @property
+    def lost(self):
+        """True if the lock expired (or was taken by someone else) while
+           it was held.
+        """
+        return self._lost or (self.watchdog is not None and
+                              self.watchdog.lost)
+
+    def extend(self, ttl=None):
+        """Extend the lock by ``ttl`` seconds (default: ``self.ttl``).
+           Returns False if the lock was lost.
+        """
+        if self.token is None:
+            return False
+        ttl = self.ttl if ttl is None else ttl
+        return bool(self._extend_script(self.cn, [self.key],
+                                        [self.token, int(ttl * 1000)]))
+
+    def release(self):
+        """Release the lock (if it is still ours), and wake up a waiter.
+           Returns False if the lock had expired.
+        """
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        token, self.token = self.token, None
+        self.fence = None
+        if token is None:
+            return False
+        return self._released(self._release(token))
+
+    def locked(self):
+        """Is the lock held (by anyone)?
+        """
+        return bool(self.cn.exists(self.key))
+
+    def __enter__(self):
+        if not self.acquire(timeout=self.timeout):
+            raise Timeout()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+# KEYS[1]: lock (hash with owner, count and fencing token), KEYS[2]:
+# fencing token counter (optional), ARGV[1]: owner, ARGV[2]: ttl.
+# The fencing token is the same for all (nested) acquisitions.
+_RACQUIRE = scripts.register('rlock_acquire', """
+    local owner = redis.call('HGET', KEYS[1], 'owner')
+    local res = 0
+    if not owner then
+        redis.call('HSET', KEYS[1], 'owner', ARGV[1])
+        redis.call('HSET', KEYS[1], 'count', 1)
+        if KEYS[2] then
+            res = -redis.call('INCR', KEYS[2])
+            redis.call('HSET', KEYS[1], 'fence', -res)
+        end
+    elseif owner == ARGV[1] then
+        redis.call('HINCRBY', KEYS[1], 'count', 1)
+        if KEYS[2] then
+            res = -tonumber(redis.call('HGET', KEYS[1], 'fence') or '0')
+        end
+    else
+        local pttl = redis.call('PTTL', KEYS[1])
+        if pttl < 0 then
+            return tonumber(ARGV[2])
+        end
+        return math.max(pttl, 1)
+    end
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return res
+""")
+
+# KEYS[1]: lock, KEYS[2]: wake list, ARGV[1]: owner, ARGV[2]: wake ttl.
+# Returns -1 if the lock isn't ours, otherwise the remaining hold count.
+_RRELEASE = scripts.register('rlock_release', """
+    if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+        return -1
+    end
+    local count = redis.call('HINCRBY', KEYS[1], 'count', -1)
+    if count > 0 then
+        return count
+    end
+    redis.call('DEL', KEYS[1])
+    redis.call('LPUSH', KEYS[2], 1)
+    redis.call('LTRIM', KEYS[2], 0, 0)
+    redis.call('PEXPIRE', KEYS[2], ARGV[2])
+    return 0
+""")
+
+# KEYS[1]: lock, ARGV[1]: owner, ARGV[2]: ttl (ms)
+_REXTEND = scripts.register('rlock_extend', """
+    if redis.call('HGET', KEYS[1], 'owner') == ARGV[1] then
+        return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+""")
+
+# unique per process (and renewed in forked children)
+_process_id = unique_id()
+
+
+def _new_process_id():  # pragma: nocover
+    global _process_id
+    _process_id = unique_id()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_new_process_id)
+
+
+class RLock(Lock):
+    """A reentrant :class:`Lock`: a thread that holds the lock can
+       acquire it again (it must be released as many times as it was
+       acquired). The owner and the hold count are stored in a hash.
+
+       Usage::
+
+           def update_invoice(invoice):
+               with RLock(f'invoice-{invoice.id}'):
+                   ...
+
+           with RLock(f'invoice-{invoice.id}'):
+               update_invoice(invoice)      # doesn't deadlock
+
+    """
+    prefix = 'dkredis:rlock:'
+    _extend_script = _REXTEND
+
+    def __init__(self, name, ttl=30, timeout=None, poll=1.0, renew=False,
+                 fencing=False, cn=None):
+        super().__init__(name, ttl=ttl, timeout=timeout, poll=poll,
+                         renew=renew, fencing=fencing, cn=cn)
+        #: number of (nested) acquisitions through this object.
+        self.holds = 0
+
+    def _acquired(self, token):
+        self.holds += 1
+        if self.holds == 1:
+            super()._acquired(token)
+
+    def release(self):
+        """Release one acquisition of the lock (the lock is released
+           when it has been released as many times as it was acquired).
+           Returns False if the lock had expired.
+        """
+        if self.holds > 1:
+            self.holds -= 1
+            return self._release(self.token)
+        self.holds = 0
+        return super().release()
+
+    def _new_token(self):
+        return f'{_process_id}:{threading.get_ident()}'
+
+    def _try_acquire(self, token, queue_ms):
+        return self._fenced(_RACQUIRE(self.cn, [self.key] + self._fence_keys(),
+                                      [token, int(self.ttl * 1000)]))
+
+    def _release(self, token):
+        return _RRELEASE(self.cn, [self.key, self.key + ':wake'],
+                         [token, int(self.poll * 2000)]) >= 0
+
+
+# KEYS[1]: readers (zset of token -> expires), KEYS[2]: writer,
+# KEYS[3]: writer intent, KEYS[4]: reader wake list,
+# ARGV[1]: token, ARGV[2]: ttl (ms), ARGV[3]: '1' to wake the next reader.
+_READ_ACQUIRE = scripts.register('rwlock_read_acquire', """
+    local pttl = math.max(redis.call('PTTL', KEYS[2]),
+                          redis.call('PTTL', KEYS[3]))
+    if pttl ~= -2 then
+        if pttl < 0 then
+            return tonumber(ARGV[2])
+        end
+        return math.max(pttl, 1)
+    end
+    local t = redis.call('TIME')
+    local now = t[1] * 1000 + math.floor(t[2] / 1000)
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    redis.call('ZADD', KEYS[1], now + ARGV[2], ARGV[1])
+    if redis.call('PTTL', KEYS[1]) < tonumber(ARGV[2]) then
+        redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    if ARGV[3] == '1' then
+        redis.call('LPUSH', KEYS[4], 1)
+        redis.call('LTRIM', KEYS[4], 0, 0)
+        redis.call('PEXPIRE', KEYS[4], ARGV[2])
+    end
+    return 0
+""")
+
+# KEYS[1]: readers, KEYS[2]: writer, KEYS[3]: writer intent, ARGV[1]:
+# token, ARGV[2]: ttl (ms), ARGV[3]: how long (ms) the intent to write
+# stops new readers.
+_WRITE_ACQUIRE = scripts.register('rwlock_write_acquire', """
+    local t = redis.call('TIME')
+    local now = t[1] * 1000 + math.floor(t[2] / 1000)
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    local intent = redis.call('GET', KEYS[3])
+    local writer = redis.call('PTTL', KEYS[2])
+    if writer == -2 and (not intent or intent == ARGV[1]) then
+        if redis.call('ZCARD', KEYS[1]) == 0 then
+            redis.call('SET', KEYS[2], ARGV[1], 'PX', ARGV[2])
+            redis.call('DEL', KEYS[3])
+            return 0
+        end
+    end
+    if not intent or intent == ARGV[1] then
+        redis.call('SET', KEYS[3], ARGV[1], 'PX', ARGV[3])
+    end
+    if writer > 0 then
+        return writer
+    end
+    local first = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    if first[2] then
+        return math.max(tonumber(first[2]) - now, 1)
+    end
+    return tonumber(ARGV[3])
+""")
+
+# KEYS[1]: readers, KEYS[2]: writer wake list, ARGV[1]: token,
+# ARGV[2]: wake ttl (ms). The last reader wakes a waiting writer.
+_READ_RELEASE = scripts.register('rwlock_read_release', """
+    local res = redis.call('ZREM', KEYS[1], ARGV[1])
+    if redis.call('ZCARD', KEYS[1]) == 0 then
+        redis.call('LPUSH', KEYS[2], 1)
+        redis.call('LTRIM', KEYS[2], 0, 0)
+        redis.call('PEXPIRE', KEYS[2], ARGV[2])
+    end
+    return res
+""")
+
+# KEYS[1]: writer, KEYS[2]: writer intent, KEYS[3]: reader wake list,
+# KEYS[4]: writer wake list, ARGV[1]: token, ARGV[2]: wake ttl (ms).
+_WRITE_RELEASE = scripts.register('rwlock_write_release', """
+    local res = 0
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        redis.call('DEL', KEYS[1])
+        res = 1
+    elseif redis.call('GET', KEYS[2]) == ARGV[1] then
+        redis.call('DEL', KEYS[2])
+    else
+        return 0
+    end
+    for i = 3, 4 do
+        redis.call('LPUSH', KEYS[i], 1)
+        redis.call('LTRIM', KEYS[i], 0, 0)
+        redis.call('PEXPIRE', KEYS[i], ARGV[2])
+    end
+    return res
+""")
+
+
+class RWLock:
+    """A reader/writer lock: any number of readers can hold the lock at
+       the same time, but a writer has it alone. A waiting writer stops
+       new readers from taking the lock, so writers aren't starved.
+
+       Locks are held for at most ``ttl`` seconds.
+
+       Usage::
+
+           lock = RWLock('pricelist')
+
+           with lock.read():
+               ...  # use the dataset
+
+           with lock.write():
+               ...  # rebuild the dataset
+
+       ``read()`` and ``write()`` raise :class:`Timeout` if the lock can't
+       be acquired in ``timeout`` seconds (None: wait forever).
+    """
+    prefix = 'dkredis:rwlock:'
+
+    def __init__(self, name, ttl=30, timeout=None, poll=1.0, cn=None):
+        self.name = name
+        self.key = self.prefix + name
+        self.ttl = ttl
+        self.timeout = timeout
+        self.poll = poll
+        self._cn = cn
+
+    @property
+    def cn(self):
+        if self._cn is None:
+            self._cn = connect()
+        return self._cn
+
+    def _keys(self):
+        k = self.key
+        return dict(readers=k + ':readers', writer=k + ':writer',
+                    intent=k + ':intent', rwake=k + ':wake:r',
+                    wwake=k + ':wake:w')
+
+    def _acquire(self, token, try_acquire, wake, blocking, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+        while 1:
+            wait_ms = try_acquire(token, waited)
+            if wait_ms == 0:
+                return token
+            wait = min(wait_ms / 1000.0, self.poll)
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+            if not blocking or wait <= 0:
+                return None
+            self.cn.blpop([wake], timeout=max(wait, 0.001))
+            waited = True
+
+    @instrumented('rwlock.read', info=_lock_info)
+    def acquire_read(self, blocking=True, timeout=None):
+        """Acquire a read lock. Returns a token (for :meth:`release_read`)
+           or None if the lock wasn't acquired.
+        """
+        k = self._keys()
+
+        def try_acquire(token, waited):
+            return _READ_ACQUIRE(
+                self.cn, [k['readers'], k['writer'], k['intent'], k['rwake']],
+                [token, int(self.ttl * 1000), '1' if waited else '0'])
+
+        return self._acquire(unique_id(), try_acquire, k['rwake'], blocking,
+                             timeout)
+
+    def release_read(self, token):
+        """Release the read lock held with ``token``.
+        """
+        k = self._keys()
+        return bool(_READ_RELEASE(self.cn, [k['readers'], k['wwake']],
+                                  [token, int(self.poll * 2000)]))
+
+    @instrumented('rwlock.write', info=_lock_info)
+    def acquire_write(self, blocking=True, timeout=None):
+        """Acquire the write lock. Returns a token (for
+           :meth:`release_write`) or None if the lock wasn't acquired.
+        """
+        k = self._keys()
+        intent_ms = int(self.poll * 2000) if blocking else 1
+
+        def try_acquire(token, waited):
+            return _WRITE_ACQUIRE(
+                self.cn, [k['readers'], k['writer'], k['intent']],
+                [token, int(self.ttl * 1000), intent_ms])
+
+        token = unique_id()
+        if self._acquire(token, try_acquire, k['wwake'], blocking, timeout):
+            return token
+        if blocking:
+            self.release_write(token)   # don't keep readers waiting
+        return None
+
+    def release_write(self, token):
+        """Release the write lock held with ``token`` (or withdraw the
+           intent to write of a writer that gave up).
+        """
+        k = self._keys()
+        return bool(_WRITE_RELEASE(
+            self.cn, [k['writer'], k['intent'], k['rwake'], k['wwake']],
+            [token, int(self.poll * 2000)]))
+
+    @contextmanager
+    def read(self):
+        """Context manager holding a read lock.
+        """
+        token = self.acquire_read(timeout=self.timeout)
+        if token is None:
+            raise Timeout()
+        try:
+            yield
+        finally:
+            self.release_read(token)
+
+    @contextmanager
+    def write(self):
+        """Context manager holding the write lock.
+        """
+        token = self.acquire_write(timeout=self.timeout)
+        if token is None:
+            raise Timeout()
+        try:
+            yield
+        finally:
+            self.release_write(token)
+
+
+def _multi_lock_keys(resources):
+    return [Lock.prefix + resource for resource in resources]
+
+
+def multi_lock(resources, ttl=30, cn=None):
+    """Lock all ``resources`` (the same names as :class:`Lock` uses) for
+       ``ttl`` seconds, all or nothing, in one round trip.
+
+       Returns a dict ``{resource: token}`` (pass it to
+       :func:`multi_unlock`), or None if any of the resources were
+       already locked.
+
+       Usage::
+
+           tokens = multi_lock([f'invoice-{i.id}' for i in invoices], 60)
+           if tokens is not None:
+               try:
+                   ...
+               finally:
+                   multi_unlock(tokens)
+
+    """
+    resources = list(dict.fromkeys(resources))     # unique, in order
+    if not resources:
+        return {}
+    uniq = unique_id()
+    tokens = {resource: f'{uniq}:{i}' for i, resource in enumerate(resources)}
+    r = cn or connect()
+    if _MULTI_ACQUIRE(r, _multi_lock_keys(resources),
+                      [int(ttl * 1000)] + list(tokens.values())):
+        return None
+    return tokens
+
+
+def multi_unlock(tokens, cn=None):
+    """Release the locks acquired by :func:`multi_lock` (the ones that
+       haven't expired), in one round trip. Returns the number of locks
+       that were released.
+    """
+    if not tokens:
+        return 0
+    r = cn or connect()
+    return _MULTI_RELEASE(r, _multi_lock_keys(tokens),
+                          list(tokens.values()) + [WAKE_TTL_MS])
+
+
+class _Mutex(Lock):
+    """The :class:`Lock` used by :func:`mutex`, it uses the keys of older
+       versions of :func:`mutex` (which stored the expiry timestamp of the
+       lock as its value), so old and new processes exclude each other.
+    """
+    prefix = 'dkredis:mutex:'
+
+    def _new_token(self):
+        # a unique token that can be read as an expiry timestamp (a new
+        # one for every attempt, so it is the expiry of the lock we get)
+        return f'{later(self.ttl):.6f}{random.getrandbits(32):010d}'
 
 
-# XXX: [bp-2023-12-17] No idea what this is supposed to be used for, but it is
-#      definitely not a mutex implementation...
 @contextmanager
 def mutex(name, seconds: int = 30, timeout: int = 60,
-          unlock: bool = True, waitsecs: int = 3):
-    """Lock the ``name`` for ``seconds``, waiting ``waitsecs`` seconds
-       between each attempt at locking the name.  Locking means creating
-       a key 'dkredis:mutex:' + key.
+          unlock: bool = True, waitsecs: int = 3, renew: bool = False,
+          reentrant: bool = False, fencing: bool = False):
+    """Lock the ``name`` for ``seconds`` (a :class:`Lock`).
+
+       It will raise a Timeout exception if the lock couldn't be acquired
+       in ``timeout`` seconds. Waiters are woken up when the lock is
+       released, and re-check it at least every ``waitsecs`` seconds.
 
-       It will raise a Timeout exception if more than ``timeout`` seconds
-       has elapsed.
+       With ``renew=True`` the lock is renewed while the context is
+       active (see :class:`Lock`). With ``reentrant=True`` the same
+       thread can take the mutex again while it holds it (see
+       :class:`RLock`). With ``fencing=True`` the context value is a
+       fencing token (see :class:`Lock`), otherwise None.
 
        Usage::
 
            from dkredis import dkredis
 
-           with dkredis.lock('mymutex'):
+           with dkredis.mutex('mymutex'):
                # mutual exclusion zone ;-)
 
     """
-    # the various time.time() calls can happen at different times.
     if timeout == 0:
         timeout = 60 * 60  # 1 hour
-
-    prefix = 'dkredis:mutex:'
-
-    start = now()
-    r = connect()
-    k = f'{prefix}{name}'
-    expire = start
-
+    if reentrant:
+        lock = RLock(name, ttl=seconds, poll=waitsecs, renew=renew,
+                     fencing=fencing)
+    else:
+        lock = _Mutex(name, ttl=seconds, poll=waitsecs, renew=renew,
+                      fencing=fencing)
+    if not lock.acquire(timeout=timeout):
+        raise Timeout()
     try:
-        while 1:
-            if start + timeout < now():
-                raise Timeout()
-
-            expire = later(seconds)
-            if r.setnx(k, expire):
-                # we have the lock, yield to the context, then exit.
-                yield
-                break
-
-            # we didn't get the lock, but it exists...
-            if float(r.get(k)) > now():
-                # the lock is still valid (someone else has the lock).
-                time.sleep(waitsecs)
-
-            else:
-                # lock has expired, try to grab it...
-                expire = later(timeout)
-                ts = float(r.getset(k, expire))
-                if ts < now():
-                    # we won, yield to the context, then exit.
-                    yield
-                    break
-                # else start again, from the top.
-
+        yield lock.fence
     finally:
-        if unlock and expire < now():
-            # we should unlock, and our lock hasn't expired.
-            r.delete(k)
+        if unlock:
+            lock.release()
+        elif lock.watchdog is not None:
+            lock.watchdog.stop()
@@ -0,0 +1,286 @@
+"""
+Instrumentation of dkredis operations.
+
+Hooks are called for every instrumented operation, with the name of the
+operation, its duration in seconds, and a dict of extra information::
+
+    from dkredis import instrumentation
+
+    def trace(op, seconds, info):
+        ...
+
+    instrumentation.add_hook(trace)
+
+When no hooks are installed, an instrumented operation costs one extra
+function call and a test.
+
+Hook points (``info`` keys in parentheses):
+
+``cache.get``, ``cache.get_many``, ``cache.get_or_compute``, ``cache.put``, ``cache.put_many``, ``cache.invalidate``
+    :class:`dkredis.rediscache.cache` (and the asyncio cache).
+    (``hit``: found in the cache, ``hits``/``misses``: counts for
+    ``get_many``)
+``cache.compute``
+    calling the function of ``get_or_compute``/``cached``.
+``serialize``, ``deserialize``
+    :mod:`dkredis.serializers` (``size``: serialized size in bytes).
+``get_pyval``, ``set_pyval``, ``update``
+    :mod:`dkredis.dkredis` (and :mod:`dkredis.aio`).
+``batch.execute``
+    executing a :func:`dkredis.dkredis.batch`.
+``update.retry``
+    a transaction in ``update`` had to be retried (no duration).
+``lock.acquire``, ``rwlock.read``, ``rwlock.write``
+    time spent acquiring (waiting for) a lock, including ``mutex``
+    (``acquired``: False if it timed out, ``name``: the lock name).
+``ratelimit.check``, ``ratelimit.check_many``
+    :mod:`dkredis.ratelimit` (``allowed``).
+
+All operations that raise an exception have ``error`` (the exception
+class name) in ``info``.
+
+:class:`Metrics` is a hook that aggregates latency histograms, hit/miss
+counts and sizes, and can export them as Prometheus text, or log them.
+:class:`StatsdHook` sends every event to a statsd server over UDP::
+
+    metrics = instrumentation.Metrics()
+    instrumentation.add_hook(metrics)
+    instrumentation.add_hook(instrumentation.StatsdHook('localhost', 8125))
+    ...
+    print(metrics.prometheus())
+
+"""
+import bisect
+import functools
+import inspect
+import logging
+import socket
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+#: The installed hooks (replaced, not mutated, by :func:`add_hook` and
+#: :func:`remove_hook`, so it can be iterated without a lock).
+hooks = ()
+
+
+def add_hook(hook):
+    """Call ``hook(op, seconds, info)`` for every instrumented operation.
+    """
+    global hooks
+    hooks = hooks + (hook,)
+
+
+def remove_hook(hook):
+    """Stop calling ``hook``.
+    """
+    global hooks
+    hooks = tuple(h for h in hooks if h is not hook)
+
+
+def record(op, seconds=0.0, **info):
+    """Report an operation to all hooks (call it only ``if hooks``).
+    """
+    for hook in hooks:
+        try:
+            hook(op, seconds, info)
+        except Exception:
+            log.exception("instrumentation hook %r failed", hook)
+
+
+def instrumented(op, miss=None, info=None):
+    """Decorator that reports calls of the decorated function (or
+       coroutine function) as ``op``.
+
+       If ``miss`` is given (an exception class), calls have ``hit`` in
+       their info, and raising ``miss`` is a miss. ``info(args, kwargs,
+       result)`` returns extra info for successful calls.
+    """
+    def _report(start, args, kw, res, exc):
+        extra = {}
+        if exc is not None:
+            if miss is not None and isinstance(exc, miss):
+                extra['hit'] = False
+            else:
+                extra['error'] = type(exc).__name__
+        else:
+            if miss is not None:
+                extra['hit'] = True
+            if info is not None:
+                extra.update(info(args, kw, res))
+        record(op, time.perf_counter() - start, **extra)
+
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kw):
+                if not hooks:
+                    return await fn(*args, **kw)
+                start = time.perf_counter()
+                try:
+                    res = await fn(*args, **kw)
+                except BaseException as e:
+                    _report(start, args, kw, None, e)
+                    raise
+                _report(start, args, kw, res, None)
+                return res
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kw):
+            if not hooks:
+                return fn(*args, **kw)
+            start = time.perf_counter()
+            try:
+                res = fn(*args, **kw)
+            except BaseException as e:
+                _report(start, args, kw, None, e)
+                raise
+            _report(start, args, kw, res, None)
+            return res
+        return wrapper
+    return decorator
+
+
+#: Upper bounds (seconds) of the latency histogram buckets.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class OpStats:
+    """Aggregated statistics of one operation.
+    """
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.seconds = 0.0
+        self.errors = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        #: number of calls per bucket (the last one is +Inf).
+        self.histogram = [0] * (len(buckets) + 1)
+
+    def as_dict(self):
+        return dict(count=self.count, seconds=self.seconds,
+                    errors=self.errors, hits=self.hits, misses=self.misses,
+                    bytes=self.bytes, histogram=list(self.histogram))
+
+
+class Metrics:
+    """Hook that aggregates the events per operation (see
+       :class:`OpStats`).
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.ops = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, op, seconds, info):
+        with self._lock:
+            stats = self.ops.get(op)
+            if stats is None:
+                stats = self.ops[op] = OpStats(self.buckets)
+            stats.count += 1
+            stats.seconds += seconds
+            stats.histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+            if 'error' in info:
+                stats.errors += 1
+            hit = info.get('hit')
+            if hit is not None:
+                if hit:
+                    stats.hits += 1
+                else:
+                    stats.misses += 1
+            stats.hits += info.get('hits', 0)
+            stats.misses += info.get('misses', 0)
+            stats.bytes += info.get('size', 0)
+
+    def snapshot(self):
+        """Return ``{op: OpStats.as_dict()}``.
+        """
+        with self._lock:
+            return {op: stats.as_dict() for op, stats in self.ops.items()}
+
+    def reset(self):
+        with self._lock:
+            self.ops.clear()
+
+    def prometheus(self, prefix='dkredis'):
+        """The metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = [
+            f'# HELP {prefix}_op_seconds Duration of dkredis operations.',
+            f'# TYPE {prefix}_op_seconds histogram',
+        ]
+        for op, stats in sorted(snapshot.items()):
+            cumulative = 0
+            bounds = [repr(b) for b in self.buckets] + ['+Inf']
+            for bound, n in zip(bounds, stats['histogram']):
+                cumulative += n
+                lines.append(f'{prefix}_op_seconds_bucket'
+                             f'{{op="{op}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_op_seconds_sum{{op="{op}"}} '
+                         f'{stats["seconds"]!r}')
+            lines.append(f'{prefix}_op_seconds_count{{op="{op}"}} '
+                         f'{stats["count"]}')
+        for name, help in [('errors', 'Operations that raised an error.'),
+                           ('hits', 'Cache hits.'),
+                           ('misses', 'Cache misses.'),
+                           ('bytes', 'Bytes (de)serialized.')]:
+            lines.append(f'# HELP {prefix}_op_{name}_total {help}')
+            lines.append(f'# TYPE {prefix}_op_{name}_total counter')
+            for op, stats in sorted(snapshot.items()):
+                lines.append(f'{prefix}_op_{name}_total{{op="{op}"}} '
+                             f'{stats[name]}')
+        return '\n'.join(lines) + '\n'
+
+    def log(self, logger=log, level=logging.INFO):
+        """Log a summary line per operation.
+        """
+        for op, stats in sorted(self.snapshot().items()):
+            mean = stats['seconds'] / stats['count'] * 1000
+            logger.log(level, "%s: count=%d mean=%.3fms errors=%d hits=%d "
+                              "misses=%d bytes=%d", op, stats['count'], mean,
+                       stats['errors'], stats['hits'], stats['misses'],
+                       stats['bytes'])
+
+
+def log_hook(op, seconds, info):
+    """Hook that logs every event (at DEBUG level).
+    """
+    log.debug("%s %.3fms %r", op, seconds * 1000, info)
+
+
+class StatsdHook:
+    """Hook that sends every event to a statsd server (over UDP): a
+       timing (ms), a ``.hit``/``.miss``/``.error`` counter, and the size
+       (as a histogram).
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='dkredis'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def __call__(self, op, seconds, info):
+        name = f'{self.prefix}.{op}'
+        lines = [f'{name}:{seconds * 1000:.3f}|ms']
+        hit = info.get('hit')
+        if hit is not None:
+            lines.append(f'{name}.{"hit" if hit else "miss"}:1|c')
+        if 'error' in info:
+            lines.append(f'{name}.error:1|c')
+        if 'size' in info:
+            lines.append(f'{name}.size:{info["size"]}|h')
+        try:
+            self.sock.sendto('\n'.join(lines).encode('u8'), self.address)
+        except OSError:     # pragma: nocover
+            pass    # metrics are best effort
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,204 @@
+"""
+Bounded in-process (L1) cache in front of :class:`dkredis.rediscache.cache`.
+
+Usage::
+
+    from dkredis.rediscache import cache
+
+    cache.enable_l1(maxbytes=32 * 1024 * 1024, ttl=60)
+
+After this, ``cache.get`` looks in the local L1 cache before asking redis.
+``cache.put`` and ``cache.remove`` publish the changed keys on a redis
+pub/sub channel, and every process with L1 enabled evicts its local copy.
+
+.. Note:: values in the L1 cache are shared between callers, i.e. a
+          value returned from ``cache.get`` must not be mutated.
+
+"""
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+#: The pub/sub channel used to broadcast invalidated redis keys.
+INVALIDATION_CHANNEL = 'dkredis:l1:invalidate'
+
+
+def publish(r, keys, sender='-', channel=INVALIDATION_CHANNEL):
+    """Send a message on ``r`` (a connection or pipeline) telling all
+       processes to evict ``keys`` from their L1 caches.
+    """
+    keys = list(keys)
+    if keys:
+        # (a JSON list: the keys can contain any character)
+        r.publish(channel, json.dumps([sender] + keys))
+
+
+# the L1 caches with a listener thread, restarted in forked children.
+_listening = weakref.WeakSet()
+
+
+def _after_fork_in_child():  # pragma: nocover
+    for l1 in list(_listening):
+        l1._restart()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class L1Cache:
+    """LRU cache with per-key TTL, bounded by the total size (in bytes) of
+       the serialized values it holds.
+    """
+
+    def __init__(self, maxbytes=16 * 1024 * 1024, ttl=60,
+                 channel=INVALIDATION_CHANNEL):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.channel = channel
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._data = OrderedDict()   # key -> (value, size, expires)
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self._listener = None
+        self._redis = None
+        #: identifies messages sent by ourselves
+        self.sender = f'{os.getpid()}.{id(self)}'
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Return the hit/miss/eviction counters.
+        """
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+            keys=len(self._data),
+            nbytes=self.nbytes,
+        )
+
+    @property
+    def epoch(self):
+        """Counter that changes on every invalidation. Read it before
+           fetching a value from redis, and pass it to :meth:`put`.
+        """
+        return self._epoch
+
+    def get(self, key, default=None):
+        """Return the value for ``key``, or ``default`` if it is missing or
+           has expired.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                if item[2] > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return item[0]
+                self._remove(key)
+                self.evictions += 1
+            self.misses += 1
+            return default
+
+    def put(self, key, value, size, ttl=None, epoch=None):
+        """Store ``value`` (whose serialized size is ``size`` bytes) for
+           ``ttl`` seconds (at most ``self.ttl``).
+
+           If ``epoch`` is given and an invalidation has happened since it
+           was read, the value may be stale and is not stored.
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or size > self.maxbytes:
+            return
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                return
+            self._remove(key)
+            self._data[key] = (value, size, time.monotonic() + ttl)
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.nbytes -= item[1]
+
+    def invalidate(self, keys):
+        """Remove ``keys`` from this process' cache.
+        """
+        with self._lock:
+            self._epoch += 1
+            for key in keys:
+                if key in self._data:
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        """Remove everything from this process' cache.
+        """
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+            self.nbytes = 0
+
+    def _on_message(self, message):
+        data = message['data']
+        if isinstance(data, bytes):
+            data = data.decode('u8')
+        sender, *keys = json.loads(data)
+        if sender != self.sender:
+            self.invalidate(keys)
+
+    def _on_error(self, exc, pubsub, thread):  # pragma: nocover
+        # invalidations may have been lost while the connection was down.
+        log.warning("L1 invalidation listener: %r", exc)
+        self.clear()
+        time.sleep(0.1)
+
+    def listen(self, r):
+        """Start a background thread that receives invalidations.
+        """
+        if self._listener is not None:
+            return
+        self._redis = r
+        pubsub = r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: self._on_message})
+        self._listener = pubsub.run_in_thread(
+            sleep_time=1.0, daemon=True, exception_handler=self._on_error
+        )
+        _listening.add(self)
+
+    def _restart(self):
+        """Start a new listener thread in a forked child (threads don't
+           survive a fork, and the values cached before the fork may have
+           been invalidated since).
+        """
+        self._lock = threading.Lock()
+        self._listener = None
+        self.sender = f'{os.getpid()}.{id(self)}'
+        self.clear()
+        self.listen(self._redis)
+
+    def stop(self):
+        """Stop the invalidation listener thread.
+        """
+        _listening.discard(self)
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener.join(timeout=2)
+            self._listener = None
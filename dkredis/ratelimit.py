@@ -0,0 +1,214 @@
+"""
+Rate limiting.
+
+Each check is a single atomic script on the server, using the server's
+clock, so any number of processes can share a limit.
+
+Usage::
+
+    from dkredis import ratelimit
+
+    # at most 100 emails per domain per minute, in bursts of at most 10
+    limiter = ratelimit.GCRA('email', limit=100, period=60, burst=10)
+
+    res = limiter.check('example.com')
+    if not res.allowed:
+        time.sleep(res.retry_after)
+
+    # many resources in one round trip
+    results = limiter.check_many(['example.com', 'example.org'])
+
+Algorithms:
+
+:class:`FixedWindow`
+    at most ``limit`` requests in a window of ``period`` seconds, starting
+    with the first request. Cheapest, but allows up to ``2 * limit``
+    requests around a window boundary.
+:class:`SlidingWindow`
+    at most ``limit`` requests in any ``period`` seconds, approximated by
+    weighting the count of the previous window.
+:class:`GCRA`
+    requests are spread evenly (``limit`` per ``period``), with bursts of
+    at most ``burst`` requests (i.e. a token bucket holding ``burst``
+    tokens, refilled at ``limit / period`` tokens per second).
+
+"""
+from collections import namedtuple
+
+from . import scripts
+from .dkredis import connect
+from .instrumentation import instrumented
+
+#: The result of a check. ``remaining`` is the number of requests that
+#: would be allowed right now, ``retry_after`` the number of seconds until
+#: the request would be allowed (0 if it was allowed).
+RateLimit = namedtuple('RateLimit', 'allowed remaining retry_after')
+
+# All scripts return {allowed (0/1), remaining, retry after (ms)}.
+
+# KEYS[1]: counter, ARGV[1]: limit, ARGV[2]: period (ms), ARGV[3]: cost
+_FIXED_WINDOW = scripts.register('ratelimit_fixed_window', """
+    local limit, cost = tonumber(ARGV[1]), tonumber(ARGV[3])
+    local n = tonumber(redis.call('GET', KEYS[1]) or '0')
+    if n + cost > limit then
+        local pttl = redis.call('PTTL', KEYS[1])
+        if pttl < 0 then
+            pttl = tonumber(ARGV[2])
+        end
+        return {0, math.max(limit - n, 0), pttl}
+    end
+    n = redis.call('INCRBY', KEYS[1], cost)
+    if redis.call('PTTL', KEYS[1]) < 0 then
+        redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    return {1, limit - n, 0}
+""")
+
+# KEYS[1]: hash with the start of the current window and the counts of
+# the current and previous windows, ARGV: as for the fixed window.
+_SLIDING_WINDOW = scripts.register('ratelimit_sliding_window', """
+    local limit, period = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local cost = tonumber(ARGV[3])
+    local t = redis.call('TIME')
+    local now = t[1] * 1000 + math.floor(t[2] / 1000)
+    local start = now - now % period
+    local h = redis.call('HMGET', KEYS[1], 'start', 'cur', 'prev')
+    local cur, prev = tonumber(h[2]) or 0, tonumber(h[3]) or 0
+    local last = tonumber(h[1])
+    if last ~= start then
+        if last == start - period then
+            prev = cur
+        else
+            prev = 0
+        end
+        cur = 0
+    end
+    local elapsed = now - start
+    local count = prev * (period - elapsed) / period + cur
+    if count + cost > limit then
+        local retry
+        if cur + cost > limit then
+            retry = period - elapsed
+        else
+            local weight = (limit - cur - cost) / prev
+            retry = math.ceil(period * (1 - weight)) - elapsed
+        end
+        return {0, math.max(math.floor(limit - count), 0),
+                math.max(retry, 1)}
+    end
+    cur = cur + cost
+    redis.call('HSET', KEYS[1], 'start', start)
+    redis.call('HSET', KEYS[1], 'cur', cur)
+    redis.call('HSET', KEYS[1], 'prev', prev)
+    redis.call('PEXPIRE', KEYS[1], 2 * period)
+    return {1, math.floor(limit - count - cost), 0}
+""")
+
+# KEYS[1]: theoretical arrival time, ARGV[1]: emission interval, ARGV[2]:
+# burst, ARGV[3]: cost. (Times in microseconds, which are still exact as
+# Lua numbers, milliseconds since the epoch would round sub-millisecond
+# intervals away.)
+_GCRA = scripts.register('ratelimit_gcra', """
+    local interval = tonumber(ARGV[1])
+    local tolerance = interval * tonumber(ARGV[2])
+    local t = redis.call('TIME')
+    local now = t[1] * 1000000 + t[2]
+    local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or '0'), now)
+    local newtat = tat + interval * tonumber(ARGV[3])
+    local diff = now - (newtat - tolerance)
+    if diff < 0 then
+        return {0, math.max(math.floor((now - (tat - tolerance)) / interval),
+                            0), math.ceil(-diff / 1000)}
+    end
+    redis.call('SET', KEYS[1], string.format('%.17g', newtat),
+               'PX', math.max(math.ceil((newtat - now) / 1000), 1))
+    return {1, math.floor(diff / interval), 0}
+""")
+
+
+def _allowed(args, kw, res):
+    return {'allowed': res.allowed}
+
+
+def _result(res):
+    return RateLimit(bool(res[0]), int(res[1]), res[2] / 1000.0)
+
+
+class RateLimiter:
+    """Base class of the rate limiters: at most ``limit`` requests per
+       ``period`` seconds for each resource (a string).
+    """
+    prefix = 'dkredis:ratelimit:'
+    script = None
+
+    def __init__(self, name, limit, period, cn=None):
+        self.name = name
+        self.limit = limit
+        self.period = period
+        self._cn = cn
+
+    @property
+    def cn(self):
+        if self._cn is None:
+            self._cn = connect()
+        return self._cn
+
+    def key(self, resource):
+        return f'{self.prefix}{self.name}:{resource}'
+
+    def _args(self, cost):
+        return [self.limit, int(self.period * 1000), cost]
+
+    @instrumented('ratelimit.check', info=_allowed)
+    def check(self, resource, cost=1):
+        """Count a request (of weight ``cost``) for ``resource``, unless
+           that would exceed the limit. Returns a :data:`RateLimit`.
+        """
+        return _result(self.script(self.cn, [self.key(resource)],
+                                   self._args(cost)))
+
+    @instrumented('ratelimit.check_many')
+    def check_many(self, resources, cost=1):
+        """Check all ``resources`` in one round trip, returns a dict
+           ``{resource: RateLimit}``.
+        """
+        resources = list(resources)
+        args = self._args(cost)
+        with self.cn.pipeline(transaction=False) as p:
+            for resource in resources:
+                self.script(p, [self.key(resource)], args)
+            return {resource: _result(res)
+                    for resource, res in zip(resources, scripts.execute(p))}
+
+    def reset(self, resource):
+        """Forget all requests for ``resource``.
+        """
+        self.cn.delete(self.key(resource))
+
+
+class FixedWindow(RateLimiter):
+    """At most ``limit`` requests in each window of ``period`` seconds.
+    """
+    script = _FIXED_WINDOW
+
+
+class SlidingWindow(RateLimiter):
+    """At most ``limit`` requests in any ``period`` seconds (using the
+       sliding window counter approximation).
+    """
+    script = _SLIDING_WINDOW
+
+
+class GCRA(RateLimiter):
+    """Generic cell rate algorithm: ``limit`` requests per ``period``
+       seconds, evenly spaced, with bursts of at most ``burst`` requests
+       (default: ``limit``).
+    """
+    script = _GCRA
+
+    def __init__(self, name, limit, period, burst=None, cn=None):
+        super().__init__(name, limit, period, cn=cn)
+        self.burst = limit if burst is None else burst
+
+    def _args(self, cost):
+        return [repr(self.period * 1e6 / self.limit), self.burst, cost]
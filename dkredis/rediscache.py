@@ -1,16 +1,40 @@
 """
 Object cache implementation using redis as a backend.
 """
+import contextlib
+import functools
+import math
+import os
 import pickle
 import hashlib
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from . import dkredis
+from . import l1cache
+from . import scripts
+from . import serializers
+from .instrumentation import instrumented
+from .utils import unique_id
 import logging
 
+try:
+    from django.conf import settings as _django_settings
+    from django.db import transaction as _django_transaction
+except ImportError:
+    _django_transaction = None
+
 log = logging.getLogger(__name__)
 
 PICLE_PROTOCOL = 1
 REDIS_CACHE_DEBUG = False
 
+#: str/bytes keys up to this length are used verbatim in the redis key,
+#: longer keys (and all other types) are hashed.
+MAX_VERBATIM_KEY_LENGTH = 64
+
 if REDIS_CACHE_DEBUG:
     def writeln(*args, **kw):
         return print(*args, **kw)
@@ -19,17 +43,150 @@ else:
         return None
 
 
-def _cache_serialize(val):
-    """Serialize a python value to go into the cache.
+#: Number of threads refreshing stale values in the background.
+REFRESH_THREADS = 4
+
+_missing = object()
+_refresh_executor = None
+
+#: A cached value, and whether it is fresh (not past its soft expiry).
+CacheEntry = namedtuple('CacheEntry', 'value fresh')
+
+
+def _refresh_in_background(fn, *args):
+    global _refresh_executor
+    if _refresh_executor is None:
+        _refresh_executor = ThreadPoolExecutor(
+            max_workers=REFRESH_THREADS,
+            thread_name_prefix='dkredis-refresh')
+    _refresh_executor.submit(fn, *args)
+
+
+def _after_fork_in_child():
+    # the executor's threads don't exist in the child.
+    global _refresh_executor
+    _refresh_executor = None
+
+
+if hasattr(os, 'register_at_fork'):  # pragma: nocover
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _is_fresh(meta):
+    return not meta or 'x' not in meta or time.time() < meta['x']
+
+
+# The decisions of get_or_compute, shared with the asyncio cache.
+
+def _should_recompute(meta, beta):
+    """Should a cached value (with ``meta``) be recomputed now, i.e. is it
+       stale, or is it time for an early recomputation (XFetch)?
     """
-    return pickle.dumps(val, protocol=PICLE_PROTOCOL)
+    if not (meta and 'x' in meta):
+        return False
+    if not (beta and 'd' in meta):
+        early = 0
+    else:
+        early = meta['d'] * beta * math.log(1.0 - random.random())
+    return time.time() - early >= meta['x']
+
+
+def _computed_meta(duration, stale, delta, generations):
+    """The redis duration and the metadata of a value that took ``delta``
+       seconds to compute.
+    """
+    _duration = _duration_seconds(duration)
+    meta = {'x': time.time() + _duration, 'd': delta}
+    if generations:
+        meta['t'] = generations
+    if stale:
+        _duration += _duration_seconds(stale)
+    return _duration, meta
+
+
+def _poll_delays(timeout):
+    """The delays between the attempts to get a value that someone else
+       is computing, for ``timeout`` seconds (the first attempt is right
+       away).
+    """
+    deadline = time.monotonic() + timeout
+    yield 0
+    delay = 0.01
+    while time.monotonic() <= deadline:
+        yield delay
+        delay = min(delay * 2, 0.25)
+
+
+def _tagged_entry(val, generations):
+    """Deserialize the raw cache value ``val`` to ``(value, meta)``, or
+       return None if it is missing or was stored with other tag
+       generations than ``generations`` (i.e. a tag has been invalidated
+       since).
+    """
+    if val is None:
+        return None
+    value, meta = serializers.loads_meta(val)
+    stored = meta.get('t') if meta else None
+    if stored is None or any(stored.get(tag) != gen
+                             for tag, gen in generations.items()):
+        return None
+    return value, meta
+
+
+def _split_tagged(res, n, tags):
+    """Split the result of an MGET of the ``n`` redis keys of a value and
+       the keys of ``tags`` into ``(raw value, generations)``.
+    """
+    val = next((v for v in res[:n] if v is not None), None)
+    return val, {tag: int(gen or 0) for tag, gen in zip(tags, res[n:])}
+
+
+def _hits_misses(args, kw, res):
+    return {'hits': len(res[0]), 'misses': len(res[1])}
+
+
+def _cache_serialize(val, serializer=None, compression=None, threshold=None,
+                     meta=None):
+    """Serialize (and possibly compress) a python value to go into the cache.
+    """
+    return serializers.dumps(val, serializer, compression, threshold, meta)
 
 
 def _cache_unserialize(val):
-    """Unserialize a python value from the cache.
+    """Unserialize (and decompress if needed) a python value from the cache.
     """
-    # return pickle.loads(zlib.decompress(base64.b64decode(val)))
-    return pickle.loads(val)
+    return serializers.loads(val)
+
+
+@functools.lru_cache(maxsize=4096)
+def _str_rediskey(key):
+    if len(key) <= MAX_VERBATIM_KEY_LENGTH:
+        return 'obj-cache:v2:s:' + key
+    return 'obj-cache:v2:sh:' + hashlib.blake2b(
+        key.encode('u8'), digest_size=16).hexdigest()
+
+
+@functools.lru_cache(maxsize=4096)
+def _legacy_str_rediskey(key):
+    k = pickle.dumps(key, protocol=PICLE_PROTOCOL)
+    return "obj-cache:" + hashlib.md5(k).hexdigest()
+
+
+def _duration_seconds(duration):
+    """Convert a cache duration to an integer number of seconds.
+    """
+    if duration is None:
+        _duration = 30 * 60  # 30 minutes
+    elif hasattr(duration, 'to_int'):
+        # ttcal.Duration
+        _duration = duration.to_int()   # pragma: nocover
+    elif hasattr(duration, 'days') and hasattr(duration, 'seconds'):
+        # datetime.timedelta
+        _duration = duration.days * 24 * 60 * 60 + duration.seconds
+    else:
+        _duration = int(duration)  # try int conversion, throws ValueError
+    assert _duration >= 1  # smallest cache duration is +1 second
+    return _duration
 
 
 class cache:
@@ -49,17 +206,151 @@ class cache:
 
        you can use a datetime value for the valid_until parameter,
        or anything the timeperiod.when() function accepts.
+
+       Values can be tagged (tags are strings), and all values with a tag
+       are invalidated at once with :meth:`invalidate_tags`::
+
+            cache.put(key, v, 3600, tags=[f'customer-{customer.id}'])
+            cache.get(key, tags=[f'customer-{customer.id}'])
+            cache.invalidate_tags([f'customer-{customer.id}'])
+
+       A tagged value stores the generation (a counter) of each of its
+       tags, invalidating a tag increments the counter, and a value
+       stored with an older generation is treated as missing (and expires
+       by itself). Pass the same tags when reading a value as when it was
+       put, the generations are read with the same MGET as the value.
+       (Tagged reads don't use the L1 cache.)
     """
 
     class DoesNotExist(Exception):
         "Value not in cache (possibly due to expiration)."
 
+    #: Name of the serializer used by :meth:`put` (see
+    #: :mod:`dkredis.serializers`), None means the default serializer.
+    #: Subclass to get a cache with a different serializer.
+    serializer = None
+
+    #: Name of the compressor used for values larger than
+    #: ``compress_threshold`` bytes (None: ``serializers.DEFAULT_COMPRESSION``,
+    #: False: never compress).
+    compression = None
+    compress_threshold = None
+
+    #: In-process L1 cache (see :meth:`enable_l1`).
+    l1 = None
+
+    #: Publish removed/changed keys so other processes can evict their L1
+    #: copies (set by :meth:`enable_l1`, can also be set in processes that
+    #: write to the cache without using an L1 cache themselves).
+    publish_invalidations = False
+
+    #: Also read (and remove) values stored under the md5-based keys used
+    #: by older versions (see :meth:`legacy_rediskey`). This can be turned
+    #: off when the longest cache duration has passed after upgrading.
+    legacy_keys = True
+
     @staticmethod
     def rediskey(key):
-        "The redis key is obj-cache. + the md5 hexdigest of its serialization."
-        k = _cache_serialize(key)
+        """The redis key is ``obj-cache:v2:`` + a type prefix + the key
+           itself for short str/bytes/int keys, or a blake2b hexdigest of
+           it (or of its pickle, for other types).
+        """
+        t = type(key)
+        if t is str:
+            return _str_rediskey(key)
+        if t is int:
+            return f'obj-cache:v2:i:{key}'
+        if t is bytes and len(key) <= MAX_VERBATIM_KEY_LENGTH // 2:
+            return 'obj-cache:v2:b:' + key.hex()
+        k = pickle.dumps(key, protocol=4)
+        return 'obj-cache:v2:p:' + hashlib.blake2b(
+            k, digest_size=16).hexdigest()
+
+    @staticmethod
+    def legacy_rediskey(key):
+        "The old redis key: obj-cache. + the md5 hexdigest of its pickle."
+        if type(key) is str:
+            return _legacy_str_rediskey(key)
+        k = pickle.dumps(key, protocol=PICLE_PROTOCOL)
         return "obj-cache:" + hashlib.md5(k).hexdigest()
 
+    @staticmethod
+    def tagkey(tag):
+        "The redis key holding the generation of ``tag``."
+        return 'obj-cache:tag:' + tag
+
+    @classmethod
+    def fencekey(cls, key):
+        "The redis key holding the last fencing token written to ``key``."
+        return 'obj-cache:fence:' + cls.rediskey(key)
+
+    @classmethod
+    def _rediskeys(cls, key):
+        "All redis keys that can hold the value for ``key``."
+        if cls.legacy_keys:
+            return [cls.rediskey(key), cls.legacy_rediskey(key)]
+        return [cls.rediskey(key)]
+
+    @classmethod
+    def enable_l1(cls, maxbytes=16 * 1024 * 1024, ttl=60):
+        """Keep up to ``maxbytes`` (serialized size) of recently read values
+           in-process, for at most ``ttl`` seconds (or the remaining redis
+           TTL if that is shorter).
+        """
+        cls.disable_l1()
+        cls.l1 = l1cache.L1Cache(maxbytes=maxbytes, ttl=ttl)
+        cls.l1.listen(dkredis.connect())
+        cls.publish_invalidations = True
+
+    @classmethod
+    def disable_l1(cls):
+        "Stop using the L1 cache."
+        if cls.l1 is not None:
+            cls.l1.stop()
+            cls.l1 = None
+
+    @classmethod
+    def _write(cls, p, rkeys):
+        """Execute the pipeline ``p`` that changes ``rkeys``, and evict
+           them from L1 caches (ours after the write has happened, so
+           concurrent reads can't re-populate it with the old value).
+        """
+        l1 = cls.l1
+        cls._publish(p, rkeys)
+        res = scripts.execute(p)
+        if l1 is not None:
+            l1.invalidate(rkeys)
+        return res
+
+    @classmethod
+    def _publish(cls, p, rkeys):
+        if cls.publish_invalidations:
+            sender = '-' if cls.l1 is None else cls.l1.sender
+            l1cache.publish(p, rkeys, sender=sender)
+
+    @classmethod
+    def _queue_write(cls, b, fn, rkeys):
+        """Queue ``fn(pipeline)``, that changes ``rkeys``, on the
+           :class:`dkredis.dkredis.Batch` ``b`` (like :meth:`_write`).
+        """
+        l1 = cls.l1
+
+        def queue(p):
+            fn(p)
+            cls._publish(p, rkeys)
+
+        def evict(res):
+            if l1 is not None:
+                l1.invalidate(rkeys)
+        return b.add(queue, evict)
+
+    @classmethod
+    def _serialize(cls, value, serializer=None, compression=None, meta=None):
+        if compression is None:
+            compression = cls.compression
+        return _cache_serialize(value, serializer or cls.serializer,
+                                compression, cls.compress_threshold, meta)
+
     @classmethod
     def ping(cls):
         r = dkredis.connect()
@@ -70,58 +361,271 @@ class cache:
         """Remove key from cache.
         """
         log.debug("CACHE:REMOVE: %r", key)
-        r = dkredis.connect()
-        r.delete(cls.rediskey(key))
+        return cls.remove_many([key])
 
     @classmethod
-    def put(cls, key, value, duration=None):
+    def remove_many(cls, keys):
+        """Remove all ``keys`` from the cache (in one round trip).
+        """
+        return cls.invalidate(keys)
+
+    @classmethod
+    @instrumented('cache.invalidate')
+    def invalidate(cls, keys=(), tags=()):
+        """Remove all ``keys`` from the cache and invalidate all ``tags``
+           (in one round trip).
+        """
+        keys = list(keys)
+        tags = list(tags)
+        if not (keys or tags):
+            return
+        rkeys = [cls.rediskey(key) for key in keys]
+
+        def queue(p):
+            if cls.legacy_keys and keys:
+                p.unlink(*rkeys, *[cls.legacy_rediskey(k) for k in keys])
+            elif keys:
+                p.unlink(*rkeys)
+            for tag in tags:
+                p.incr(cls.tagkey(tag))
+        b = dkredis._batching()
+        if b is not None:
+            return cls._queue_write(b, queue, rkeys)
+        with dkredis.connect().pipeline(transaction=False) as p:
+            queue(p)
+            cls._write(p, rkeys)
+
+    @classmethod
+    def invalidate_tags(cls, tags):
+        """Invalidate all values tagged with any of ``tags`` (one INCR per
+           tag, in one round trip).
+        """
+        cls.invalidate(tags=tags)
+
+    @classmethod
+    def _tag_generations(cls, tags):
+        "The current generations of ``tags``: ``{tag: int}``."
+        gens = dkredis.connect().mget([cls.tagkey(tag) for tag in tags])
+        return {tag: int(gen or 0) for tag, gen in zip(tags, gens)}
+
+    @classmethod
+    @instrumented('cache.put')
+    def put(cls, key, value, duration=None, serializer=None,
+            compression=None, stale=None, tags=None):
         """Put ``value`` in cache, under ``key``, for ``duration`` seconds.
+
+           ``serializer`` and ``compression`` override the cache's
+           serializer and compressor for this value.
+
+           With ``stale``, the value is kept ``stale`` seconds longer, and
+           is served as stale while it is being refreshed (see
+           :meth:`get_entry` and :meth:`get_or_compute`).
+
+           ``tags`` is a list of tags for the value.
         """
+        meta = None
+        if stale:
+            duration = _duration_seconds(duration)
+            meta = {'x': time.time() + duration}
+            duration += _duration_seconds(stale)
+        if tags:
+            meta = dict(meta or {}, t=cls._tag_generations(tags))
+        return cls._put(key, value, duration, serializer, compression, meta)
+
+    @classmethod
+    def _put(cls, key, value, duration=None, serializer=None,
+             compression=None, meta=None, batched=True):
         # writeln("CACHE:PUT[%r] = [[%r]] @%r" % (key, value, duration))
-        log.debug("CACHE:PUT[%r] = [[%r]] @%r", key, value, duration)
-        if duration is None:
-            _duration = 30 * 60  # 30 minutes
-        elif hasattr(duration, 'to_int'):
-            # ttcal.Duration
-            _duration = duration.to_int()   # pragma: nocover
-        elif hasattr(duration, 'days') and hasattr(duration, 'seconds'):
-            # datetime.timedelta
-            _duration = duration.days * 24 * 60 * 60 + duration.seconds
-        else:
-            _duration = int(duration)  # try int conversion, throws ValueError
-        assert _duration >= 1  # smallest cache duration is +1 second
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("CACHE:PUT[%r] = [[%r]] @%r", key, value, duration)
+        _duration = _duration_seconds(duration)
 
         # no need to remove an existing key...
         # cls.remove(key)
 
         k = cls.rediskey(key)
-        v = _cache_serialize(value)
+        v = cls._serialize(value, serializer, compression, meta)
+
+        def queue(p):
+            p.set(k, v, ex=_duration)
+            if cls.legacy_keys:
+                # don't let an older value re-appear when this one expires
+                p.unlink(cls.legacy_rediskey(key))
+        b = dkredis._batching() if batched else None
+        if b is not None:
+            return cls._queue_write(b, queue, [k])
 
         r = dkredis.connect()
         # writeln("....cache:put:setex(%r, %r, %r) for %r" % (
         #     k, _duration, v, key
         # ))
-        log.debug("....cache:put:setex(%r, %r, %r) for %r",
-                  k, _duration, v, key)
-        r.set(k, v, ex=_duration)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("....cache:put:setex(%r, %r, %r) for %r",
+                      k, _duration, v, key)
+        if cls.l1 is None and not (cls.publish_invalidations
+                                   or cls.legacy_keys):
+            r.set(k, v, ex=_duration)
+            return
+        with r.pipeline(transaction=False) as p:
+            queue(p)
+            cls._write(p, [k])
+
+    @classmethod
+    def put_fenced(cls, key, value, fence, duration=None, serializer=None,
+                   compression=None):
+        """Put ``value`` in cache (like :meth:`put`), unless the cached
+           value was written with a newer fencing token than ``fence``
+           (see :func:`dkredis.dkredis.set_pyval_fenced`).
+
+           Returns True if the value was written.
+        """
+        k = cls.rediskey(key)
+        v = cls._serialize(value, serializer, compression)
+        with dkredis.connect().pipeline(transaction=False) as p:
+            dkredis._fenced_set(p, k, v, fence, _duration_seconds(duration),
+                                cls.fencekey(key))
+            if cls.legacy_keys:
+                p.unlink(cls.legacy_rediskey(key))
+            return bool(cls._write(p, [k])[0])
+
+    @classmethod
+    @instrumented('cache.put_many')
+    def put_many(cls, mapping, duration=None, serializer=None,
+                 compression=None):
+        """Put all ``key: value`` pairs from ``mapping`` in the cache, for
+           ``duration`` seconds (in one round trip).
+        """
+        _duration = _duration_seconds(duration)
+        with dkredis.connect().pipeline(transaction=False) as p:
+            rkeys = []
+            for key, value in mapping.items():
+                rkey = cls.rediskey(key)
+                rkeys.append(rkey)
+                p.set(rkey, cls._serialize(value, serializer, compression),
+                      ex=_duration)
+            if cls.legacy_keys and mapping:
+                p.unlink(*[cls.legacy_rediskey(key) for key in mapping])
+            cls._write(p, rkeys)
 
     @classmethod
     def _raw_get(cls, key):
         r = dkredis.connect()
+        if not cls.legacy_keys:
+            return r.get(cls.rediskey(key))
+        val, legacy_val = r.mget(cls._rediskeys(key))
+        return legacy_val if val is None else val
+
+    @classmethod
+    def _raw_get_with_pttl(cls, key):
+        """Return ``(value, pttl)``, using a single round trip.
+        """
+        with dkredis.connect().pipeline(transaction=False) as p:
+            for rkey in cls._rediskeys(key):
+                p.get(rkey)
+                p.pttl(rkey)
+            res = p.execute()
+        for i in range(0, len(res), 2):
+            if res[i] is not None:
+                return res[i:i + 2]
+        return None, -2
+
+    @classmethod
+    def _raw_get_tagged(cls, key, tags):
+        """Return ``(value, generations)``: the raw value for ``key`` and
+           the current generations of ``tags``, with a single MGET.
+        """
+        rkeys = cls._rediskeys(key)
+        res = dkredis.connect().mget(rkeys + [cls.tagkey(t) for t in tags])
+        return _split_tagged(res, len(rkeys), tags)
+
+    @classmethod
+    def _tagged_lookup(cls, key, tags):
+        res = _tagged_entry(*cls._raw_get_tagged(key, tags))
+        if res is None:
+            raise cls.DoesNotExist(
+                "Value not in cache (possibly due to expiration).")
+        return res
+
+    @staticmethod
+    def _l1_put(l1, rkey, val, pttl, epoch):
+        """Deserialize the raw value ``val`` to ``(value, meta)``, and keep
+           that in ``l1`` (at most for ``pttl`` ms).
+        """
+        entry = serializers.loads_meta(val)
+        ttl = pttl / 1000.0
+        meta = entry[1]
+        if meta and 'x' in meta:
+            # never keep a (soon to be) stale value in the L1 cache
+            ttl = min(ttl, meta['x'] - time.time())
+        l1.put(rkey, entry, len(val), ttl, epoch)
+        return entry
+
+    @classmethod
+    def _l1_get(cls, l1, key):
+        """Return ``(value, meta)`` for ``key`` from ``l1``, or from redis
+           (and keep it in ``l1``).
+        """
         rkey = cls.rediskey(key)
-        log.debug("KEY: %s, TTL: %r", key, r.ttl(rkey))
-        return r.get(rkey)
+        entry = l1.get(rkey, _missing)
+        if entry is not _missing:
+            return entry
+        epoch = l1.epoch
+        val, pttl = cls._raw_get_with_pttl(key)
+        if val is None:
+            raise cls.DoesNotExist(
+                "Value not in cache (possibly due to expiration).")
+        return cls._l1_put(l1, rkey, val, pttl, epoch)
+
+    @classmethod
+    def _batched_get(cls, b, key, tags=None, default=_missing):
+        """Queue a :meth:`get` (or a :meth:`get_value`, with a
+           ``default``) on the :class:`dkredis.dkredis.Batch` ``b``.
+        """
+        if cls.l1 is not None and not tags:
+            # (values read in a batch aren't added to the L1 cache)
+            entry = cls.l1.get(cls.rediskey(key), _missing)
+            if entry is not _missing:
+                return b.done(entry[0])
+        rkeys = cls._rediskeys(key)
+        tags = list(tags or ())
+
+        def convert(res):
+            val, generations = _split_tagged(res[0], len(rkeys), tags)
+            if tags:
+                entry = _tagged_entry(val, generations)
+                if entry is not None:
+                    return entry[0]
+            elif val is not None:
+                return _cache_unserialize(val)
+            if default is not _missing:
+                return default
+            raise cls.DoesNotExist(
+                "Value not in cache (possibly due to expiration).")
+        return b.add(
+            lambda p: p.mget(rkeys + [cls.tagkey(t) for t in tags]), convert)
 
     @classmethod
-    def get(cls, key):
-        "Fetch value for ``key`` from redis."
+    @instrumented('cache.get', miss=DoesNotExist)
+    def get(cls, key, tags=None):
+        """Fetch value for ``key`` from the L1 cache (if enabled) or redis.
+           Values stored before one of their ``tags`` was invalidated are
+           missing.
+        """
+        b = dkredis._batching()
+        if b is not None:
+            return cls._batched_get(b, key, tags)
+        if tags:
+            return cls._tagged_lookup(key, tags)[0]
+        if cls.l1 is not None:
+            return cls._l1_get(cls.l1, key)[0]
         val = cls._raw_get(key)
         if val is not None:
             res = _cache_unserialize(val)
             # import json
             # writeln("CACHE:GET(%r) => %s" % (key, json.dumps(res, indent=4)))
             # writeln("CACHE:GET(%r) => %r" % (key, res))
-            log.debug("CACHE:GET(%r) => %r", key, res)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("CACHE:GET(%r) => %r", key, res)
             return res
         # writeln("CACHE:GET(%r) => NOT-FOUND" % key)
         log.debug("CACHE:GET(%r) => NOT-FOUND", key)
@@ -129,12 +633,188 @@ class cache:
             "Value not in cache (possibly due to expiration).")
 
     @classmethod
-    def get_value(cls, key, default=None):
+    def get_with_ttl(cls, key):
+        """Fetch value for ``key`` and its remaining time to live (in
+           seconds, as a float) in a single round trip.
+
+           This is a diagnostic aid, use :meth:`get` on hot paths.
+        """
+        val, pttl = cls._raw_get_with_pttl(key)
+        if val is None:
+            raise cls.DoesNotExist(
+                "Value not in cache (possibly due to expiration).")
+        return _cache_unserialize(val), pttl / 1000.0
+
+    @classmethod
+    def get_value(cls, key, default=None, tags=None):
+        b = dkredis._batching()
+        if b is not None:
+            return cls._batched_get(b, key, tags, default)
         try:
-            return cls.get(key)
+            return cls.get(key, tags)
         except cls.DoesNotExist:
             return default
 
+    @classmethod
+    def _lookup(cls, key, tags=None):
+        """Return ``(value, meta)`` for ``key`` (``meta`` is None for
+           values from the L1 cache or without metadata).
+        """
+        if tags:
+            return cls._tagged_lookup(key, tags)
+        if cls.l1 is not None:
+            return cls._l1_get(cls.l1, key)
+        val = cls._raw_get(key)
+        if val is None:
+            raise cls.DoesNotExist(
+                "Value not in cache (possibly due to expiration).")
+        return serializers.loads_meta(val)
+
+    @classmethod
+    def get_entry(cls, key, tags=None):
+        """Fetch a :class:`CacheEntry` with the value for ``key`` and
+           whether it is fresh (values put with ``stale`` are served stale
+           after ``duration`` seconds).
+        """
+        value, meta = cls._lookup(key, tags)
+        return CacheEntry(value, _is_fresh(meta))
+
+    @classmethod
+    @instrumented('cache.compute')
+    def _compute(cls, key, fn, duration, stale=None, tags=None):
+        """Call ``fn()`` and cache the result (with the metadata needed
+           for early recomputation).
+        """
+        # the generations from before the computation, so the value is
+        # stale if a tag is invalidated while it is being computed.
+        gens = cls._tag_generations(tags) if tags else None
+        start = time.perf_counter()
+        value = fn()
+        _duration, meta = _computed_meta(
+            duration, stale, time.perf_counter() - start, gens)
+        # (not batched: the value must be there when the fetch lock is
+        # released, for the callers waiting for it)
+        cls._put(key, value, _duration, meta=meta, batched=False)
+        return value
+
+    @classmethod
+    def _poll(cls, key, tags=None):
+        """Return ``(value, meta)`` if ``key`` has been computed (by
+           someone else), otherwise None.
+        """
+        if tags:
+            return _tagged_entry(*cls._raw_get_tagged(key, tags))
+        val = dkredis.connect().get(cls.rediskey(key))
+        return None if val is None else serializers.loads_meta(val)
+
+    @classmethod
+    def _refresh(cls, key, fn, duration, stale, lockkey, token, tags=None):
+        try:
+            cls._compute(key, fn, duration, stale, tags)
+        except Exception:
+            log.exception("CACHE:REFRESH(%r) failed", key)
+        finally:
+            dkredis.remove_if(lockkey, token)
+
+    @classmethod
+    @instrumented('cache.get_or_compute')
+    def get_or_compute(cls, key, fn, duration=None, lock_timeout=30,
+                       wait=None, beta=1.0, stale=None, background=False,
+                       tags=None):
+        """Return the cached value for ``key``, or compute it with ``fn()``
+           and cache it for ``duration`` seconds.
+
+           Only one caller (in any process) computes a missing value, the
+           others wait (polling) for up to ``wait`` seconds (default:
+           ``lock_timeout``) for its result, before computing it
+           themselves. ``lock_timeout`` should be longer than ``fn()``
+           takes.
+
+           A value can also be recomputed before it expires, with a
+           probability that grows as the expiry gets closer and with the
+           time ``fn()`` took (XFetch, see Vattani et al., "Optimal
+           Probabilistic Cache Stampede Prevention"). Meanwhile, other
+           callers get the current value. ``beta > 1`` favors earlier
+           recomputation, ``beta=0`` turns it off.
+
+           With ``stale`` (stale-while-revalidate), the value is kept for
+           ``stale`` seconds after it expires. During that time, one
+           caller recomputes it while everyone else gets the stale value
+           immediately. With ``background=True`` the stale value is
+           returned to that caller too, and the value is recomputed in a
+           background thread.
+
+           ``tags`` are the tags of the value (see :meth:`put`).
+        """
+        try:
+            value, meta = cls._lookup(key, tags)
+        except cls.DoesNotExist:
+            value = _missing
+        else:
+            if not _should_recompute(meta, beta):
+                return value
+
+        lockkey = 'dkredis:fetchlock:' + cls.rediskey(key)
+        r = dkredis.connect()
+        for delay in _poll_delays(lock_timeout if wait is None else wait):
+            if delay:
+                time.sleep(delay)
+                res = cls._poll(key, tags)
+                if res is not None:
+                    return res[0]
+            token = unique_id()
+            if r.set(lockkey, token, px=int(lock_timeout * 1000), nx=True):
+                if background and value is not _missing:
+                    _refresh_in_background(cls._refresh, key, fn, duration,
+                                           stale, lockkey, token, tags)
+                    return value
+                try:
+                    return cls._compute(key, fn, duration, stale, tags)
+                finally:
+                    dkredis.remove_if(lockkey, token, cn=r)
+            if value is not _missing:
+                return value    # someone else is re-computing it
+
+        # the process holding the lock didn't finish in time.
+        log.warning("CACHE:GET_OR_COMPUTE(%r): gave up waiting", key)
+        return cls._compute(key, fn, duration, stale, tags)
+
+    @classmethod
+    @instrumented('cache.get_many', info=_hits_misses)
+    def get_many(cls, keys):
+        """Fetch the values for all ``keys`` with a single MGET.
+
+           Returns a tuple ``(hits, misses)``, where ``hits`` is a dict
+           ``{key: value}`` and ``misses`` is the set of keys that were
+           not in the cache.
+        """
+        keys = list(keys)
+        hits = {}
+        misses = set()
+        l1 = cls.l1
+        if l1 is not None:
+            for key in keys:
+                entry = l1.get(cls.rediskey(key), _missing)
+                if entry is not _missing:
+                    hits[key] = entry[0]
+            keys = [key for key in keys if key not in hits]
+        if not keys:
+            return hits, misses
+        rkeys = [cls.rediskey(key) for key in keys]
+        if cls.legacy_keys:
+            rkeys += [cls.legacy_rediskey(key) for key in keys]
+        vals = dkredis.connect().mget(rkeys)
+        if cls.legacy_keys:
+            n = len(keys)
+            vals = [legacy if val is None else val
+                    for val, legacy in zip(vals[:n], vals[n:])]
+        for key, val in zip(keys, vals):
+            if val is None:
+                misses.add(key)
+            else:
+                hits[key] = _cache_unserialize(val)
+        return hits, misses
+
 
 class djangocache:
     "Django facade to the rediscache."
@@ -147,6 +827,91 @@ class djangocache:
     def set(cls, key, value, duration):
         cache.put(key, value, duration)
 
+    @classmethod
+    def get_many(cls, keys):
+        return cache.get_many(keys)[0]
+
+    @classmethod
+    def set_many(cls, mapping, duration):
+        cache.put_many(mapping, duration)
+
+    @classmethod
+    def delete_many(cls, keys):
+        cache.remove_many(keys)
+
+
+class _PendingInvalidations(threading.local):
+    """The invalidations collected by the current
+       :func:`invalidation_batch` (of this thread).
+    """
+    def __init__(self):
+        self.keys = {}      # rediskey -> key
+        self.tags = set()
+        self.depth = 0      # nesting level of invalidation_batch()
+
+
+_pending = _PendingInvalidations()
+
+
+def _on_commit(fn):
+    """Call ``fn()`` when the current Django transaction commits (right
+       away if there is none, or Django isn't used).
+    """
+    if (_django_transaction is not None and _django_settings.configured
+            and _django_settings.DATABASES):   # pragma: nocover
+        _django_transaction.on_commit(fn)
+    else:
+        fn()
+
+
+def _invalidate_on_commit(keys, tags):
+    # the keys and tags are bound to the callback, so they are dropped
+    # (with the callback) if the transaction is rolled back.
+    keys = list(keys)
+    tags = list(tags)
+    if keys or tags:
+        _on_commit(lambda: cache.invalidate(keys, tags))
+
+
+def _defer_invalidation(keys, tags):
+    """Remove ``keys`` and invalidate ``tags`` after the current
+       transaction commits, or when the current :func:`invalidation_batch`
+       ends.
+    """
+    if not _pending.depth:
+        _invalidate_on_commit(keys, tags)
+        return
+    for key in keys:
+        _pending.keys[cache.rediskey(key)] = key
+    _pending.tags.update(tags)
+
+
+@contextlib.contextmanager
+def invalidation_batch():
+    """Collect the invalidations done by :class:`Cached` objects, and
+       do them all in one round trip at the end (after the current Django
+       transaction commits). E.g. in a middleware, to get one flush per
+       request::
+
+           def cache_invalidation_middleware(get_response):
+               def middleware(request):
+                   with invalidation_batch():
+                       return get_response(request)
+               return middleware
+
+    """
+    _pending.depth += 1
+    try:
+        yield
+    finally:
+        _pending.depth -= 1
+        if not _pending.depth:
+            keys = list(_pending.keys.values())
+            tags = list(_pending.tags)
+            _pending.keys.clear()
+            _pending.tags.clear()
+            _invalidate_on_commit(keys, tags)
+
 
 class Cached:
     """Mixin class to invalidate cache keys on model.save().
@@ -161,26 +926,89 @@ class Cached:
 
        (that's it.  All cache keys will be removed whenever `MyModel.save()` is
        called).
+
+       All ``cache_tags`` (see :class:`cache`) are invalidated too. The
+       invalidation is done after the save, when the current transaction
+       commits (with Django, nothing is invalidated if it is rolled back),
+       and is batched with the other invalidations in the current
+       :func:`invalidation_batch`.
     """
     cache_keys = []
+    cache_tags = []
 
     def save(self, *args, **kwargs):
-        for ckey in self.cache_keys:
-            cache.remove(ckey)
         super().save(*args, **kwargs)
+        self.invalidate_cache()
+
+    def invalidate_cache(self):
+        """Remove the ``cache_keys`` and invalidate the ``cache_tags`` of
+           this object (deferred, see :class:`Cached`).
+        """
+        _defer_invalidation(self.cache_keys, self.cache_tags)
+
+    @classmethod
+    def bulk_invalidate(cls, objs):
+        """Invalidate the cache of all ``objs`` (e.g. after a
+           ``bulk_update()``), in one round trip.
+        """
+        keys = []
+        tags = []
+        for obj in objs:
+            keys.extend(obj.cache_keys)
+            tags.extend(obj.cache_tags)
+        _defer_invalidation(keys, tags)
 
     def get_cache_values(self):
-        """Get all cached values for this object.
+        """Get all cached values for this object (values stored before
+           one of the ``cache_tags`` was invalidated are missing, so the
+           values should be put with the ``cache_tags``).
 
            .. Note:: returns None both for keys that are None and
                      non-existant keys!
         """
-        return {ckey: cache.get_value(ckey) for ckey in self.cache_keys}
+        return {ckey: cache.get_value(ckey, tags=self.cache_tags)
+                for ckey in self.cache_keys}
+
+
+def _cached_tags(tags, args, kws):
+    """The tags for the call ``func(*args, **kws)``, as specified by the
+       ``tags`` argument to :func:`cached`.
+    """
+    if callable(tags):
+        return tags(*args, **kws)
+    return tags
+
+
+def _cached_key(cache_key, func, timeout, args, kws):
+    """The cache key for the call ``func(*args, **kws)``, as specified by
+       the ``cache_key`` argument to :func:`cached`.
+    """
+    if isinstance(cache_key, str):
+        return cache_key % locals()
+    elif callable(cache_key):
+        return cache_key(*args, **kws)
+    else:
+        return hashlib.sha1((
+            str(func.__module__)
+            + str(func.__name__)
+            + str(args)
+            + str(kws)
+            ).encode('u8')
+        ).hexdigest()
 
 
-def cached(cache_key=None, timeout=3600):
+def cached(cache_key=None, timeout=3600, lock_timeout=30, beta=1.0,
+           stale=None, background=False, tags=None):
     """Function result cache decorator.
 
+       Concurrent calls with a missing cache value only call the function
+       once, see :meth:`cache.get_or_compute` for ``lock_timeout``,
+       ``beta``, ``stale`` and ``background``.
+
+       ``tags`` is a list of tags (see :class:`cache`), or a function
+       returning the tags given the same arguments as the decorated
+       function.
+
        Usage::
 
            @cached()
@@ -194,30 +1022,18 @@ def cached(cache_key=None, timeout=3600):
                def get_root(self):
                    return MenuItem.objects.get(pk=1)
 
-           @cached(lambda u: 'user_privileges_%s' % u.username, 3600)
+           @cached(lambda u: 'user_privileges_%s' % u.username, 3600,
+                   tags=lambda u: ['customer-%s' % u.customer_id])
            def get_user_privileges(user):
                #...
     """
     def _cached(func):
         def do_cache(*args, **kws):
-            if isinstance(cache_key, str):
-                key = cache_key % locals()
-            elif callable(cache_key):
-                key = cache_key(*args, **kws)
-            else:
-                key = hashlib.sha1((
-                    str(func.__module__)
-                    + str(func.__name__)
-                    + str(args)
-                    + str(kws)
-                    ).encode('ascii')
-                ).hexdigest()
-            # key = "FNCACHED-" + key
-            try:
-                return cache.get(key)
-            except cache.DoesNotExist:
-                data = func(*args, **kws)
-                cache.put(key, data, timeout)
-                return data
+            key = _cached_key(cache_key, func, timeout, args, kws)
+            return cache.get_or_compute(
+                key, lambda: func(*args, **kws), timeout,
+                lock_timeout=lock_timeout, beta=beta,
+                stale=stale, background=background,
+                tags=_cached_tags(tags, args, kws))
         return do_cache
     return _cached
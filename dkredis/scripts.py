@@ -0,0 +1,212 @@
+"""
+Registry of the Lua scripts that dkredis runs on the redis server.
+
+Scripts are called with EVALSHA, so the script source is only sent to
+(and compiled by) the server the first time it is used on that server,
+or after a ``SCRIPT FLUSH``/restart, when the server answers NOSCRIPT
+and the script is loaded again transparently.
+
+In a pipeline, a script is checked (``SCRIPT EXISTS``, and loaded if
+needed) before the pipeline is executed only until it is known to be
+loaded on the server of the pipeline's connection pool, after that the
+pipeline is sent in a single round trip. Execute pipelines that call
+scripts with :func:`execute` (or :func:`execute_async`), which loads
+the scripts the server has lost since then (after a ``SCRIPT FLUSH``
+or a restart) and runs their calls again.
+
+Usage::
+
+    from dkredis import scripts
+
+    REMOVE_IF = scripts.register('remove_if', '''
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    ''')
+
+    REMOVE_IF(r, [key], [val])                  # connection or pipeline
+    await REMOVE_IF.call_async(r, [key], [val])  # asyncio connection
+
+    with r.pipeline(transaction=False) as p:
+        REMOVE_IF(p, [key], [val])
+        scripts.execute(p)
+
+"""
+import hashlib
+import weakref
+
+import redis as _redis
+from redis.asyncio.client import Pipeline as _AsyncPipeline
+from redis.client import Pipeline as _Pipeline
+
+# name -> Script
+_scripts = {}
+
+# connection pool -> the shas of the scripts known to be loaded on its
+# server
+_loaded = weakref.WeakKeyDictionary()
+
+
+def _loaded_shas(r):
+    return _loaded.setdefault(r.connection_pool, set())
+
+
+class Script:
+    """A Lua script, identified by the SHA1 of its source.
+
+       (``sha`` and ``script`` are the attributes redis-py uses to load
+       the scripts of a pipeline before executing it.)
+    """
+
+    def __init__(self, name, source):
+        self.name = name
+        self.script = source.encode('u8') if isinstance(source, str) else source
+        self.sha = hashlib.sha1(self.script).hexdigest()
+
+    def __repr__(self):
+        return f'<Script {self.name} {self.sha[:8]}>'
+
+    def __call__(self, r, keys=(), args=()):
+        """Run the script on ``r`` (a connection or a pipeline).
+        """
+        keys = list(keys)
+        if isinstance(r, _Pipeline):
+            self._check_before_execute(r)
+            return r.evalsha(self.sha, len(keys), *keys, *args)
+        try:
+            res = r.evalsha(self.sha, len(keys), *keys, *args)
+        except _redis.exceptions.NoScriptError:
+            _loaded_shas(r).clear()
+            r.script_load(self.script)
+            res = r.evalsha(self.sha, len(keys), *keys, *args)
+        _loaded_shas(r).add(self.sha)
+        return res
+
+    async def call_async(self, r, keys=(), args=()):
+        """Run the script on ``r`` (an asyncio connection or pipeline).
+        """
+        keys = list(keys)
+        if isinstance(r, _AsyncPipeline):
+            self._check_before_execute(r)
+            return r.evalsha(self.sha, len(keys), *keys, *args)
+        try:
+            res = await r.evalsha(self.sha, len(keys), *keys, *args)
+        except _redis.exceptions.NoScriptError:
+            _loaded_shas(r).clear()
+            await r.script_load(self.script)
+            res = await r.evalsha(self.sha, len(keys), *keys, *args)
+        _loaded_shas(r).add(self.sha)
+        return res
+
+    def _check_before_execute(self, p):
+        loaded = _loaded_shas(p)
+        if self.sha not in loaded:
+            p.scripts.add(self)     # loaded (if needed) before execute()
+            loaded.add(self.sha)
+
+
+def register(name, source):
+    """Register the Lua script ``source`` under ``name``, and return it
+       as a callable :class:`Script`.
+    """
+    script = Script(name, source)
+    existing = _scripts.get(name)
+    if existing is not None:
+        if existing.sha != script.sha:
+            raise ValueError(f'a different script is registered as {name!r}')
+        return existing
+    _scripts[name] = script
+    return script
+
+
+def get(name):
+    """Return the script registered under ``name``.
+    """
+    return _scripts[name]
+
+
+def registered():
+    """Return the names of the registered scripts.
+    """
+    return list(_scripts)
+
+
+def _lost(p, stack, results):
+    """The ``[(index, script)]`` of the script calls in ``stack`` that
+       failed because the server has lost their script.
+    """
+    by_sha = {script.sha: script for script in _scripts.values()}
+    lost = [(i, by_sha.get(args[1]))
+            for i, ((args, _), res) in enumerate(zip(stack, results))
+            if isinstance(res, _redis.exceptions.NoScriptError)]
+    if lost:
+        _loaded_shas(p).clear()
+    return [(i, script) for i, script in lost if script is not None]
+
+
+def _queue_retry(p, stack, lost):
+    scripts = {script.sha: script for _, script in lost}
+    for script in scripts.values():
+        p.script_load(script.script)
+    for i, _ in lost:
+        args, options = stack[i]
+        p.execute_command(*args, **options)
+    return len(scripts)
+
+
+def _merge_retry(p, results, lost, retried):
+    for (i, script), res in zip(lost, retried):
+        results[i] = res
+        _loaded_shas(p).add(script.sha)
+
+
+def _raise_first_error(results):
+    for res in results:
+        if isinstance(res, Exception):
+            raise res
+
+
+def execute(p, raise_on_error=True):
+    """Execute the pipeline ``p`` (like ``p.execute()``, for pipelines
+       with ``transaction=False``).
+
+       The script calls that fail because the server has lost their
+       script (after a ``SCRIPT FLUSH`` or a restart) are run again, after
+       the other commands of the pipeline, when the script is loaded.
+    """
+    stack = list(p.command_stack)
+    results = p.execute(raise_on_error=False)
+    lost = _lost(p, stack, results)
+    if lost:
+        n = _queue_retry(p, stack, lost)
+        _merge_retry(p, results, lost, p.execute(raise_on_error=False)[n:])
+    if raise_on_error:
+        _raise_first_error(results)
+    return results
+
+
+async def execute_async(p, raise_on_error=True):
+    """Execute the asyncio pipeline ``p`` (see :func:`execute`).
+    """
+    stack = list(p.command_stack)
+    results = await p.execute(raise_on_error=False)
+    lost = _lost(p, stack, results)
+    if lost:
+        n = _queue_retry(p, stack, lost)
+        retried = await p.execute(raise_on_error=False)
+        _merge_retry(p, results, lost, retried[n:])
+    if raise_on_error:
+        _raise_first_error(results)
+    return results
+
+
+def load(r):
+    """Load all registered scripts on the server ``r`` is connected to
+       (in one round trip), e.g. to warm up a new server.
+    """
+    with r.pipeline(transaction=False) as p:
+        for script in _scripts.values():
+            p.script_load(script.script)
+        p.execute()
+    _loaded_shas(r).update(script.sha for script in _scripts.values())
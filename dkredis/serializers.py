@@ -0,0 +1,253 @@
+"""
+Serialization of the python values that dkredis stores in redis.
+
+Serialized values start with a one-byte format tag, so the reader knows
+how to deserialize them. Values without a known tag are pickles written
+by older versions of dkredis (which used pickle protocol 1), and are
+still readable.
+
+Usage::
+
+    from dkredis import serializers
+
+    data = serializers.dumps({'hello': 'world'}, 'json')
+    serializers.loads(data)   # ==> {'hello': 'world'}
+
+Available serializers:
+
+``pickle``
+    any picklable value, using the highest pickle protocol (the default).
+``marshal``
+    plain data (None, bool, int, float, str, bytes, list, tuple, dict,
+    set). Fast, but the format can change between Python versions.
+``json``
+    JSON-safe values (tuples come back as lists). Uses ``orjson`` if it
+    is installed.
+``msgpack``
+    JSON-safe values and bytes, only available if ``msgpack`` is
+    installed.
+
+Serialized values that are larger than ``threshold`` bytes can be
+compressed, the compressed value starts with a second one-byte tag
+identifying the compressor, and is only decompressed when it is read::
+
+    data = serializers.dumps(html, compression='zlib', threshold=1024)
+
+Available compressors: ``zlib`` and ``lzma`` (stdlib), ``zstd`` (if
+``zstandard`` is installed) and ``lz4`` (if ``lz4`` is installed).
+
+Finally, a value can carry a small dict of metadata (e.g. when it was
+computed), stored in a header in front of the (compressed) value::
+
+    data = serializers.dumps(val, meta={'x': expires})
+    serializers.loads_meta(data)   # ==> (val, {'x': expires})
+
+"""
+import json
+import lzma
+import marshal
+import pickle
+import zlib
+
+from .instrumentation import instrumented
+
+#: The serializer used when none is specified.
+DEFAULT_SERIALIZER = 'pickle'
+
+#: Pickle protocol used by the ``pickle`` serializer.
+PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+#: The compressor used when none is specified (None: don't compress).
+DEFAULT_COMPRESSION = None
+
+#: Only compress serialized values larger than this (bytes).
+COMPRESS_THRESHOLD = 16 * 1024
+
+#: Tag of the metadata header.
+META_TAG = b'\x1f'
+
+# name -> (tag, dumps, loads) and tag (int) -> (name, loads)
+_serializers = {}
+_tags = {}
+
+# name -> (tag, compress, decompress) and tag (int) -> (name, decompress)
+_compressors = {}
+_ctags = {}
+
+
+def _register_tag(registry, tags, name, tag, encode, decode, lo, hi):
+    if len(tag) != 1 or not lo <= tag[0] <= hi:
+        raise ValueError(f'invalid tag: {tag!r}')
+    if tag[0] in tags and tags[tag[0]][0] != name:
+        raise ValueError(f'tag {tag!r} is already used by {tags[tag[0]][0]}')
+    registry[name] = (tag, encode, decode)
+    tags[tag[0]] = (name, decode)
+
+
+def register(name, tag, dumps, loads):
+    """Register a serializer.
+
+       ``tag`` is a one-byte bytes value, it must be in the range
+       ``b'\\x01'`` - ``b'\\x0f'`` (which are not the first byte of any
+       pickle).
+    """
+    _register_tag(_serializers, _tags, name, tag, dumps, loads, 0x01, 0x0f)
+
+
+def register_compressor(name, tag, compress, decompress):
+    """Register a compressor.
+
+       ``tag`` is a one-byte bytes value, in the range ``b'\\x10'`` -
+       ``b'\\x1e'``.
+    """
+    _register_tag(_compressors, _ctags, name, tag, compress, decompress,
+                  0x10, 0x1e)
+
+
+def available():
+    """Return the names of the registered serializers.
+    """
+    return list(_serializers)
+
+
+def available_compressors():
+    """Return the names of the registered compressors.
+    """
+    return list(_compressors)
+
+
+def _result_size(args, kw, res):
+    return {'size': len(res)}
+
+
+def _data_size(args, kw, res):
+    return {'size': len(args[0])}
+
+
+@instrumented('serialize', info=_result_size)
+def dumps(val, serializer=None, compression=None, threshold=None,
+          meta=None):
+    """Serialize ``val`` using ``serializer`` (a name), and compress the
+       result with ``compression`` if it is larger than ``threshold``
+       bytes.
+
+       ``compression=None`` means ``DEFAULT_COMPRESSION``, use
+       ``compression=False`` to never compress.
+
+       ``meta`` is an optional dict of marshallable metadata.
+    """
+    try:
+        tag, _dumps, _ = _serializers[serializer or DEFAULT_SERIALIZER]
+    except KeyError:
+        raise ValueError(f'unknown serializer: {serializer!r}') from None
+    data = tag + _dumps(val)
+    if compression is None:
+        compression = DEFAULT_COMPRESSION
+    if compression:
+        if threshold is None:
+            threshold = COMPRESS_THRESHOLD
+        if len(data) > threshold:
+            data = compress(data, compression)
+    if meta:
+        header = marshal.dumps(meta)
+        data = META_TAG + len(header).to_bytes(4, 'big') + header + data
+    return data
+
+
+def compress(data, compression):
+    """Compress serialized ``data`` (unless that doesn't make it smaller).
+    """
+    try:
+        tag, _compress, _ = _compressors[compression]
+    except KeyError:
+        raise ValueError(f'unknown compressor: {compression!r}') from None
+    packed = tag + _compress(data)
+    return packed if len(packed) < len(data) else data
+
+
+def loads(data):
+    """Deserialize ``data`` (as written by :func:`dumps`, or a legacy
+       pickle).
+    """
+    return loads_meta(data)[0]
+
+
+@instrumented('deserialize', info=_data_size)
+def loads_meta(data):
+    """Deserialize ``data``, returning a tuple ``(value, meta)``, where
+       ``meta`` is None if the value doesn't have any metadata.
+    """
+    meta = None
+    tag = data[0] if data else None
+    if tag == META_TAG[0]:
+        end = 5 + int.from_bytes(data[1:5], 'big')
+        meta = marshal.loads(data[5:end])
+        data = memoryview(data)[end:]
+        tag = data[0]
+    decompress = _ctags.get(tag)
+    if decompress is not None:
+        data = decompress[1](memoryview(data)[1:])
+        tag = data[0]
+    fmt = _tags.get(tag)
+    if fmt is None:
+        return pickle.loads(data), meta
+    return fmt[1](memoryview(data)[1:]), meta
+
+
+def _pickle_dumps(val):
+    return pickle.dumps(val, protocol=PICKLE_PROTOCOL)
+
+
+register('pickle', b'\x01', _pickle_dumps, pickle.loads)
+register('marshal', b'\x02', marshal.dumps, marshal.loads)
+
+try:
+    import orjson
+except ImportError:
+    def _json_dumps(val):
+        return json.dumps(val, separators=(',', ':')).encode('u8')
+
+    def _json_loads(data):
+        return json.loads(bytes(data))
+
+    register('json', b'\x03', _json_dumps, _json_loads)
+else:  # pragma: nocover
+    register('json', b'\x03', orjson.dumps, orjson.loads)
+
+try:
+    import msgpack
+except ImportError:
+    pass
+else:  # pragma: nocover
+    def _msgpack_dumps(val):
+        return msgpack.packb(val, use_bin_type=True)
+
+    def _msgpack_loads(data):
+        return msgpack.unpackb(data, raw=False)
+
+    register('msgpack', b'\x04', _msgpack_dumps, _msgpack_loads)
+
+
+register_compressor('zlib', b'\x10', zlib.compress, zlib.decompress)
+register_compressor('lzma', b'\x11', lzma.compress, lzma.decompress)
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:  # pragma: nocover
+    def _zstd_compress(data):
+        return zstandard.ZstdCompressor().compress(data)
+
+    def _zstd_decompress(data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    register_compressor('zstd', b'\x12', _zstd_compress, _zstd_decompress)
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:  # pragma: nocover
+    register_compressor('lz4', b'\x13', lz4.frame.compress,
+                        lz4.frame.decompress)
@@ -30,6 +30,6 @@ setuptools.setup(
     license='MIT',
     author='bjorn',
     author_email='bp@datakortet.no',
-    packages=['dkredis'],
+    packages=['dkredis', 'dkredis.aio'],
     zip_safe=False,
 )
@@ -144,11 +144,29 @@ def watch(ctx):
     watcher.start()
 
 
+@task
+def bench(ctx, names='', quick=False, server='env', save_baseline=False,
+          fail_on_regression=False):
+    """Run the benchmarks (see ``python -m benchmarks -h``), results are
+       saved in .benchmarks/ and compared with the saved baseline.
+    """
+    cmd = ['python -m benchmarks', '--server', server]
+    if quick:
+        cmd.append('--quick')
+    if save_baseline:
+        cmd.append('--save-baseline')
+    if fail_on_regression:
+        cmd.append('--fail-on-regression')
+    cmd += names.replace(',', ' ').split()
+    ctx.run(' '.join(cmd))
+
+
 # individual tasks that can be run from this project
 ns = Collection(
     build,
     watch,
     build_js,
+    bench,
     lessc,
     doctools,
     version, upversion,
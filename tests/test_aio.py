@@ -0,0 +1,314 @@
+"""Tests of the asyncio interface (dkredis.aio).
+"""
+import asyncio
+import time
+
+import pytest
+
+from dkredis import aio, dkredis
+from dkredis.aio.rediscache import cache as acache, cached as acached
+from dkredis.rediscache import cache, _cached_key
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_connect():
+    async def main():
+        r = aio.connect()
+        assert r is aio.connect()
+        assert await r.ping()
+        busy = await r.connection_pool.get_connection('PING')
+        await aio.reset_pools()
+        assert aio.connect() is not r
+        assert busy.is_connected
+        await busy.send_command('PING')
+        assert await busy.read_response() == b'PONG'
+        await r.connection_pool.release(busy)
+        await r.connection_pool.disconnect()
+        await aio.reset_pools()
+    run(main())
+
+
+def test_pyval_shared_with_sync():
+    async def main():
+        await aio.set_pyval('tstaiopyval', {'a': 1}, secs=5)
+        assert dkredis.get_pyval('tstaiopyval') == {'a': 1}
+        dkredis.set_pyval('tstaiopyval', [2], secs=5)
+        assert await aio.get_pyval('tstaiopyval') == [2]
+        assert await aio.pop_pyval('tstaiopyval') == [2]
+        await aio.set_pyval('tstaiopyval2', 3, secs=5)
+        assert await aio.pop_pyvals(['tstaiopyval', 'tstaiopyval2']) == {
+            'tstaiopyval2': 3}
+        assert await aio.get_pyval('tstaiopyval', missing_value=42) == 42
+    run(main())
+
+
+def test_update_setmax():
+    async def main():
+        r = aio.connect()
+        await r.set('tstaioupdate', 42)
+        assert await aio.update('tstaioupdate', lambda x: int(x) + 1) == 43
+        await r.set('tstaioupdate', 'hello')
+        assert await aio.setmax('tstaioupdate', 'world') == 'world'
+        assert await aio.setmin('tstaioupdate', 'hello') == 'hello'
+        await r.set('tstaioupdate', 9)
+        assert await aio.setmax('tstaioupdate', 10) == 10
+        assert await aio.incr('tstaioupdate', 5, maxval=12) == 12
+        await aio.remove('tstaioupdate')
+    run(main())
+
+
+def test_dict():
+    async def main():
+        await aio.set_dict('tstaiodict', dict(hello='world'), secs=5)
+        assert await aio.get_dict('tstaiodict') == {'hello': 'world'}
+    run(main())
+
+
+def test_cache_shared_with_sync():
+    async def main():
+        await acache.put('tstaiocache', {1, 2}, 5)
+        assert cache.get('tstaiocache') == {1, 2}
+        cache.put('tstaiocache', 'sync', 5)
+        assert await acache.get('tstaiocache') == 'sync'
+        assert await acache.get_many(['tstaiocache', 'x']) == (
+            {'tstaiocache': 'sync'}, {'x'})
+        await acache.remove('tstaiocache')
+        assert await acache.get_value('tstaiocache', 42) == 42
+    run(main())
+
+
+calls = []
+
+
+@acached(timeout=5)
+async def slow_square(x):
+    calls.append(x)
+    return x * x
+
+
+def test_cached():
+    async def main():
+        await acache.remove(
+            _cached_key(None, slow_square.__wrapped__, 5, (7,), {}))
+        assert await slow_square(7) == 49
+        assert await slow_square(7) == 49
+    calls.clear()
+    run(main())
+    assert calls == [7]
+
+
+def test_fetch_lock():
+    async def main():
+        async with aio.fetch_lock('tstaiofetch') as should_fetch:
+            assert should_fetch
+            async with aio.fetch_lock('tstaiofetch') as again:
+                assert not again
+        async with aio.fetch_lock('tstaiofetch') as should_fetch:
+            assert should_fetch
+    run(main())
+
+
+def test_mutex():
+    async def main():
+        async with aio.mutex('tstaiomutex', 2):
+            pass
+        async with aio.mutex('tstaiomutex', 2, waitsecs=0.1):
+            pass
+    run(main())
+
+
+def test_lock():
+    async def main():
+        lock = aio.Lock('tstaiolock', ttl=5)
+        assert await lock.acquire(blocking=False)
+        assert await lock.locked()
+        assert not await aio.Lock('tstaiolock').acquire(timeout=0.1)
+
+        async def waiter():
+            async with aio.Lock('tstaiolock', poll=10):
+                return True
+
+        task = asyncio.ensure_future(waiter())
+        await asyncio.sleep(0.1)
+        start = time.monotonic()
+        assert await lock.release()
+        assert await asyncio.wait_for(task, 2)
+        assert time.monotonic() - start < 2
+    run(main())
+
+
+def test_lock_in_several_loops():
+    lock = aio.Lock('tstaiolock', ttl=5)
+    rwlock = aio.RWLock('tstaiorwlock', ttl=5)
+
+    async def main():
+        async with lock:
+            pass
+        async with rwlock.write():
+            pass
+    run(main())
+    run(main())
+
+
+def test_lock_needs_async_with():
+    with pytest.raises(TypeError):
+        with aio.Lock('tstaiolock'):
+            pass
+    with pytest.raises(TypeError):
+        with aio.RLock('tstaiolock'):
+            pass
+
+
+def test_rlock_rwlock():
+    async def main():
+        async with aio.mutex('tstaiorlock', 5, 2, reentrant=True):
+            async with aio.mutex('tstaiorlock', 5, 2, reentrant=True):
+                pass
+        lock = aio.RWLock('tstaiorwlock', ttl=5, timeout=0.2)
+        async with lock.read():
+            async with lock.read():
+                with pytest.raises(aio.Timeout):
+                    async with lock.write():
+                        pass
+        async with lock.write():
+            assert await lock.acquire_read(blocking=False) is None
+    run(main())
+
+
+def test_rlock_nested_on_one_object():
+    async def main():
+        lock = aio.RLock('tstaiorlock', ttl=5)
+        assert await lock.acquire()
+        assert await lock.acquire()
+        assert await lock.release()
+        assert await lock.locked()
+        assert await lock.release()
+        assert not await lock.locked()
+    run(main())
+
+
+def test_multi_lock():
+    async def main():
+        tokens = await aio.multi_lock(['tstaioml1', 'tstaioml2'], ttl=5)
+        assert set(tokens) == {'tstaioml1', 'tstaioml2'}
+        assert await aio.multi_lock(['tstaioml2', 'tstaioml3']) is None
+        assert await aio.multi_unlock(tokens) == 2
+        tokens = await aio.multi_lock(['tstaioml1', 'tstaioml1'], ttl=5)
+        assert list(tokens) == ['tstaioml1']
+        assert await aio.multi_unlock(tokens) == 1
+    run(main())
+
+
+def test_lock_renew():
+    async def main():
+        lock = aio.Lock('tstaiolock', ttl=0.3, renew=True)
+        assert await lock.acquire()
+        await asyncio.sleep(0.8)
+        assert await lock.locked()
+        assert await lock.release()
+        assert not lock.lost
+        async with aio.fetch_lease('tstaiofetch', 0.3, renew=True) as lease:
+            assert lease
+            await asyncio.sleep(0.8)
+            async with aio.fetch_lock('tstaiofetch') as again:
+                assert again is False
+            assert not lease.lost
+    run(main())
+
+
+def test_get_or_compute():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return 42
+
+    async def main():
+        await acache.remove('tstaiostampede')
+        res = await asyncio.gather(*[
+            acache.get_or_compute('tstaiostampede', compute, 10)
+            for _ in range(8)
+        ])
+        assert res == [42] * 8
+        await acache.remove('tstaiostampede')
+    run(main())
+    assert len(calls) == 1
+
+
+def test_stale_while_revalidate():
+    async def main():
+        await acache.put('tstaioswr', 'old', 1, stale=30)
+        assert await acache.get_entry('tstaioswr') == ('old', True)
+        await asyncio.sleep(1.1)
+        assert await acache.get_entry('tstaioswr') == ('old', False)
+        assert await acache.get_or_compute(
+            'tstaioswr', lambda: 'new', 10, stale=30, background=True) == 'old'
+        await asyncio.sleep(0.1)
+        assert await acache.get_entry('tstaioswr') == ('new', True)
+        await acache.remove('tstaioswr')
+    run(main())
+
+
+def test_ratelimit():
+    from dkredis.aio import ratelimit
+
+    async def main():
+        limiter = ratelimit.GCRA('tstaiorl', limit=2, period=10)
+        await limiter.reset('a')
+        assert (await limiter.check('a')).allowed
+        res = await limiter.check_many(['a', 'b'])
+        assert res['a'].allowed and res['b'].allowed
+        res = await limiter.check('a')
+        assert not res.allowed and res.retry_after > 0
+        await limiter.reset('a')
+        await limiter.reset('b')
+    run(main())
+
+
+def test_fencing():
+    async def main():
+        await acache.remove('tstaiofenced')
+        async with aio.mutex('tstaiofence', fencing=True) as fence:
+            assert await acache.put_fenced('tstaiofenced', 1, fence, 5)
+            assert await aio.set_pyval_fenced('tstaiofenced', 1, fence, 5)
+        async with aio.fetch_lease('tstaiofence', fencing=True) as held:
+            assert held.fence
+        assert not await acache.put_fenced('tstaiofenced', 2, fence - 1, 5)
+        assert not await aio.set_pyval_fenced('tstaiofenced', 2, fence - 1)
+        assert await acache.get('tstaiofenced') == 1
+    run(main())
+
+
+def test_cache_tags():
+    async def main():
+        await acache.put('tstaiotagged', 42, 10, tags=['tstaiotag'])
+        assert await acache.get('tstaiotagged', tags=['tstaiotag']) == 42
+        assert cache.get('tstaiotagged', tags=['tstaiotag']) == 42
+        await acache.invalidate_tags(['tstaiotag'])
+        assert await acache.get_value('tstaiotagged',
+                                      tags=['tstaiotag']) is None
+        assert await acache.get_or_compute('tstaiotagged', lambda: 43, 10,
+                                           tags=['tstaiotag']) == 43
+        assert await acache.get('tstaiotagged', tags=['tstaiotag']) == 43
+        await acache.remove('tstaiotagged')
+    run(main())
+
+
+def test_l1_stale_while_revalidate():
+    async def main():
+        await acache.put('tstaiol1swr', 'old', 1, stale=30)
+        assert await acache.get('tstaiol1swr') == 'old'
+        assert await acache.get_entry('tstaiol1swr') == ('old', True)
+        await asyncio.sleep(1.1)
+        assert await acache.get_entry('tstaiol1swr') == ('old', False)
+        await acache.remove('tstaiol1swr')
+
+    acache.enable_l1(ttl=30)
+    try:
+        run(main())
+    finally:
+        acache.disable_l1()
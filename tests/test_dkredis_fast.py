@@ -66,15 +66,50 @@ def test_update(cn):
 def test_setmax(cn):
     cn.set('testsetmax', 'hello')
     assert dkredis.setmax('testsetmax', 'world', cn=cn) == 'world'
-    # cn.set('testsetmax', 1)
-    # assert dkredis.setmax('testsetmax', 2, cn=cn) == 2
+    cn.set('testsetmax', 1)
+    assert dkredis.setmax('testsetmax', 2, cn=cn) == 2
 
 
 def test_setmin(cn):
     cn.set('testsetmax', 'hello')
     assert dkredis.setmin('testsetmax', 'world', cn=cn) == 'hello'
-    # cn.set('testsetmax', 1)
-    # assert dkredis.setmin('testsetmax', 2, cn=cn) == 1
+    cn.set('testsetmax', 1)
+    assert dkredis.setmin('testsetmax', 2, cn=cn) == 1
+
+
+def test_setmax_numeric(cn):
+    cn.set('testsetmax', 9)
+    assert dkredis.setmax('testsetmax', 10, cn=cn) == 10  # not '9' > '10'
+    assert dkredis.setmax('testsetmax', 2.5, cn=cn) == 10.0
+    cn.delete('testsetmax')
+    assert dkredis.setmax('testsetmax', 3, cn=cn) == 3
+    assert dkredis.setmax_cutoff('testsetmax', 50, 20, cn=cn) == 20
+    assert dkredis.setmin_cutoff('testsetmax', -5, 0, cn=cn) == 0
+    assert cn.get('testsetmax') == b'0'
+    cn.delete('testsetmax')
+
+
+def test_incr(cn):
+    cn.delete('testincr')
+    assert dkredis.incr('testincr', cn=cn) == 1
+    assert dkredis.incr('testincr', 5, maxval=3, cn=cn) == 3
+    assert dkredis.incr('testincr', -10, minval=0, cn=cn) == 0
+    assert dkredis.incr('testincr', 0.5, cn=cn) == 0.5
+    cn.delete('testincr')
+
+
+def test_update_max_retries(cn):
+    cn.set('testupdate', 0)
+
+    def conflict(val):
+        cn.incr('testupdate')    # someone else changes the key..
+        return 42
+
+    retries = dkredis.UPDATE_STATS['retries']
+    with pytest.raises(dkredis.Timeout):
+        dkredis.update('testupdate', conflict, cn=cn, max_retries=2)
+    assert dkredis.UPDATE_STATS['retries'] == retries + 3
+    cn.delete('testupdate')
 
 
 def test_pyval():
@@ -87,8 +122,125 @@ def test_pop_pyval(cn):
     v = dkredis.pop_pyval('testpoppyval', cn=cn)
     assert v == 42
     assert cn.keys('testpoppyval') == []
+    assert dkredis.pop_pyval('testpoppyval', cn=cn) is None
+
+
+def test_pop_pyvals(cn):
+    dkredis.set_pyval('testpop1', 1, cn=cn)
+    dkredis.set_pyval('testpop2', [2], cn=cn)
+    assert dkredis.pop_pyvals(['testpop1', 'testpop2', 'testpop3'],
+                              cn=cn) == {'testpop1': 1, 'testpop2': [2]}
+    assert cn.exists('testpop1', 'testpop2') == 0
+
+
+def test_pop_pyval_without_getdel(cn, monkeypatch):
+    def getdel(key):
+        raise dkredis.dkredis._redis.ResponseError("unknown command 'GETDEL'")
+
+    r = dkredis.connect(pooled=False)
+    monkeypatch.setattr(r, 'getdel', getdel)
+    dkredis.set_pyval('testpop1', 1, cn=r)
+    dkredis.set_pyval('testpop2', 2, cn=r)
+    assert dkredis.pop_pyval('testpop1', cn=r) == 1
+    assert dkredis.dkredis._has_getdel[r.connection_pool] is False
+    assert dkredis.pop_pyvals(['testpop1', 'testpop2'], cn=r) == {'testpop2': 2}
+    assert cn.exists('testpop1', 'testpop2') == 0
 
 
 def test_dict(cn):
     dkredis.set_dict('testdict', dict(hello='world'), secs=5, cn=cn)
     assert dkredis.get_dict('testdict', cn=cn) == {'hello': 'world'}
+
+
+def test_batch(cn):
+    cn.delete('tstbatch.d', 'tstbatch.n')
+    with dkredis.batch() as b:
+        dkredis.set_pyval('tstbatch.a', [1], secs=5)
+        dkredis.set_dict('tstbatch.d', dict(x='1'), secs=5)
+        a = dkredis.get_pyval('tstbatch.a')
+        d = dkredis.get_dict('tstbatch.d')
+        n = dkredis.incr('tstbatch.n', 5, maxval=3)
+        cn.set('tstbatch.s', 'x')
+        error = dkredis.incr('tstbatch.s')
+        missing = dkredis.get_pyval('tstbatch.missing', missing_value=42)
+        unbatched = dkredis.get_pyval('tstbatch.a', cn=cn)
+        assert len(b) == 7 and not a.done()
+        assert unbatched is None
+    assert a.result() == [1]
+    assert d.result() == {'x': '1'}
+    assert n.result() == 3
+    assert missing.result() == 42
+    assert isinstance(error.exception(), dkredis.dkredis._redis.ResponseError)
+    with pytest.raises(dkredis.dkredis._redis.ResponseError):
+        error.result()
+    with dkredis.batch():
+        assert dkredis.remove('tstbatch.a').result() is None
+        assert cn.exists('tstbatch.a') == 0
+    with dkredis.batch(size=2):
+        f = dkredis.setmax('tstbatch.n', 10)
+        assert not f.done()
+        dkredis.setmin('tstbatch.n', 4)
+        assert f.done() and f.result() == 10
+    assert dkredis.get_pyval('tstbatch.a') is None
+    with pytest.raises(ZeroDivisionError):
+        with dkredis.batch():
+            f = dkredis.set_pyval('tstbatch.a', 1)
+            1 / 0
+    with pytest.raises(dkredis.BatchDiscarded):
+        f.result()
+    assert cn.exists('tstbatch.a') == 0
+    cn.delete('tstbatch.d', 'tstbatch.n', 'tstbatch.s')
+
+
+def test_connect_shares_pool():
+    assert dkredis.connect() is dkredis.connect()
+    assert dkredis.connect(db=1) is not dkredis.connect()
+    assert dkredis.connect(pooled=False).connection_pool \
+        is not dkredis.connect().connection_pool
+
+
+def test_reset_pools(cn):
+    cn.ping()
+    busy = cn.connection_pool.get_connection('PING')     # another thread's
+    dkredis.reset_pools()
+    assert dkredis.connect() is not cn
+    assert dkredis.connect().ping()
+    assert busy._sock is not None       # not disconnected under its feet
+    busy.send_command('PING')
+    assert busy.read_response() == b'PONG'
+    cn.connection_pool.release(busy)
+
+
+def test_configure_pools():
+    try:
+        dkredis.configure_pools(max_connections=4, blocking=True)
+        r = dkredis.connect()
+        assert r.connection_pool.max_connections == 4
+        assert r.ping()
+    finally:
+        dkredis.configure_pools()
+
+
+def test_imhkeyget(cn):
+    for key in cn.scan_iter("tstimh.*"):
+        cn.delete(key)
+    for i in range(25):
+        cn.hset(f'tstimh.{i}', 'x', i)
+    cn.hset('tstimh.nox', 'y', 1)
+    res = dict(dkredis.imhkeyget('tstimh.*', 'x', batchsize=10))
+    assert res == {f'tstimh.{i}': str(i) for i in range(25)}
+    cn.delete(*cn.keys('tstimh.*'))
+
+
+def test_get_dicts_mhget(cn):
+    dkredis.set_dict('tstdicts.a', dict(x='1', y='2'), secs=5, cn=cn)
+    dkredis.set_dict('tstdicts.b', dict(x='3'), secs=5, cn=cn)
+    assert dkredis.get_dicts(['tstdicts.a', 'tstdicts.b', 'tstdicts.c']) == {
+        'tstdicts.a': {'x': '1', 'y': '2'},
+        'tstdicts.b': {'x': '3'},
+        'tstdicts.c': {},
+    }
+    assert dkredis.mhget(['tstdicts.a', 'tstdicts.b'], ['x', 'y']) == {
+        'tstdicts.a': {'x': '1', 'y': '2'},
+        'tstdicts.b': {'x': '3', 'y': None},
+    }
@@ -3,9 +3,13 @@ Test that all modules are importable.
 """
 
 import dkredis
+import dkredis.aio
 import dkredis.dkredis
 import dkredis.dkredislocks
+import dkredis.instrumentation
+import dkredis.ratelimit
 import dkredis.rediscache
+import dkredis.scripts
 import dkredis.utils
 
 
@@ -14,7 +18,11 @@ def test_import_dkredis():
     """
     
     assert dkredis
+    assert dkredis.aio
     assert dkredis.dkredis
     assert dkredis.dkredislocks
+    assert dkredis.instrumentation
+    assert dkredis.ratelimit
     assert dkredis.rediscache
+    assert dkredis.scripts
     assert dkredis.utils
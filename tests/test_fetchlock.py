@@ -20,7 +20,7 @@ def test_fetch_lock_acquired(redis_mock):
         assert redis_mock.set.call_args == call('lock:si:weatherapi', value=ANY, ex=5, nx=True)
         assert should_fetch
 
-    assert redis_mock.eval.called
+    assert redis_mock.evalsha.called
 
 
 def test_fetch_lock_not_acquired(redis_mock):
@@ -30,7 +30,7 @@ def test_fetch_lock_not_acquired(redis_mock):
         assert redis_mock.set.call_args == call('dkredis:fetchlock:weatherapi', value=ANY, ex=5, nx=True)
         assert not should_fetch
 
-    assert not redis_mock.eval.called
+    assert not redis_mock.evalsha.called
 
 
 def test_fetch_lock_invalid_apiname(redis_mock):
@@ -0,0 +1,99 @@
+import asyncio
+import socket
+
+import pytest
+
+from dkredis import aio, dkredis, instrumentation
+from dkredis.dkredislocks import Lock
+from dkredis.rediscache import cache
+
+
+@pytest.fixture
+def metrics():
+    m = instrumentation.Metrics()
+    instrumentation.add_hook(m)
+    yield m
+    instrumentation.remove_hook(m)
+
+
+def test_no_hooks():
+    assert instrumentation.hooks == ()
+
+
+def test_cache_metrics(metrics):
+    cache.put('tstinstr', 'x' * 100, 10)
+    assert cache.get('tstinstr') == 'x' * 100
+    with pytest.raises(cache.DoesNotExist):
+        cache.get('tstinstr-missing')
+    cache.get_many(['tstinstr', 'tstinstr-missing'])
+    cache.remove('tstinstr')
+    stats = metrics.snapshot()
+    assert stats['cache.get']['count'] == 2
+    assert stats['cache.get']['hits'] == 1
+    assert stats['cache.get']['misses'] == 1
+    assert stats['cache.get']['errors'] == 0
+    assert stats['cache.get_many']['hits'] == 1
+    assert stats['cache.get_many']['misses'] == 1
+    assert stats['serialize']['bytes'] > 100
+    assert stats['deserialize']['count'] == 2
+    assert sum(stats['cache.put']['histogram']) == 1
+    text = metrics.prometheus()
+    assert 'dkredis_op_seconds_count{op="cache.get"} 2' in text
+    assert 'dkredis_op_seconds_bucket{op="cache.get",le="+Inf"} 2' in text
+    assert 'dkredis_op_hits_total{op="cache.get"} 1' in text
+    metrics.reset()
+    assert metrics.snapshot() == {}
+
+
+def test_errors_and_locks(metrics):
+    events = []
+    instrumentation.add_hook(lambda op, secs, info: events.append(op))
+    with pytest.raises(dkredis.Timeout):
+        dkredis.update('tstinstr-update', lambda v: v,
+                       max_retries=-1)
+    lock = Lock('tstinstrlock', ttl=5)
+    assert lock.acquire(blocking=False)
+    assert not Lock('tstinstrlock').acquire(blocking=False)
+    lock.release()
+    instrumentation.remove_hook(instrumentation.hooks[-1])
+    stats = metrics.snapshot()
+    assert stats['update']['errors'] == 1
+    assert stats['lock.acquire']['count'] == 2
+    assert 'lock.acquire' in events
+
+
+def test_aio_metrics(metrics):
+    async def main():
+        await aio.set_pyval('tstinstr', 1, 5)
+        assert await aio.get_pyval('tstinstr') == 1
+        await aio.update('tstinstr-update', lambda v: b'1')
+    asyncio.run(main())
+    stats = metrics.snapshot()
+    assert stats['set_pyval']['count'] == 1
+    assert stats['get_pyval']['count'] == 1
+    assert stats['update']['count'] == 1
+
+
+def test_failing_hook_is_ignored():
+    def hook(op, secs, info):
+        raise ValueError()
+    instrumentation.add_hook(hook)
+    try:
+        dkredis.set_pyval('tstinstr', 1, 5)
+    finally:
+        instrumentation.remove_hook(hook)
+    assert dkredis.get_pyval('tstinstr') == 1
+
+
+def test_statsd():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(2)
+    hook = instrumentation.StatsdHook(*server.getsockname())
+    hook('cache.get', 0.002, {'hit': False, 'size': 10})
+    data = server.recv(1024).decode()
+    assert data.split('\n') == ['dkredis.cache.get:2.000|ms',
+                                'dkredis.cache.get.miss:1|c',
+                                'dkredis.cache.get.size:10|h']
+    hook.close()
+    server.close()
@@ -0,0 +1,120 @@
+import os
+import time
+
+import pytest
+
+from dkredis import dkredis
+from dkredis import l1cache
+from dkredis.l1cache import L1Cache
+from dkredis.rediscache import cache
+
+
+@pytest.fixture
+def l1():
+    cache.enable_l1(maxbytes=1024 * 1024, ttl=30)
+    yield cache.l1
+    cache.disable_l1()
+    cache.publish_invalidations = False
+
+
+def test_lru_by_bytes():
+    c = L1Cache(maxbytes=100, ttl=10)
+    c.put('a', 1, 40)
+    c.put('b', 2, 40)
+    assert c.get('a') == 1      # 'b' is now least recently used
+    c.put('c', 3, 40)
+    assert c.get('b') is None
+    assert c.get('a') == 1
+    assert c.nbytes == 80
+    assert c.stats()['evictions'] == 1
+    c.put('huge', 4, 1000)      # larger than the cache, not stored
+    assert c.get('huge') is None
+
+
+def test_ttl():
+    c = L1Cache(maxbytes=100, ttl=10)
+    c.put('a', 1, 1, ttl=0.1)
+    assert c.get('a') == 1
+    time.sleep(0.2)
+    assert c.get('a') is None
+
+
+def test_stale_epoch():
+    c = L1Cache()
+    epoch = c.epoch
+    c.invalidate(['x'])
+    c.put('x', 1, 1, epoch=epoch)
+    assert c.get('x') is None
+
+
+def test_l1_get(l1):
+    cache.put('tstl1', 'hello', 10)
+    assert cache.get('tstl1') == 'hello'
+    assert cache.get('tstl1') == 'hello'
+    assert l1.stats()['hits'] == 1, l1.stats()
+    cache.remove('tstl1')
+    with pytest.raises(cache.DoesNotExist):
+        cache.get('tstl1')
+
+
+def test_l1_invalidation_from_other_process(l1):
+    cache.put('tstl1other', 'hello', 10)
+    assert cache.get('tstl1other') == 'hello'
+    # another process changes the value...
+    r = dkredis.connect()
+    r.set(cache.rediskey('tstl1other'), b'x', ex=10)
+    l1cache.publish(r, [cache.rediskey('tstl1other')])
+    for _ in range(50):
+        if not len(l1):
+            break
+        time.sleep(0.02)
+    assert len(l1) == 0
+    cache.remove('tstl1other')
+
+
+def test_l1_stale_while_revalidate(l1):
+    cache.put('tstl1swr', 'old', 1, stale=30)
+    assert cache.get_entry('tstl1swr') == ('old', True)
+    assert cache.get_entry('tstl1swr') == ('old', True)    # from L1
+    time.sleep(1.1)
+    assert cache.get_entry('tstl1swr') == ('old', False)
+    assert cache.get_or_compute('tstl1swr', lambda: 'new', 10, stale=30,
+                                beta=0) == 'new'
+    assert cache.get_entry('tstl1swr') == ('new', True)
+    cache.remove('tstl1swr')
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_l1_listener_restarted_after_fork(l1):
+    cache.put('tstl1fork', 'hello', 10)
+    assert cache.get('tstl1fork') == 'hello'
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:    # pragma: nocover
+        try:
+            ok = (len(l1) == 0 and l1._listener.is_alive()
+                  and l1.sender.startswith(f'{os.getpid()}.'))
+            os.write(wfd, b'1' if ok else b'0')
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(rfd, 1) == b'1'
+    os.close(rfd)
+    os.close(wfd)
+    cache.remove('tstl1fork')
+
+
+def test_publish_is_one_message():
+    r = dkredis.connect()
+    p = r.pubsub()
+    p.subscribe('tstl1channel')
+    assert p.get_message(timeout=1)['type'] == 'subscribe'
+    l1cache.publish(r, ['a b', 'c'], sender='me', channel='tstl1channel')
+    l1cache.publish(r, [], channel='tstl1channel')
+    messages = []
+    for _ in range(50):
+        m = p.get_message(timeout=0.02)
+        if m is not None:
+            messages.append(m['data'])
+    p.close()
+    assert messages == [b'["me", "a b", "c"]']
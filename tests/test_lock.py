@@ -0,0 +1,328 @@
+import threading
+import time
+
+import pytest
+
+from dkredis import dkredis
+from dkredis.dkredislocks import (
+    Lock, RLock, RWLock, fetch_lease, fetch_lock, multi_lock, multi_unlock,
+    mutex,
+)
+
+
+@pytest.fixture
+def name():
+    r = dkredis.connect()
+    for key in r.scan_iter('dkredis:*:tstlock*'):
+        r.delete(key)
+    return 'tstlock'
+
+
+def test_acquire_release(name):
+    lock = Lock(name, ttl=5)
+    assert lock.acquire(blocking=False)
+    assert lock.locked()
+    assert not Lock(name).acquire(blocking=False)
+    assert not Lock(name).acquire(timeout=0.2)
+    assert lock.release()
+    assert not lock.locked()
+    assert not lock.release()
+
+
+def test_expired_lock_is_not_released(name):
+    lock = Lock(name, ttl=0.1)
+    assert lock.acquire()
+    time.sleep(0.2)
+    other = Lock(name, ttl=5)
+    assert other.acquire(blocking=False)
+    assert not lock.release()
+    assert other.locked()
+    other.release()
+
+
+def test_with_timeout(name):
+    with Lock(name, ttl=5):
+        with pytest.raises(dkredis.Timeout):
+            with Lock(name, timeout=0.1):
+                pass
+
+
+def test_waiter_is_woken(name):
+    lock = Lock(name, ttl=5)
+    lock.acquire()
+    waited = []
+
+    def waiter():
+        start = time.monotonic()
+        with Lock(name, poll=10):
+            waited.append(time.monotonic() - start)
+
+    t = threading.Thread(target=waiter)
+    t.start()
+    time.sleep(0.2)
+    lock.release()
+    t.join()
+    assert waited[0] < 2    # not the 10 second poll interval
+
+
+def test_fair(name):
+    lock = Lock(name, ttl=5, fair=True)
+    lock.acquire()
+    order = []
+
+    def waiter(i):
+        with Lock(name, fair=True):
+            order.append(i)
+            time.sleep(0.05)
+
+    threads = []
+    for i in range(4):
+        threads.append(threading.Thread(target=waiter, args=(i,)))
+        threads[-1].start()
+        time.sleep(0.1)     # queue up in order
+    lock.release()
+    for t in threads:
+        t.join()
+    assert order == [0, 1, 2, 3]
+
+
+def test_mutex_counter(name):
+    counter = [0]
+
+    def work():
+        for _ in range(5):
+            with mutex(name, 5, 10):
+                val = counter[0]
+                time.sleep(0.001)
+                counter[0] = val + 1
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert counter[0] == 20
+
+
+def test_extend(name):
+    lock = Lock(name, ttl=0.2)
+    assert not lock.extend()
+    lock.acquire()
+    assert lock.extend(5)
+    time.sleep(0.3)
+    assert lock.locked()
+    assert lock.release()
+    assert not lock.lost
+
+
+def test_renew(name):
+    lock = Lock(name, ttl=0.3, renew=True)
+    lock.acquire()
+    time.sleep(0.8)
+    assert not Lock(name).acquire(blocking=False)
+    assert not lock.lost
+    dkredis.connect().delete(lock.key)      # lose the lock
+    time.sleep(0.3)
+    assert lock.lost
+    assert not lock.release()
+    assert lock.lost
+
+
+def test_fetch_lock_renew():
+    with fetch_lease('tstrenew', timeout=0.3, renew=True) as should_fetch:
+        assert should_fetch
+        time.sleep(0.8)
+        with fetch_lease('tstrenew', timeout=0.3) as again:
+            assert not again
+            assert not again.lost
+        with fetch_lock('tstrenew', timeout=0.3, renew=True) as again:
+            assert again is False
+        assert not should_fetch.lost
+    with fetch_lock('tstrenew', timeout=0.3) as should_fetch:
+        assert should_fetch is True
+
+
+def test_rlock(name):
+    with RLock(name, ttl=5) as outer:
+        with RLock(name, timeout=1):
+            assert outer.locked()
+        assert outer.locked()
+        result = []
+        t = threading.Thread(
+            target=lambda: result.append(RLock(name).acquire(timeout=0.2)))
+        t.start()
+        t.join()
+        assert result == [False]    # another thread
+    assert not outer.locked()
+    assert not outer.lost
+
+
+def test_mutex_key_is_compatible(name):
+    r = dkredis.connect()
+    with mutex(name, 5):
+        # older versions store (and read) an expiry timestamp
+        expires = float(r.get('dkredis:mutex:' + name))
+        assert time.time() < expires < time.time() + 6
+        r.delete('dkredis:mutex:' + name)
+        r.set('dkredis:mutex:' + name, time.time() + 5)
+        with pytest.raises(dkredis.Timeout):
+            with mutex(name, 5, 0.2):
+                pass
+    r.delete('dkredis:mutex:' + name)
+
+    # a waiter writes the expiry of the lock it got, not of its first try
+    def hold():
+        with mutex(name, 2):
+            time.sleep(1)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    time.sleep(0.1)
+    with mutex(name, 2, 2, waitsecs=0.1):
+        assert float(r.get('dkredis:mutex:' + name)) > time.time() + 1.7
+    holder.join()
+
+
+def test_mutex_legacy_keys(name):
+    # older versions left their (expired) keys behind, without a ttl
+    r = dkredis.connect()
+    r.set('dkredis:mutex:' + name, time.time() - 5)
+    with mutex(name, 5, 1):
+        assert 0 < r.pttl('dkredis:mutex:' + name) <= 5000
+    assert not r.exists('dkredis:mutex:' + name)
+
+    r.set('dkredis:mutex:' + name, time.time() + 0.3)
+    start = time.time()
+    with mutex(name, 5, 2, waitsecs=0.1):
+        assert time.time() - start > 0.25
+    r.set('dkredis:mutex:' + name, 'garbage')
+    with mutex(name, 5, 1):
+        pass
+
+
+def test_rlock_nested_on_one_object(name):
+    lock = RLock(name, ttl=0.3, renew=True)
+    assert lock.acquire()
+    watchdog = lock.watchdog
+    assert lock.acquire()
+    assert lock.watchdog is watchdog
+    assert lock.release()
+    assert lock.locked() and lock.token is not None
+    time.sleep(0.5)                 # still renewed
+    assert lock.locked()
+    assert lock.release()
+    assert not lock.locked() and not lock.lost
+    assert not watchdog.is_alive()
+
+
+def test_reentrant_mutex(name):
+    with mutex(name, 5, 2, reentrant=True):
+        with mutex(name, 5, 2, reentrant=True):
+            pass
+
+
+def test_rwlock_readers_share(name):
+    lock = RWLock(name, ttl=5)
+    t1 = lock.acquire_read()
+    t2 = lock.acquire_read(blocking=False)
+    assert t1 and t2
+    assert lock.acquire_write(blocking=False) is None
+    assert lock.release_read(t1)
+    assert lock.release_read(t2)
+    t3 = lock.acquire_write(blocking=False)
+    assert t3
+    assert lock.acquire_read(blocking=False) is None
+    assert lock.release_write(t3)
+
+
+def test_rwlock_writer_waits_for_readers(name):
+    lock = RWLock(name, ttl=5, poll=10)
+    reader = lock.acquire_read()
+    events = []
+
+    def writer():
+        with lock.write():
+            events.append('write')
+
+    t = threading.Thread(target=writer)
+    t.start()
+    time.sleep(0.2)
+    # the waiting writer blocks new readers
+    assert lock.acquire_read(timeout=0.1) is None
+    events.append('release')
+    lock.release_read(reader)
+    t.join(timeout=2)
+    assert events == ['release', 'write']
+    # .. and wakes them up when it is done
+    assert lock.acquire_read(blocking=False)
+
+
+def test_rwlock_timeout(name):
+    lock = RWLock(name, ttl=5, timeout=0.2)
+    with lock.read():
+        with pytest.raises(dkredis.Timeout):
+            with lock.write():
+                pass
+        with lock.read():       # the writer withdrew its intent
+            pass
+
+
+def test_multi_lock(name):
+    resources = [f'{name}{i}' for i in range(100)]
+    tokens = multi_lock(resources, ttl=5)
+    assert len(tokens) == 100 and len(set(tokens.values())) == 100
+    assert Lock(resources[42]).locked()
+    # all or nothing
+    assert multi_lock([f'{name}x', resources[99]]) is None
+    assert not Lock(f'{name}x').locked()
+    assert multi_unlock(tokens) == 100
+    assert not Lock(resources[42]).locked()
+    assert multi_lock([]) == {}
+    tokens = multi_lock([f'{name}a', f'{name}b', f'{name}a'], ttl=5)
+    assert list(tokens) == [f'{name}a', f'{name}b']
+    assert multi_unlock(tokens) == 2
+
+
+def test_multi_unlock_wakes_waiter(name):
+    tokens = multi_lock([name], ttl=5)
+    waited = []
+
+    def waiter():
+        start = time.monotonic()
+        with Lock(name, poll=10):
+            waited.append(time.monotonic() - start)
+
+    t = threading.Thread(target=waiter)
+    t.start()
+    time.sleep(0.2)
+    assert multi_unlock(tokens) == 1
+    t.join()
+    assert waited[0] < 2
+
+
+def test_fencing(name):
+    r = dkredis.connect()
+    r.delete('tstfenced', 'tstfenced:fence')
+    lock = Lock(name, ttl=0.1, fencing=True)
+    assert lock.acquire()
+    stale = lock.fence
+    time.sleep(0.2)                 # stalled past the ttl
+    with Lock(name, fencing=True) as other:
+        fence = other.fence
+        assert fence > stale
+        assert dkredis.set_pyval_fenced('tstfenced', 'new', fence, 5)
+    assert not dkredis.set_pyval_fenced('tstfenced', 'stale', stale, 5)
+    assert dkredis.get_pyval('tstfenced') == 'new'
+    assert not lock.release()
+    assert lock.fence is None
+    with RLock(name, fencing=True) as outer:
+        with RLock(name, fencing=True) as inner:
+            assert inner.fence == outer.fence
+    with mutex(name, fencing=True) as fence:
+        assert fence
+    with fetch_lease(name, fencing=True) as held:
+        assert held.fence
+        with fetch_lease(name, fencing=True) as again:
+            assert not again and again.fence is None
+    r.delete('tstfenced', 'dkredis:fence:tstfenced',
+             'dkredis:fetchlock:tstlock:fence')
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from dkredis import dkredis
+from dkredis.ratelimit import FixedWindow, GCRA, SlidingWindow
+
+
+@pytest.fixture
+def name():
+    r = dkredis.connect()
+    for key in r.scan_iter('dkredis:ratelimit:tstrl*'):
+        r.delete(key)
+    return 'tstrl'
+
+
+@pytest.mark.parametrize('cls', [FixedWindow, SlidingWindow, GCRA])
+def test_limit(name, cls):
+    limiter = cls(name, limit=3, period=10)
+    results = [limiter.check('a') for _ in range(4)]
+    assert [res.allowed for res in results] == [True, True, True, False]
+    assert [res.remaining for res in results] == [2, 1, 0, 0]
+    assert results[0].retry_after == 0
+    assert 0 < results[-1].retry_after <= 10
+    assert limiter.check('b').allowed   # resources are limited separately
+    limiter.reset('a')
+    assert limiter.check('a').allowed
+
+
+@pytest.mark.parametrize('cls', [FixedWindow, SlidingWindow, GCRA])
+def test_cost(name, cls):
+    limiter = cls(name, limit=5, period=10)
+    assert limiter.check('a', cost=4).allowed
+    res = limiter.check('a', cost=2)
+    assert not res.allowed
+    assert res.remaining == 1
+    assert limiter.check('a').allowed
+
+
+def test_window_expires(name):
+    limiter = FixedWindow(name, limit=1, period=0.2)
+    assert limiter.check('a').allowed
+    res = limiter.check('a')
+    assert not res.allowed
+    time.sleep(res.retry_after + 0.01)
+    assert limiter.check('a').allowed
+
+
+def test_gcra_burst(name):
+    limiter = GCRA(name, limit=10, period=1, burst=2)
+    assert limiter.check('a').allowed
+    assert limiter.check('a').allowed
+    res = limiter.check('a')
+    assert not res.allowed
+    assert 0 < res.retry_after <= 0.1
+    time.sleep(res.retry_after + 0.01)
+    assert limiter.check('a').allowed
+
+
+def test_check_many(name):
+    limiter = SlidingWindow(name, limit=1, period=10)
+    assert limiter.check('a').allowed
+    res = limiter.check_many(['a', 'b', 'c'])
+    assert list(res) == ['a', 'b', 'c']
+    assert [r.allowed for r in res.values()] == [False, True, True]
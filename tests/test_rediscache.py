@@ -1,6 +1,10 @@
 import datetime, time
 
-from dkredis.rediscache import cache, djangocache, cached
+import pytest
+
+from dkredis import dkredis
+from dkredis import rediscache
+from dkredis.rediscache import cache, djangocache, cached, Cached
 
 
 @cached(timeout=5)
@@ -38,6 +42,26 @@ def test_put():
     assert cache.get(key) == val
 
 
+def test_put_fenced():
+    key = 'tstputfenced'
+    cache.remove(key)
+    dkredis.connect().delete(cache.fencekey(key))
+    assert cache.put_fenced(key, 'first', 5, duration=5)
+    assert cache.put_fenced(key, 'second', 7, duration=5)
+    assert not cache.put_fenced(key, 'stale', 6, duration=5)
+    assert cache.get(key) == 'second'
+
+    # the fencing token is not the value of another key
+    cache.put(key + ':fence', 'other', 5)
+    assert cache.put_fenced(key, 'third', 8, duration=5)
+    assert cache.get(key + ':fence') == 'other'
+    dkredis.set_pyval(key + ':fence', 'other', 5)
+    assert dkredis.set_pyval_fenced(key, 'first', 1, 5)
+    assert dkredis.set_pyval_fenced(key, 'second', 2, 5)
+    assert dkredis.get_pyval(key + ':fence') == 'other'
+    cache.remove_many([key, key + ':fence'])
+
+
 def test_ping():
     cache.ping()
     assert 1  # didn't throw
@@ -52,3 +76,224 @@ def test_djangocache():
     key = 'testdjcache'
     djangocache.set(key, val, 15)
     assert djangocache.get(key) == val
+
+
+def test_get_with_ttl():
+    cache.put('tstttl', 'hello', 30)
+    val, ttl = cache.get_with_ttl('tstttl')
+    assert val == 'hello'
+    assert 25 < ttl <= 30
+    cache.remove('tstttl')
+    with pytest.raises(cache.DoesNotExist):
+        cache.get_with_ttl('tstttl')
+
+
+def test_many():
+    cache.put_many({'tstmany1': 1, 'tstmany2': [2]}, 10)
+    hits, misses = cache.get_many(['tstmany1', 'tstmany2', 'tstmany3'])
+    assert hits == {'tstmany1': 1, 'tstmany2': [2]}
+    assert misses == {'tstmany3'}
+    cache.remove_many(['tstmany1', 'tstmany2'])
+    assert cache.get_many(['tstmany1', 'tstmany2']) == (
+        {}, {'tstmany1', 'tstmany2'})
+    assert cache.get_many([]) == ({}, set())
+
+
+def test_djangocache_many():
+    djangocache.set_many({'tstdjmany1': 'a', 'tstdjmany2': 'b'}, 10)
+    assert djangocache.get_many(['tstdjmany1', 'tstdjmany2', 'x']) == {
+        'tstdjmany1': 'a', 'tstdjmany2': 'b'}
+    djangocache.delete_many(['tstdjmany1', 'tstdjmany2'])
+    assert djangocache.get_many(['tstdjmany1']) == {}
+
+
+def test_rediskey():
+    assert cache.rediskey('foo') == 'obj-cache:v2:s:foo'
+    assert cache.rediskey(42) != cache.rediskey('42')
+    assert cache.rediskey(b'42') != cache.rediskey('42')
+    assert cache.rediskey(True) != cache.rediskey(1)
+    assert cache.rediskey((1, 'a')) == cache.rediskey((1, 'a'))
+    assert cache.rediskey((1, 'a')) != cache.rediskey((1, 'b'))
+    assert len(cache.rediskey('x' * 1000)) < 64
+
+
+def test_legacy_keys():
+    from dkredis.rediscache import _cache_serialize
+    r = dkredis.connect()
+    r.set(cache.legacy_rediskey('tstlegacy'), _cache_serialize('old'), ex=10)
+    assert cache.get('tstlegacy') == 'old'
+    assert cache.get_many(['tstlegacy'])[0] == {'tstlegacy': 'old'}
+    cache.put('tstlegacy', 'new', 10)
+    assert r.get(cache.legacy_rediskey('tstlegacy')) is None
+    assert cache.get('tstlegacy') == 'new'
+    cache.remove('tstlegacy')
+
+
+def test_get_or_compute_stampede():
+    from multiprocessing.pool import ThreadPool
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.3)
+        return 42
+
+    cache.remove('tststampede')
+    with ThreadPool(8) as pool:
+        res = pool.map(
+            lambda _: cache.get_or_compute('tststampede', compute, 10),
+            range(8))
+    assert res == [42] * 8
+    assert len(calls) == 1
+    cache.remove('tststampede')
+
+
+def test_get_or_compute_early_recomputation():
+    cache.remove('tstxfetch')
+    assert cache.get_or_compute('tstxfetch', lambda: 1, 10) == 1
+    assert cache.get_or_compute('tstxfetch', lambda: 2, 10) == 1
+    # with a huge beta, the value is always recomputed early
+    assert cache.get_or_compute('tstxfetch', lambda: 3, 10, beta=1e12) == 3
+    cache.remove('tstxfetch')
+
+
+def test_stale_while_revalidate():
+    cache.put('tstswr', 'old', 1, stale=30)
+    assert cache.get_entry('tstswr') == ('old', True)
+    time.sleep(1.1)
+    assert cache.get('tstswr') == 'old'
+    assert cache.get_entry('tstswr') == ('old', False)
+
+    # another process is refreshing the value: serve the stale value
+    lockkey = 'dkredis:fetchlock:' + cache.rediskey('tstswr')
+    dkredis.connect().set(lockkey, 'other', ex=5)
+    assert cache.get_or_compute('tstswr', lambda: 'new', 1, stale=30) == 'old'
+    dkredis.connect().delete(lockkey)
+
+    # we refresh it ourselves
+    assert cache.get_or_compute('tstswr', lambda: 'new', 10, stale=30,
+                                beta=0) == 'new'
+    assert cache.get_entry('tstswr') == ('new', True)
+    cache.remove('tstswr')
+
+
+def test_stale_while_revalidate_background():
+    cache.put('tstswrbg', 'old', 1, stale=30)
+    time.sleep(1.1)
+    assert cache.get_or_compute('tstswrbg', lambda: 'new', 10, stale=30,
+                                background=True) == 'old'
+    for _ in range(50):
+        if cache.get_entry('tstswrbg').fresh:
+            break
+        time.sleep(0.02)
+    assert cache.get_entry('tstswrbg') == ('new', True)
+    cache.remove('tstswrbg')
+
+
+def test_tags():
+    tags = ['tsttag-a', 'tsttag-b']
+    cache.put('tsttagged', 42, 10, tags=tags)
+    cache.put('tsttagged2', 43, 10, tags=['tsttag-b'])
+    assert cache.get('tsttagged', tags=tags) == 42
+    cache.invalidate_tags(['tsttag-a'])
+    with pytest.raises(cache.DoesNotExist):
+        cache.get('tsttagged', tags=tags)
+    assert cache.get_value('tsttagged2', tags=['tsttag-b']) == 43
+    calls = []
+
+    @cached('tsttagged-fn', 10, tags=lambda x: [f'tsttag-{x}'])
+    def fn(x):
+        calls.append(x)
+        return len(calls)
+
+    assert fn('a') == fn('a') == 1
+    cache.invalidate_tags(['tsttag-a'])
+    assert fn('a') == 2
+    cache.remove_many(['tsttagged', 'tsttagged2', 'tsttagged-fn'])
+
+
+def test_batch():
+    cache.put('tstbatched', 'old', 10, tags=['tstbatchtag'])
+    with dkredis.batch():
+        put = cache.put('tstbatched', 'new', 10)
+        old = cache.get('tstbatched', tags=['tstbatchtag'])
+        values = [cache.get_value(k, 'default') for k in ['tstbatched', 'x']]
+        missing = cache.get('tstbatched-missing')
+        cache.remove('tstbatched2')
+    assert put.result() is None
+    with pytest.raises(cache.DoesNotExist):
+        old.result()        # stored without the tag
+    assert [v.result() for v in values] == ['new', 'default']
+    assert isinstance(missing.exception(), cache.DoesNotExist)
+    cache.remove('tstbatched')
+
+    # the computed value is there for the waiters when the lock is released
+    with dkredis.batch():
+        assert cache.get_or_compute('tstbatched', lambda: 42, 10) == 42
+        assert dkredis.connect().get(cache.rediskey('tstbatched'))
+    cache.remove('tstbatched')
+
+
+def test_cached_mixin():
+    class Model:
+        def save(self):
+            self.saved = True
+
+    class MyModel(Cached, Model):
+        cache_keys = ['tstmixin']
+        cache_tags = ['tsttag-mixin']
+
+    cache.put('tstmixin', 1, 10, tags=['tsttag-mixin'])
+    cache.put('tstmixin-tagged', 2, 10, tags=['tsttag-mixin'])
+    obj = MyModel()
+    assert obj.get_cache_values() == {'tstmixin': 1}
+    cache.invalidate_tags(['tsttag-mixin'])
+    assert obj.get_cache_values() == {'tstmixin': None}
+    cache.put('tstmixin', 1, 10, tags=['tsttag-mixin'])
+    cache.put('tstmixin-tagged', 2, 10, tags=['tsttag-mixin'])
+    obj.save()
+    assert obj.saved
+    assert obj.get_cache_values() == {'tstmixin': None}
+    assert cache.get_value('tstmixin-tagged', tags=['tsttag-mixin']) is None
+
+
+def test_deferred_invalidation(monkeypatch):
+    commit = []
+    monkeypatch.setattr(rediscache, '_on_commit', commit.append)
+
+    class Model:
+        def save(self):
+            pass
+
+    class MyModel(Cached, Model):
+        def __init__(self, i):
+            self.cache_keys = [f'tstdeferred-{i}']
+
+    cache.put_many({f'tstdeferred-{i}': i for i in range(3)}, 10)
+    objs = [MyModel(i) for i in range(3)]
+    with rediscache.invalidation_batch():
+        for obj in objs[:2]:
+            obj.save()
+        assert cache.get('tstdeferred-0') == 0     # not yet
+    assert cache.get('tstdeferred-0') == 0         # not committed yet
+    for fn in commit:
+        fn()
+    assert cache.get_many([f'tstdeferred-{i}' for i in range(3)]) == (
+        {'tstdeferred-2': 2}, {'tstdeferred-0', 'tstdeferred-1'})
+    MyModel.bulk_invalidate(objs)
+    commit[-1]()
+    assert cache.get_value('tstdeferred-2') is None
+
+    # a rolled back transaction drops its invalidations
+    cache.put_many({f'tstdeferred-{i}': i for i in range(2)}, 10)
+    commit.clear()
+    objs[0].save()
+    with rediscache.invalidation_batch():
+        objs[0].save()
+    commit.clear()      # rollback
+    objs[1].save()
+    for fn in commit:
+        fn()
+    assert cache.get_many(['tstdeferred-0', 'tstdeferred-1']) == (
+        {'tstdeferred-0': 0}, {'tstdeferred-1'})
+    cache.remove('tstdeferred-0')
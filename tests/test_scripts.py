@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+from redis.connection import Connection
+
+from dkredis import dkredis, ratelimit, scripts
+from dkredis.aio import dkredis as aio
+from dkredis.rediscache import cache
+
+ECHO = scripts.register('test_echo', """
+    return {KEYS[1], ARGV[1]}
+""")
+
+
+def test_register():
+    assert scripts.register('test_echo', ECHO.script) is ECHO
+    assert scripts.get('test_echo') is ECHO
+    assert 'remove_if' in scripts.registered()
+    with pytest.raises(ValueError):
+        scripts.register('test_echo', "return 1")
+
+
+def test_call_reloads_script():
+    r = dkredis.connect()
+    r.script_flush()
+    assert ECHO(r, ['k'], ['v']) == [b'k', b'v']
+    assert r.script_exists(ECHO.sha) == [True]
+
+
+def test_pipeline():
+    r = dkredis.connect()
+    r.script_flush()
+    with r.pipeline(transaction=False) as p:
+        ECHO(p, ['a'], [1])
+        ECHO(p, ['b'], [2])
+        assert scripts.execute(p) == [[b'a', b'1'], [b'b', b'2']]
+
+    # the server lost the script: it is loaded, and the calls run again
+    r.script_flush()
+    with r.pipeline(transaction=False) as p:
+        p.incr('tstscriptcount')
+        ECHO(p, ['a'], [1])
+        p.incr('tstscriptcount')
+        assert scripts.execute(p) == [1, [b'a', b'1'], 2]
+    r.delete('tstscriptcount')
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    "The commands sent to the server (a pipeline is 'PIPELINE')."
+    sent = []
+    send_command = Connection.send_command
+    pack_commands = Connection.pack_commands
+
+    def send(self, *args, **kw):
+        sent.append(args[0])
+        return send_command(self, *args, **kw)
+
+    def pack(self, commands):
+        sent.append('PIPELINE')
+        return pack_commands(self, commands)
+
+    monkeypatch.setattr(Connection, 'send_command', send)
+    monkeypatch.setattr(Connection, 'pack_commands', pack)
+    return sent
+
+
+def test_pipeline_round_trips(sent):
+    limiter = ratelimit.GCRA('tstscripts', 10, 1)
+    for _ in range(2):      # (the first time the scripts are checked)
+        sent.clear()
+        cache.put_fenced('tstscripts', 1, 1, 5)
+        limiter.check_many(['a', 'b'])
+        with dkredis.batch():
+            dkredis.setmax('tstscripts-max', 1)
+    assert sent == ['PIPELINE'] * 3
+    cache.remove('tstscripts')
+    dkredis.connect().delete('tstscripts-max', cache.fencekey('tstscripts'))
+
+
+def test_load():
+    r = dkredis.connect()
+    r.script_flush()
+    scripts.load(r)
+    assert all(r.script_exists(*[scripts.get(name).sha
+                                 for name in scripts.registered()]))
+
+
+def test_call_async():
+    async def main():
+        r = aio.connect()
+        await r.script_flush()
+        assert await ECHO.call_async(r, ['k'], ['v']) == [b'k', b'v']
+        async with r.pipeline(transaction=False) as p:
+            await ECHO.call_async(p, ['a'], [1])
+            assert await p.execute() == [[b'a', b'1']]
+        await r.script_flush()
+        async with r.pipeline(transaction=False) as p:
+            await ECHO.call_async(p, ['a'], [1])
+            assert await scripts.execute_async(p) == [[b'a', b'1']]
+    asyncio.run(main())
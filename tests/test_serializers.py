@@ -0,0 +1,91 @@
+import pickle
+
+import pytest
+
+from dkredis import dkredis, serializers
+from dkredis.rediscache import cache
+
+
+@pytest.mark.parametrize('name', serializers.available())
+def test_roundtrip(name):
+    val = {'hello': ['world', 42, 3.5, None, True]}
+    data = serializers.dumps(val, name)
+    assert serializers.loads(data) == val
+
+
+def test_pickle_roundtrip():
+    val = {42, 'hello', (1, 2)}
+    assert serializers.loads(serializers.dumps(val)) == val
+
+
+def test_legacy_pickles_are_readable():
+    val = {'hello': [1, 2, 3], 'x': (None, True)}
+    for protocol in (0, 1, 2, pickle.HIGHEST_PROTOCOL):
+        assert serializers.loads(pickle.dumps(val, protocol=protocol)) == val
+
+
+def test_unknown_serializer():
+    with pytest.raises(ValueError):
+        serializers.dumps(42, 'unknown')
+
+
+def test_register_invalid_tag():
+    with pytest.raises(ValueError):
+        serializers.register('bad', b'(', repr, eval)
+    with pytest.raises(ValueError):
+        serializers.register('bad', b'\x01', repr, eval)
+
+
+def test_cache_serializer():
+    class jsoncache(cache):
+        serializer = 'json'
+
+    jsoncache.put('tstjsoncache', (1, 2), 5)
+    assert jsoncache.get('tstjsoncache') == [1, 2]
+    cache.put('tstjsoncache', (1, 2), 5, serializer='marshal')
+    assert cache.get('tstjsoncache') == (1, 2)
+    cache.remove('tstjsoncache')
+
+
+def test_pyval_serializer():
+    dkredis.set_pyval('tstpyvalser', {'a': 1}, secs=5, serializer='json')
+    assert dkredis.get_pyval('tstpyvalser') == {'a': 1}
+    r = dkredis.connect()
+    r.set('tstpyvalser', pickle.dumps({'a': 2}, protocol=1))
+    assert dkredis.pop_pyval('tstpyvalser') == {'a': 2}
+
+
+@pytest.mark.parametrize('name', serializers.available_compressors())
+def test_compression(name):
+    val = '<p>hello world</p>' * 1000
+    data = serializers.dumps(val, compression=name, threshold=1024)
+    assert len(data) < len(val) / 10
+    assert serializers.loads(data) == val
+
+
+def test_compression_threshold():
+    data = serializers.dumps('hello', compression='zlib', threshold=1024)
+    assert data == serializers.dumps('hello')
+    assert serializers.dumps('x' * 2000, compression=False) \
+        == serializers.dumps('x' * 2000)
+
+
+def test_incompressible_values_are_stored_as_is():
+    import os
+    val = os.urandom(4096)
+    data = serializers.dumps(val, compression='zlib', threshold=1024)
+    assert data == serializers.dumps(val)
+
+
+def test_cache_compression():
+    class zcache(cache):
+        compression = 'zlib'
+        compress_threshold = 100
+
+    val = ['hello world'] * 1000
+    zcache.put('tstzcache', val, 5)
+    assert len(zcache._raw_get('tstzcache')) < 1000
+    assert cache.get('tstzcache') == val
+    dkredis.set_pyval('tstzcache', val, secs=5, compression='lzma')
+    assert dkredis.get_pyval('tstzcache') == val
+    cache.remove('tstzcache')